@@ -0,0 +1,512 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import yaml
+from pathlib import Path
+
+tests_dir = Path(__file__).parent
+root_dir = tests_dir.parent
+utils_dir = root_dir / "utils"
+data_dir = root_dir / "data"
+
+sys.path.insert(0, str(utils_dir))
+
+import cbor2_local as cbor2
+from record import Record
+from paged import PagedBuffer
+from decode_cache import DecodeCache
+from fields import Fields, DecodeConfig
+from nfc_initialize import nfc_initialize, Args as InitializeArgs
+from corpus import Generator, Args as CorpusArgs
+from inventory import Inventory
+from colors import ColorIndex
+import fleet
+import uuids
+import nfcv
+from validator import Validator
+
+parser = argparse.ArgumentParser(description="Runs in-process microbenchmarks of the utilities and reports ops/sec and per-op latency")
+parser.add_argument("-o", "--output", type=str, default=None, help="Write the results into the specified JSON file")
+parser.add_argument("-c", "--compare", type=str, default=None, help="Compare the results against a JSON file produced by a previous run")
+parser.add_argument("-k", "--filter", type=str, default=None, help="Only run benchmarks whose name contains the specified substring")
+parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of measurement rounds per benchmark")
+parser.add_argument("-t", "--min-time", type=float, default=0.2, help="Minimum duration of a single measurement round in seconds")
+parser.add_argument("--threads", type=int, default=None, help="Instead of the microbenchmarks, measure the throughput scaling of the thread workloads from 1 up to the specified number of threads")
+
+nfcv_config_file = str(data_dir / "config_nfcv.yaml")
+noroot_config_file = str(data_dir / "config_noroot.yaml")
+
+# Sample values for the individual field types, used by the Fields.encode/decode benchmarks
+field_type_samples = {
+    "bool": True,
+    "int": 215,
+    "number": 1.24,
+    "string": "PLA Prusa Galaxy Black",
+    "enum": None,  # Filled in by the first item of the enum
+    "enum_array": None,
+    "timestamp": 1758709719,
+    "bytes": {"hex": "3d3e3dff"},
+    "uuid": "31062f81-b5bd-4f86-a5f8-46367e841508",
+}
+
+
+def sample_tag(size: int = 312, aux_region: int = 32) -> bytes:
+    """Returns a tag filled with the encode_decode/01 test data"""
+    data = bytearray(nfc_initialize(InitializeArgs(size=size, aux_region=aux_region, config_file=nfcv_config_file, ndef_uri="https://3dtag.org/s/334c54f088")))
+    with open(tests_dir / "encode_decode" / "01_input.yaml", "r") as f:
+        update_data = yaml.safe_load(f)
+
+    record = Record(nfcv_config_file, memoryview(data))
+    for region_name, region in record.regions.items():
+        region.update(update_fields=update_data.get("data", dict()).get(region_name, dict()))
+
+    return bytes(data)
+
+
+@functools.cache
+def nfcv_sample() -> bytes:
+    return sample_tag()
+
+
+@functools.cache
+def sample_record() -> Record:
+    """Record of the sample tag shared by the region benchmarks (updated by the region.update ones)"""
+    return Record(nfcv_config_file, memoryview(bytearray(nfcv_sample())))
+
+
+@functools.cache
+def sample_decoded() -> list[dict]:
+    return synthetic_decoded(1000)
+
+
+@functools.cache
+def sample_inventory() -> Inventory:
+    inventory = Inventory(nfcv_config_file)
+    inventory.add_batch(sample_decoded())
+    return inventory
+
+
+def benchmarks():
+    """Yields (name, setup) pairs of all benchmarks, setup() prepares the data and returns the callable to measure
+
+    The data is built by the cached sample_* functions on the first setup that needs it, so only the data of
+    the selected benchmarks is built.
+    """
+
+    def record_init(config_file, data):
+        return lambda: Record(config_file, memoryview(bytearray(data)))
+
+    yield "record.init.nfcv", lambda: record_init(nfcv_config_file, nfcv_sample())
+    yield "record.init.noroot", lambda: record_init(noroot_config_file, bytes(sample_record().payload))
+
+    def record_init_paged():
+        data = nfcv_sample()
+        return lambda: Record(nfcv_config_file, PagedBuffer.from_bytes(data))
+
+    yield "record.init.paged", record_init_paged
+
+    def refresh():
+        # Alternating between two images that differ in the aux region
+        record = Record(nfcv_config_file, memoryview(bytearray(nfcv_sample())))
+        images = [memoryview(bytearray(nfcv_sample())), memoryview(bytearray(nfcv_sample()))]
+        Record(nfcv_config_file, images[1]).aux_region.update({"consumed_weight": 123})
+        count = itertools.count()
+        return lambda: record.refresh(images[next(count) % 2])
+
+    yield "record.refresh.aux", refresh
+
+    def region_read(region_name):
+        return sample_record().regions[region_name].read
+
+    for region_name in ("meta", "main", "aux"):
+        yield f"region.read.{region_name}", functools.partial(region_read, region_name)
+
+    def validate():
+        validator = Validator(nfcv_config_file, [str(tests_dir / "sample_requirements.yaml")])
+        record = sample_record()
+        return lambda: validator.validate_record(record)
+
+    yield "validator.record", validate
+
+    def read_main(**kwargs):
+        region = sample_record().main_region
+        return lambda: region.read(**kwargs)
+
+    yield "region.read.main.compact", lambda: read_main(config=DecodeConfig(compact=True))
+    yield "region.read.main.cached", lambda: read_main(cache=DecodeCache())
+
+    def view_main():
+        region = sample_record().main_region
+        return lambda: region.view()["material_type"]
+
+    yield "region.view.main.material_type", view_main
+    yield "region.read.main.masks", lambda: read_main(config=DecodeConfig(enum_array_masks=True))
+    yield "region.read.main.expanded", lambda: read_main(config=DecodeConfig(expand_implied=True))
+
+    main_update = {"material_name": "PLA Prusa Galaxy Blue", "min_print_temperature": 210}
+
+    def region_update(region_name, update_fields):
+        region = sample_record().regions[region_name]
+        return lambda: region.update(update_fields)
+
+    yield "region.update.main", functools.partial(region_update, "main", main_update)
+    yield "region.update.aux", functools.partial(region_update, "aux", {"consumed_weight": 123.5})
+
+    main_fields = Fields.from_file(str(data_dir / "main_fields.yaml"))
+    aux_fields = Fields.from_file(str(data_dir / "aux_fields.yaml"))
+
+    def field_encode(field, value):
+        return lambda: field.encode(value)
+
+    def field_decode(field, encoded):
+        return lambda: field.decode(encoded)
+
+    seen_types = set()
+    for field in list(main_fields.fields_by_key.values()) + list(aux_fields.fields_by_key.values()):
+        if field.type_name in seen_types:
+            continue
+
+        seen_types.add(field.type_name)
+        match field.type_name:
+            case "enum":
+                value = next(iter(field.items_by_name))
+            case "enum_array":
+                value = list(field.items_by_name)[:3]
+            case "string":
+                value = field_type_samples["string"][: field.max_len]
+            case _:
+                value = field_type_samples[field.type_name]
+
+        # Round-trip through CBOR so that decode gets the same types it would get from a tag
+        encoded = cbor2.loads(cbor2.dumps(field.encode(value)))
+        yield f"field.encode.{field.type_name}", functools.partial(field_encode, field, value)
+        yield f"field.decode.{field.type_name}", functools.partial(field_decode, field, encoded)
+
+    def fields_encode():
+        main_data = sample_record().main_region.read()
+        return lambda: main_fields.encode(main_data)
+
+    yield "fields.encode.main", fields_encode
+
+    def main_cbor():
+        region = sample_record().main_region
+        return bytes(region.memory[0 : region.used_size()])
+
+    def cbor2_loads():
+        data = main_cbor()
+        return lambda: cbor2.loads(data)
+
+    def cbor2_load_from():
+        memory = sample_record().main_region.memory
+        return lambda: cbor2.load_from(memory)
+
+    def cbor2_dumps():
+        raw = cbor2.loads(main_cbor())
+        return lambda: cbor2.dumps(raw)
+
+    yield "cbor2.loads.main", cbor2_loads
+    yield "cbor2.load_from.main", cbor2_load_from
+    yield "cbor2.dumps.main", cbor2_dumps
+
+    def initialize(init_args):
+        return lambda: nfc_initialize(init_args)
+
+    for size in (136, 312, 504, 1016, 2040):
+        init_args = InitializeArgs(size=size, aux_region=16 if size < 200 else 32, config_file=nfcv_config_file)
+        yield f"nfc_initialize.{size}", functools.partial(initialize, init_args)
+
+    inventory_query = [("material_type", "==", "PETG"), ("tags", "lacks", "abrasive"), ("remaining_weight", ">", 200)]
+
+    def inventory_query_bench():
+        inventory = sample_inventory()
+        return lambda: inventory.query(*inventory_query)
+
+    def inventory_scan():
+        inventory = sample_inventory()
+        return lambda: inventory.scan(*inventory_query)
+
+    def inventory_compatible():
+        inventory = sample_inventory()
+        return lambda: inventory.compatible(nozzle_diameter=0.4, print_temperature=240, bed_temperature=80)
+
+    yield "inventory.query.1000", inventory_query_bench
+    yield "inventory.scan.1000", inventory_scan
+    yield "inventory.compatible.1000", inventory_compatible
+
+    def colors_query():
+        index = ColorIndex.from_items(sample_inventory().items)
+        return lambda: index.query("d03020", k=5)
+
+    def colors_query_brute():
+        index = ColorIndex.from_items(sample_inventory().items)
+        return lambda: index.query_brute("d03020", k=5)
+
+    yield "colors.query.1000", colors_query
+    yield "colors.query_brute.1000", colors_query_brute
+
+    def fleet_remaining():
+        columns = fleet.batch_columns(sample_decoded())
+        return lambda: fleet.remaining_material(columns)
+
+    def uuids_resolve():
+        items = sample_inventory().items
+        return lambda: uuids.resolve_batch(items.values())
+
+    yield "fleet.remaining.1000", fleet_remaining
+    yield "uuids.resolve.1000", uuids_resolve
+
+    def instance_uuids():
+        tag_uids = [bytes([0xE0, 0x04, 0x01]) + i.to_bytes(5, "big") for i in range(1000)]
+        prusament_uuid = uuids.brand_uuid("Prusament")
+        return lambda: uuids.instance_uuids(prusament_uuid, tag_uids)
+
+    yield "uuids.instance_uuids.1000", instance_uuids
+
+    def fleet_aggregate():
+        columns = fleet.batch_columns(sample_decoded())
+        remaining = fleet.remaining_material(columns)["remaining_weight"]
+        return lambda: fleet.aggregate(columns, {"remaining_weight": remaining}, ["material_type"])
+
+    yield "fleet.aggregate.1000", fleet_aggregate
+
+    def nfcv_read_record():
+        # Protocol and parsing cost of reading a record from a simulated tag, without the simulated latency
+        loop = asyncio.new_event_loop()
+        simulator = nfcv.Slix2Simulator(nfcv_sample(), latency=nfcv.LatencyModel().scaled(0))
+        return lambda: loop.run_until_complete(nfcv.read_record(nfcv.Tag(simulator, uid=simulator.uid), nfcv_config_file))
+
+    yield "nfcv.read_record.ndef", nfcv_read_record
+
+
+def thread_workloads():
+    """Yields (name, factory) pairs of the multi-threaded scaling benchmarks
+
+    The factory is called once per thread and returns the callable to measure. Records are not thread-safe, so each
+    thread gets its own; the schemas (Fields, enum tables) and the validator are shared by all the threads.
+    """
+
+    nfcv_data = nfcv_sample()
+    main_update = {"material_name": "PLA Prusa Galaxy Blue", "min_print_temperature": 210}
+
+    def record():
+        return Record(nfcv_config_file, memoryview(bytearray(nfcv_data)))
+
+    yield "record.init.nfcv", lambda: record
+    yield "region.read.main", lambda: record().main_region.read
+
+    def update():
+        region = record().main_region
+        return lambda: region.update(main_update)
+
+    yield "region.update.main", update
+
+    main_fields = Fields.from_file(str(data_dir / "main_fields.yaml"))
+    main_data = record().main_region.read()
+    yield "fields.encode.main", lambda: lambda: main_fields.encode(main_data)
+
+    validator = Validator(nfcv_config_file, [str(tests_dir / "sample_requirements.yaml")])
+
+    def validate():
+        thread_record = record()
+        return lambda: validator.validate_record(thread_record)
+
+    yield "validator.record", validate
+
+
+def synthetic_decoded(count: int, seed: int = 0) -> list[dict]:
+    """Returns decoded region data of count synthetic tags (see corpus.Generator), without the cost of building the images"""
+    generator = Generator(CorpusArgs(count=count, output="", seed=seed))
+    rng = random.Random(seed)
+
+    result = []
+    for _ in range(count):
+        main_data = generator.main_data(rng)
+        aux_data = generator.aux_data(rng, main_data)
+        result.append(
+            {
+                "main": generator.main_fields.decode(cbor2.BufferReader(generator.main_fields.encode(main_data))),
+                "aux": generator.aux_fields.decode(cbor2.BufferReader(generator.aux_fields.encode(aux_data))),
+            }
+        )
+
+    return result
+
+
+def measure(func, repeat: int, min_time: float):
+    timer = timeit.Timer(func)
+
+    # Calibrate the number of calls so that a single round takes at least min_time
+    number, duration = timer.autorange()
+    if duration < min_time:
+        number = max(number, int(number * min_time / max(duration, 1e-9)))
+
+    per_op = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    median = statistics.median(per_op)
+
+    return {
+        "ops_per_sec": 1 / median,
+        "latency_us": {
+            "min": min(per_op) * 1e6,
+            "median": median * 1e6,
+            "mean": statistics.mean(per_op) * 1e6,
+            "stdev": statistics.stdev(per_op) * 1e6 if len(per_op) > 1 else 0,
+        },
+        "rounds": repeat,
+        "calls_per_round": number,
+    }
+
+
+def measure_threads(factory, threads: int, repeat: int, min_time: float):
+    """Runs the workload in the specified number of threads for min_time, returns the total ops/sec (median of the rounds)"""
+    funcs = [factory() for _ in range(threads)]
+    rounds = []
+
+    for _ in range(repeat):
+        counts = [0] * threads
+        barrier = threading.Barrier(threads + 1)
+        stop = threading.Event()
+
+        def run(i):
+            func = funcs[i]
+            barrier.wait()
+            count = 0
+            while not stop.is_set():
+                # Check the stop flag only every few calls, so that it does not dominate the fast workloads
+                for _ in range(16):
+                    func()
+                count += 16
+
+            counts[i] = count
+
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+
+        barrier.wait()
+        start = time.perf_counter()
+        time.sleep(min_time)
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+        rounds.append(sum(counts) / (time.perf_counter() - start))
+
+    return statistics.median(rounds)
+
+
+def thread_counts(max_threads: int) -> list[int]:
+    result = [1]
+    while result[-1] * 2 < max_threads:
+        result.append(result[-1] * 2)
+
+    if max_threads > 1:
+        result.append(max_threads)
+
+    return result
+
+
+def gil_enabled():
+    # sys._is_gil_enabled is only available since Python 3.13, the GIL is always enabled before
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled() if is_gil_enabled else True
+
+
+def run_scaling(args):
+    print(f"GIL enabled: {gil_enabled()}, CPUs: {os.cpu_count()}")
+    print(f"{'benchmark':<28} {'threads':>7} {'ops/sec':>12} {'speedup':>8}")
+
+    results = {}
+    for name, factory in thread_workloads():
+        if args.filter and args.filter not in name:
+            continue
+
+        results[name] = {}
+        for threads in thread_counts(args.threads):
+            ops_per_sec = measure_threads(factory, threads, args.repeat, args.min_time)
+            results[name][threads] = ops_per_sec
+            print(f"{name:<28} {threads:>7} {ops_per_sec:>12.1f} {ops_per_sec / results[name][1]:>7.2f}x", flush=True)
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=root_dir, capture_output=True, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        assert args.threads >= 1, "--threads must be at least 1"
+        scaling = run_scaling(args)
+
+        if args.output:
+            output = {
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "revision": git_revision(),
+                "python": sys.version,
+                "gil_enabled": gil_enabled(),
+                "cpu_count": os.cpu_count(),
+                "scaling": scaling,
+            }
+
+            with open(args.output, "w") as f:
+                json.dump(output, f, indent=2)
+
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print(f"{'benchmark':<28} {'ops/sec':>12} {'median us':>11} {'min us':>9} {'stdev us':>9}" + (f" {'vs base':>8}" if baseline else ""))
+
+    for name, setup in benchmarks():
+        if args.filter and args.filter not in name:
+            continue
+
+        result = measure(setup(), args.repeat, args.min_time)
+        results[name] = result
+
+        lat = result["latency_us"]
+        line = f"{name:<28} {result['ops_per_sec']:>12.1f} {lat['median']:>11.2f} {lat['min']:>9.2f} {lat['stdev']:>9.2f}"
+
+        if baseline and name in baseline:
+            line += f" {result['ops_per_sec'] / baseline[name]['ops_per_sec']:>7.2f}x"
+
+        print(line, flush=True)
+
+    if args.output:
+        output = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": sys.version,
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }
+
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,43 @@
 import subprocess
 import sys
+import json
 import yaml
 import argparse
+import importlib
+import http.client
 import os
+import socket
+import time
+import traceback
 from pathlib import Path
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-u", "--update", action="store_true", help="Updates reference files to match the new outputs")
+parser.add_argument("--in-process", action="store_true", help="Call the utilities' main() functions in-process instead of spawning a subprocess for every call")
 
 args = parser.parse_args()
+in_process = args.in_process
 
 tests_dir = Path(__file__).parent
 root_dir = tests_dir.parent
 utils_dir = root_dir / "utils"
 
+sys.path.insert(0, str(utils_dir))
+
+import cbor2_local as cbor2
+from common import default_config_file
+from fields import DecodeConfig
+from record import Record
+
 logs_dir = tests_dir / "logs"
 logs_dir.mkdir(exist_ok=True)
 
+start_time = time.perf_counter()
+
+# The utilities are run from the tests directory, the test files use paths relative to it
+if in_process:
+    os.chdir(tests_dir)
+
 
 # Runs nfc_initialize & nfc_update utilities and checks their result, output
 def utils_test(input_fn: str | None = None, init_args: list[str] = None, update_args: list[str] = None, info_args: list[str] = None, expect_success: bool = True, expected_info_fn: str | None = None, expected_data_fn: str | None = None):
@@ -27,7 +48,21 @@ def utils_test(input_fn: str | None = None, init_args: list[str] = None, update_
             self.code = code
             self.stderr = stderr
 
+    def run_util_in_process(util: str, util_args: list[str], input):
+        print(f"  Calling {util}.main({util_args})")
+        try:
+            return importlib.import_module(util).main(util_args, input)
+
+        except SystemExit as e:
+            raise UtilFailure(e.code, str(e).encode())
+
+        except Exception:
+            raise UtilFailure(1, traceback.format_exc().encode())
+
     def run_util(util: str, args: list[str] = [], input=None):
+        if in_process:
+            return run_util_in_process(util, args, input)
+
         proc_args = ["python3", str(root_dir / "utils" / f"{util}.py")] + args
         print(f"  Running {proc_args}")
         proc = subprocess.run(args=proc_args, input=input, capture_output=True, check=False, cwd=tests_dir)
@@ -106,7 +141,7 @@ for file in tests_dir.glob("validate/*.yaml"):
     utils_test(
         init_args=["--size=312", "--aux-region=32", "--ndef-uri=https://3dtag.org/s/334c54f088"],
         update_args=[str(file)],
-        info_args=["--validate", "--extra-required-fields=sample_requirements.yaml"],
+        info_args=["--validate", "--extra-required-fields=sample_requirements.yaml", "--profile", "--profile-trace=logs/profile_trace.json"],
     )
 
 # Run encode/decode tests
@@ -126,6 +161,56 @@ for file in tests_dir.glob("encode_decode/*_input.yaml"):
     )
 
 
+# Check the JSON update documents and the machine-friendly rec_info output formats against the YAML ones
+if True:
+    with open(tests_dir / "encode_decode" / "01_info.yaml", "r") as f:
+        expected_info = yaml.safe_load(f)
+
+    utils_test(
+        init_args=["--size=312", "--aux-region=32", "--ndef-uri", expected_info["uri"]],
+        update_args=[f"{tests_dir}/specific/json_update.json"],
+        expected_data_fn=f"{tests_dir}/encode_decode/01_data.bin",
+    )
+
+    with open(tests_dir / "encode_decode" / "01_data.bin", "rb") as f:
+        record_data = f.read()
+
+    for output_format in ("json", "ndjson", "cbor"):
+        output = subprocess.run(["python3", str(utils_dir / "rec_info.py"), "--show-all", "--show-raw-data", f"--format={output_format}"], input=record_data, check=True, capture_output=True).stdout
+        output = cbor2.loads(output) if output_format == "cbor" else json.loads(output)
+        assert output == expected_info, f"rec_info --format={output_format} output differs from the YAML one"
+
+# Run the utilities through the resident worker (see worker.py)
+if not in_process:
+    worker_socket = logs_dir / "worker.sock"
+    worker = subprocess.Popen(["python3", str(utils_dir / "worker.py"), f"--socket={worker_socket}"], stderr=subprocess.PIPE)
+    try:
+        # Wait for the worker to start listening
+        worker.stderr.readline()
+
+        os.environ["NFC_WORKER_SOCKET"] = str(worker_socket)
+        with open(tests_dir / "encode_decode" / "01_info.yaml", "r") as f:
+            uri = yaml.safe_load(f)["uri"]
+
+        utils_test(
+            init_args=["--size=312", "--aux-region=32", "--ndef-uri", uri],
+            update_args=[str(tests_dir / "encode_decode" / "01_input.yaml")],
+            info_args=["--validate", "--extra-required-fields=sample_requirements.yaml", "--show-all", "--show-raw-data"],
+            expected_info_fn=str(tests_dir / "encode_decode" / "01_info.yaml"),
+            expected_data_fn=str(tests_dir / "encode_decode" / "01_data.bin"),
+        )
+        utils_test(
+            init_args=["--size=312", "--aux-region=32"],
+            update_args=["specific/missing_required_fields.yaml"],
+            info_args=["--validate"],
+            expect_success=False,
+        )
+
+    finally:
+        del os.environ["NFC_WORKER_SOCKET"]
+        worker.terminate()
+        worker.wait()
+
 # Check that basic required fields checking works
 utils_test(
     init_args=["--size=312", "--aux-region=32"],
@@ -142,6 +227,29 @@ utils_test(
     expect_success=False,
 )
 
+# Check that tags bitmasks with unknown or deprecated keys are rejected
+for file in ("invalid_tags_mask.yaml", "bool_tags_mask.yaml"):
+    utils_test(
+        init_args=["--size=312", "--aux-region=32"],
+        update_args=[f"specific/{file}"],
+        expect_success=False,
+    )
+
+# Check that --expand-tags adds the transitively implied tags to the original ones
+if True:
+    utils_test(
+        init_args=["--size=312", "--aux-region=32"],
+        update_args=["specific/expand_tags_update.yaml"],
+        info_args=["--show-data", "--expand-tags"],
+        expected_info_fn=f"{tests_dir}/specific/expand_tags_info.yaml",
+    )
+
+    tag = subprocess.run(["python3", str(utils_dir / "nfc_initialize.py"), "--size=312", "--aux-region=32"], check=True, capture_output=True).stdout
+    tag = subprocess.run(["python3", str(utils_dir / "rec_update.py"), str(tests_dir / "specific" / "expand_tags_update.yaml")], input=tag, check=True, capture_output=True).stdout
+    tags = yaml.safe_load(subprocess.run(["python3", str(utils_dir / "rec_info.py"), "--show-data"], input=tag, check=True, capture_output=True).stdout)["data"]["main"]["tags"]
+    expanded_tags = yaml.safe_load(subprocess.run(["python3", str(utils_dir / "rec_info.py"), "--show-data", "--expand-tags"], input=tag, check=True, capture_output=True).stdout)["data"]["main"]["tags"]
+    assert set(tags) < set(expanded_tags), f"Expanded tags {expanded_tags} do not extend {tags}"
+
 # Test that we are able to handle unknown fields
 if True:
     utils_test(
@@ -158,3 +266,124 @@ if True:
         expected_info_fn=f"{tests_dir}/specific/unknown_info_2.yaml",
         expected_data_fn=f"{tests_dir}/specific/unknown_data_2.bin",
     )
+
+# Unknown keys are not errors, vendor-specific keys of the aux region are accepted by the validator
+if True:
+    vendor_dir = logs_dir / "vendor_corpus"
+    vendor_dir.mkdir(exist_ok=True)
+    tag = subprocess.run(["python3", str(utils_dir / "nfc_initialize.py"), "--size=312", "--aux-region=32"], check=True, capture_output=True).stdout
+    tag = subprocess.run(["python3", str(utils_dir / "rec_update.py"), str(tests_dir / "specific" / "vendor_data.yaml"), f"--config-file={tests_dir}/specific/vendor_config.yaml"], input=tag, check=True, capture_output=True).stdout
+    (vendor_dir / "00000000.bin").write_bytes(tag)
+    (vendor_dir / "00000001.bin").write_bytes((tests_dir / "specific" / "unknown_data_2.bin").read_bytes())
+    output = subprocess.run(["python3", str(utils_dir / "validator.py"), str(vendor_dir), "--strict"], check=True, capture_output=True).stdout.decode()
+    assert "unknown_field" in output and "65400" not in output, output
+
+# Check the UUID derivation against the example from the specification
+if True:
+    output = subprocess.run(["python3", str(utils_dir / "uuids.py"), "--brand-name=Prusament", "--tag-uid=E0040108662F6FBC"], check=True, capture_output=True).stdout.decode()
+    assert "brand_uuid: ae5ff34e-298e-50c9-8f77-92a97fb30b09" in output, output
+
+    output = subprocess.run(["python3", str(utils_dir / "uuids.py"), "--brand-name=Prusament", "--tag-uids-file=-"], input=b"E0040108662F6FBC\nBC6F2F66080104E0\n", check=True, capture_output=True).stdout.decode()
+    assert len(set(output.split())) == 1, output
+
+# Check that the synthetic corpus generator produces valid tags
+if True:
+    corpus_dir = logs_dir / "corpus"
+    subprocess.run(["python3", str(utils_dir / "corpus.py"), "--count=8", f"--output={corpus_dir}", "--directory", "--seed=1"], check=True, capture_output=True)
+
+    for file in sorted(corpus_dir.glob("*.bin")):
+        utils_test(
+            input_fn=str(file),
+            info_args=["--validate", "--show-all"],
+        )
+
+    # Records parsed from lazily fetched tag memory read the same as the fully read ones
+    for file in sorted(corpus_dir.glob("*.bin"))[:2]:
+        subprocess.run(["python3", str(utils_dir / "paged.py"), str(file), "--regions=main", "--check"], check=True, capture_output=True)
+        subprocess.run(["python3", str(utils_dir / "paged.py"), str(file), "--prefetch=8", "--check"], check=True, capture_output=True)
+
+    # The compact decoded data and the lazy views read the same as the dicts
+    for file in sorted(tests_dir.glob("encode_decode/*_data.bin")) + sorted(corpus_dir.glob("*.bin")):
+        record = Record(default_config_file, memoryview(bytearray(file.read_bytes())))
+        for name, region in record.regions.items():
+            data = region.read()
+            assert region.read(config=DecodeConfig(compact=True)).to_dict() == data, f"Compact data of the {name} region of '{file}' differ"
+
+            view = region.view()
+            assert dict(view) == data and len(view) == len(data) and list(view) == list(data), f"View of the {name} region of '{file}' differs"
+
+            # Random access on a fresh view, indexing the region only up to the accessed fields
+            view = region.view()
+            for field_name in reversed(data):
+                assert view[field_name] == data[field_name], f"View field {field_name} of the {name} region of '{file}' differs"
+
+            for field_name in [field_name for field_name in region.fields.fields_by_name if field_name not in data][:1] + ["nonexistent_field"]:
+                try:
+                    region.view()[field_name]
+                    assert False, f"View of the {name} region of '{file}' has the field {field_name}"
+                except KeyError:
+                    pass
+
+    # Batch decoding of the corpus, including the memory profiling mode
+    subprocess.run(["python3", str(utils_dir / "batch.py"), str(corpus_dir), "--memory-profile", "--limit=2"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "batch.py"), str(corpus_dir), "--tags-any=abrasive,glitter", "--tags-all=abrasive,glitter"], check=True, capture_output=True)
+    output = subprocess.run(["python3", str(utils_dir / "batch.py"), str(corpus_dir), "--cache", "--cache-entries=4", "--tags-any=abrasive"], check=True, capture_output=True).stdout.decode()
+    assert "Decode cache: " in output, output
+    subprocess.run(["python3", str(utils_dir / "inventory.py"), str(corpus_dir), "--check", "--where=material_class == FFF", "--where=tags lacks abrasive", "--where=remaining_weight > 200"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "inventory.py"), str(corpus_dir), "--check", "--where=nozzle_diameter_range contains 0.4", "--where=print_temperature_range contains 240", "--where=bed_temperature_range contains 80"], check=True, capture_output=True)
+
+    # The derived ranges keep the schema fields of the same base name (chamber_temperature, key 41)
+    chamber_dir = logs_dir / "chamber_corpus"
+    chamber_dir.mkdir(exist_ok=True)
+    tag = subprocess.run(["python3", str(utils_dir / "nfc_initialize.py"), "--size=312", "--aux-region=32"], check=True, capture_output=True).stdout
+    tag = subprocess.run(["python3", str(utils_dir / "rec_update.py"), str(tests_dir / "specific" / "chamber_update.yaml")], input=tag, check=True, capture_output=True).stdout
+    (chamber_dir / "00000000.bin").write_bytes(tag)
+    output = subprocess.run(["python3", str(utils_dir / "inventory.py"), str(chamber_dir), "--check", "--where=chamber_temperature == 35", "--where=chamber_temperature_range contains 20"], check=True, capture_output=True).stdout.decode()
+    assert "matches: 1" in output, output
+    subprocess.run(["python3", str(utils_dir / "colors.py"), str(corpus_dir), "d03020", "-k", "3", "--secondary", "--alpha-weight=0.5", "--check"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "validator.py"), str(corpus_dir), "--strict"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "validator.py"), str(corpus_dir), "--extra-required-fields=sample_requirements.yaml", "--show-records"], check=True, capture_output=True, cwd=tests_dir)
+    subprocess.run(["python3", str(utils_dir / "fleet.py"), str(corpus_dir), "--by=material_type", "--by=brand_name"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "nfcv.py"), str(corpus_dir), "--readers=2", "--latency-scale=0.01", "--jitter=0.2", "--write", "--check"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "nfcv.py"), str(corpus_dir), "--count=2", "--strategy=single", "--latency-scale=0", "--check"], check=True, capture_output=True)
+    subprocess.run(["python3", str(utils_dir / "nfcv.py"), str(corpus_dir), "--readers=2", "--strategy=lazy", "--latency-scale=0.01", "--write", "--check"], check=True, capture_output=True)
+
+    # HTTP service and its load generator, single and batch requests
+    service = subprocess.Popen(["python3", str(utils_dir / "service.py"), "--port=0", "--workers=2", "--request-timeout=1"], stderr=subprocess.PIPE)
+    try:
+        service_port = service.stderr.readline().decode().strip().rsplit(":", 1)[1]
+        for loadgen_args in (["--endpoint=info", "--requests=16"], ["--endpoint=info", "--batch=4", "--requests=4"], ["--endpoint=update", "--batch=2", "--requests=4"]):
+            subprocess.run(["python3", str(utils_dir / "service_loadgen.py"), str(corpus_dir), f"--port={service_port}", "--concurrency=2", "--strict"] + loadgen_args, check=True, capture_output=True)
+
+        def service_request(path: str, request: dict) -> int:
+            connection = http.client.HTTPConnection("127.0.0.1", int(service_port), timeout=10)
+            try:
+                connection.request("POST", path, body=json.dumps(request), headers={"Content-Type": "application/json"})
+                return connection.getresponse().status
+            finally:
+                connection.close()
+
+        # Invalid requests are rejected with 400, the same for all the endpoints
+        assert service_request("/initialize", {"args": {"size": 312, "aux_region": 32}}) == 200
+        for request in ({"args": {"size": 312, "unknown_arg": 1}}, {"args": {"size": 312, "config_file": "config.yaml"}}, {"args": {"size": 312, "ndef_uri": 5}}, {"args": {"size": True}}, {"args": {}}):
+            assert service_request("/initialize", request) == 400, request
+            assert service_request("/batch/initialize", {"items": [request["args"]]}) == 400, request
+
+        assert service_request("/info", {"data": "00", "options": {"unknown_option": True}}) == 400
+
+        # Too large bodies are refused without reading them, slow requests are disconnected after the request timeout
+        with socket.create_connection(("127.0.0.1", int(service_port)), timeout=10) as connection:
+            connection.sendall(b"POST /info HTTP/1.1\r\nContent-Length: 1000000000\r\n\r\n")
+            assert connection.recv(1024).startswith(b"HTTP/1.1 413 "), "Too large request body not refused"
+
+        with socket.create_connection(("127.0.0.1", int(service_port)), timeout=10) as connection:
+            connection.sendall(b"POST /info HTTP/1.1\r\nContent-Length: 10\r\n\r\n{")
+            request_start = time.perf_counter()
+            assert connection.recv(1024) == b"", "Incomplete request not disconnected"
+            assert time.perf_counter() - request_start < 5, "Incomplete request disconnected late"
+
+    finally:
+        service.terminate()
+        service.wait()
+
+print(f"All tests passed in {time.perf_counter() - start_time:.1f} s")
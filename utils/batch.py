@@ -0,0 +1,132 @@
+import argparse
+import os
+import sys
+import time
+import typing
+
+import numpy
+import yaml
+
+import profiling
+import memory_profiling
+from record import Record
+from fields import Fields, DecodeConfig, EnumTable
+from corpus import read_corpus
+from decode_cache import DecodeCache
+from common import default_config_file
+
+
+def load_records(images: typing.Iterable[memoryview], config_file: str = default_config_file) -> typing.Iterator[Record]:
+    """Yields a Record for each of the tag images"""
+    for image in images:
+        if type(image) is not memoryview:
+            image = memoryview(image)
+
+        yield Record(config_file, image)
+
+
+def decode_record(record: Record, regions: typing.Container[str] = None, config: DecodeConfig = None, cache: DecodeCache = None) -> dict[str, dict[str, typing.Any]]:
+    """Decodes the data of the record regions (all regions if regions is None), through the cache if given"""
+    return {name: region.read(config=config, cache=cache) for name, region in record.regions.items() if regions is None or name in regions}
+
+
+def decode_batch(images: typing.Iterable[memoryview], config_file: str = default_config_file, regions: typing.Container[str] = None, config: DecodeConfig = None, cache: DecodeCache = None) -> list[dict[str, dict[str, typing.Any]]]:
+    """Decodes data of all the tag images"""
+    return [decode_record(record, regions, config, cache) for record in load_records(images, config_file)]
+
+
+def field_enum_table(config_file: str, region: str = "main", field_name: str = "tags") -> EnumTable:
+    """Returns the enum table of an enum or enum_array field of the record configuration"""
+    with open(config_file, "r") as f:
+        config = yaml.safe_load(f)
+
+    fields = Fields.from_file(os.path.join(os.path.dirname(config_file), config[f"{region}_fields"]))
+    return fields.fields_by_name[field_name].table
+
+
+# Columnar bitmasks: a column of N masks is a (N, words) matrix of uint64, word i holding bits 64*i to 64*i+63.
+# The masks are the ones produced by decoding with DecodeConfig(enum_array_masks=True).
+
+
+def mask_column(masks: typing.Iterable[int], bit_count: int) -> numpy.ndarray:
+    """Packs the bitmasks into a word matrix, bit_count is the width of the masks (see EnumTable.bit_count)"""
+    words = max(1, (bit_count + 63) // 64)
+    data = b"".join(mask.to_bytes(words * 8, "little") for mask in masks)
+    return numpy.frombuffer(data, dtype="<u8").reshape(-1, words)
+
+
+def batch_masks(decoded: list[dict[str, dict[str, typing.Any]]], region: str = "main", field_name: str = "tags") -> list[int]:
+    """Extracts the field bitmasks from decode_batch results, records without the field have an empty mask"""
+    return [record.get(region, {}).get(field_name, 0) for record in decoded]
+
+
+def column_any_of(column: numpy.ndarray, mask: int) -> numpy.ndarray:
+    """Returns a boolean array marking the rows that have any of the mask bits set"""
+    query = mask_column([mask], column.shape[1] * 64)[0]
+    return (column & query).any(axis=1)
+
+
+def column_all_of(column: numpy.ndarray, mask: int) -> numpy.ndarray:
+    """Returns a boolean array marking the rows that have all of the mask bits set"""
+    query = mask_column([mask], column.shape[1] * 64)[0]
+    return ((column & query) == query).all(axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="batch", description="Decodes all tags of a corpus (see corpus.py) and reports statistics about the run")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-n", "--limit", type=int, default=None, help="Only decode first N tags of the corpus")
+    parser.add_argument("--profile", action=argparse.BooleanOptionalAction, default=False, help="Measure time spent in the individual parsing stages and print a summary table")
+    parser.add_argument("--memory-profile", action=argparse.BooleanOptionalAction, default=False, help="Measure memory retained by the decoded records, regions and fields (slow) and print a report")
+    parser.add_argument("--compact", action=argparse.BooleanOptionalAction, default=False, help="Decode the regions into the compact slotted representation instead of dicts")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False, help="Decode identical regions only once (see decode_cache.py) and print the cache statistics")
+    parser.add_argument("--cache-entries", type=int, default=4096, help="Maximum number of regions in the --cache")
+    parser.add_argument("--cache-bytes", type=int, default=4 * 1024 * 1024, help="Maximum encoded size of the regions in the --cache")
+    parser.add_argument("--top", type=int, default=10, help="Number of top allocation sites reported by --memory-profile")
+    parser.add_argument("--tags-any", type=str, default=None, help="Comma separated tag names, reports number of tags having any of them")
+    parser.add_argument("--tags-all", type=str, default=None, help="Comma separated tag names, reports number of tags having all of them")
+
+    args = parser.parse_args()
+
+    images = read_corpus(args.corpus)
+    if args.limit is not None:
+        images = (image for i, image in zip(range(args.limit), images))
+
+    tag_query = args.tags_any is not None or args.tags_all is not None
+    decode_config = DecodeConfig(compact=args.compact, enum_array_masks=tag_query)
+
+    if args.memory_profile:
+        report = memory_profiling.profile_decode(images, args.config_file, top=args.top, decode_config=decode_config)
+        print(memory_profiling.format_report(report))
+        sys.exit(0)
+
+    if args.profile:
+        profiling.enable()
+
+    cache = DecodeCache(args.cache_entries, args.cache_bytes) if args.cache else None
+
+    start = time.perf_counter()
+    decoded = decode_batch(images, args.config_file, config=decode_config, cache=cache)
+    duration = time.perf_counter() - start
+
+    print(f"Decoded {len(decoded)} tags in {duration:.3f} s ({len(decoded) / max(duration, 1e-9):.1f} tags/s)")
+
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Decode cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, {stats['entries']} entries of {stats['bytes']} bytes")
+
+    if tag_query:
+        table = field_enum_table(args.config_file)
+        column = mask_column(batch_masks(decoded), table.bit_count)
+
+        if args.tags_any is not None:
+            matches = column_any_of(column, table.mask_from_names(args.tags_any.split(",")))
+            print(f"Tags with any of {args.tags_any}: {int(matches.sum())}")
+
+        if args.tags_all is not None:
+            matches = column_all_of(column, table.mask_from_names(args.tags_all.split(",")))
+            print(f"Tags with all of {args.tags_all}: {int(matches.sum())}")
+
+    if profiler := profiling.disable():
+        print(profiler.format_table())
@@ -1,7 +1,12 @@
 from typing import Any
 
+from ._decoder import BufferReader as BufferReader
+from ._decoder import CBORBufferDecoder as CBORBufferDecoder
 from ._decoder import CBORDecoder as CBORDecoder
+from ._decoder import index_map as index_map
+from ._decoder import iter_map as iter_map
 from ._decoder import load as load
+from ._decoder import load_from as load_from
 from ._decoder import loads as loads
 from ._encoder import CBOREncoder as CBOREncoder
 from ._encoder import dump as dump
@@ -4,7 +4,7 @@ import re
 import struct
 import sys
 from codecs import getincrementaldecoder
-from collections.abc import Callable, Mapping, Sequence
+from collections.abc import Callable, Iterator, Mapping, Sequence
 from datetime import date, datetime, timedelta, timezone
 from io import BytesIO
 from typing import IO, TYPE_CHECKING, Any, TypeVar, cast, overload
@@ -35,6 +35,46 @@ timestamp_re = re.compile(
 incremental_utf8_decoder = getincrementaldecoder("utf-8")
 
 
+class BufferReader:
+    """
+    Minimal read-only file-like object over a buffer (:class:`bytes`,
+    :class:`bytearray`, :class:`memoryview`, :class:`mmap.mmap`, ...).
+
+    Unlike :class:`io.BytesIO`, the buffer is not copied and :meth:`read`
+    returns :class:`memoryview` slices of it. :func:`load` recognizes the
+    reader and decodes straight from the buffer using
+    :class:`CBORBufferDecoder`.
+    """
+
+    __slots__ = ("_view", "_pos")
+
+    def __init__(self, buf: bytes | bytearray | memoryview, offset: int = 0):
+        view = memoryview(buf)
+        if view.format != "B" or view.ndim != 1:
+            view = view.cast("B")
+
+        self._view = view
+        self._pos = offset
+
+    def read(self, amount: int = -1) -> memoryview:
+        start = self._pos
+        end = len(self._view) if amount < 0 else min(start + amount, len(self._view))
+        self._pos = max(end, start)
+        return self._view[start:end]
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._view)
+
+        self._pos = max(offset, 0)
+        return self._pos
+
+
 class CBORDecoder:
     """
     The CBORDecoder class implements a fully featured `CBOR`_ decoder with
@@ -296,7 +336,7 @@ class CBORDecoder:
                         raise CBORDecodeValueError(
                             f"invalid length for indefinite bytestring chunk 0x{length:x}"
                         )
-                    value = self.read(length)
+                    value = bytes(self.read(length))
                     buf.append(value)
                 else:
                     raise CBORDecodeValueError(
@@ -306,7 +346,8 @@ class CBORDecoder:
             if length > sys.maxsize:
                 raise CBORDecodeValueError(f"invalid length for bytestring 0x{length:x}")
             elif length <= 65536:
-                result = self.read(length)
+                # The stream may hand out zero-copy views (see BufferReader), materialize them here
+                result = bytes(self.read(length))
             else:
                 # Read large bytestrings 65536 (2 ** 16) bytes at a time
                 left = length
@@ -354,7 +395,7 @@ class CBORDecoder:
                         )
 
                     try:
-                        value = self.read(length).decode("utf-8", self._str_errors)
+                        value = str(self.read(length), "utf-8", self._str_errors)
                     except UnicodeDecodeError as exc:
                         raise CBORDecodeValueError("error decoding unicode string") from exc
 
@@ -367,7 +408,7 @@ class CBORDecoder:
 
             if length <= 65536:
                 try:
-                    result = self.read(length).decode("utf-8", self._str_errors)
+                    result = str(self.read(length), "utf-8", self._str_errors)
                 except UnicodeDecodeError as exc:
                     raise CBORDecodeValueError("error decoding unicode string") from exc
             else:
@@ -737,6 +778,172 @@ class CBORDecoder:
         return self.set_shareable(cast(float, struct.unpack(">d", self.read(8))[0]))
 
 
+class CBORBufferDecoder(CBORDecoder):
+    """
+    Variant of :class:`CBORDecoder` that decodes directly from a buffer, starting
+    at a given offset, instead of from a file-like object. Nothing is copied
+    except for the byte strings that end up in the decoded output, and
+    :attr:`offset` reports where the decoding stopped.
+    """
+
+    __slots__ = ("_buf", "_pos", "_end")
+
+    def __init__(
+        self,
+        buf: bytes | bytearray | memoryview,
+        offset: int = 0,
+        tag_hook: Callable[[CBORDecoder, CBORTag], Any] | None = None,
+        object_hook: Callable[[CBORDecoder, dict[Any, Any]], Any] | None = None,
+        str_errors: Literal["strict", "error", "replace"] = "strict",
+    ):
+        reader = BufferReader(buf, offset)
+        super().__init__(reader, tag_hook=tag_hook, object_hook=object_hook, str_errors=str_errors)
+        self._buf = reader._view
+        self._pos = offset
+        self._end = len(self._buf)
+
+    @property
+    def offset(self) -> int:
+        """Offset of the first byte that has not been decoded yet"""
+        return self._pos
+
+    def read(self, amount: int) -> memoryview:
+        pos = self._pos
+        end = pos + amount
+        if end > self._end:
+            raise CBORDecodeEOF(
+                f"premature end of stream (expected to read {amount} bytes, got "
+                f"{max(self._end - pos, 0)} instead)"
+            )
+
+        self._pos = end
+        return self._buf[pos:end]
+
+    def _decode(self, immutable: bool = False, unshared: bool = False) -> Any:
+        if immutable:
+            old_immutable = self._immutable
+            self._immutable = True
+        if unshared:
+            old_index = self._share_index
+            self._share_index = None
+        try:
+            pos = self._pos
+            if pos >= self._end:
+                raise CBORDecodeEOF(
+                    "premature end of stream (expected to read 1 bytes, got 0 instead)"
+                )
+
+            initial_byte = self._buf[pos]
+            self._pos = pos + 1
+            return major_decoders[initial_byte >> 5](self, initial_byte & 31)
+        finally:
+            if immutable:
+                self._immutable = old_immutable
+            if unshared:
+                self._share_index = old_index
+
+    def _peek(self) -> int:
+        if self._pos >= self._end:
+            raise CBORDecodeEOF("premature end of stream (expected to read 1 bytes, got 0 instead)")
+
+        return self._buf[self._pos]
+
+    def skip(self) -> None:
+        """
+        Advance past the next item without decoding it. Only the item headers
+        are parsed, no objects are created for the skipped data.
+        """
+        initial_byte = self._peek()
+        self._pos += 1
+        major_type = initial_byte >> 5
+        subtype = initial_byte & 31
+
+        if subtype < 24:
+            # Short forms: the value or the length is contained in the initial byte
+            if major_type in (2, 3):
+                self.read(subtype)
+            elif major_type in (4, 5):
+                for _ in range(subtype if major_type == 4 else subtype * 2):
+                    self.skip()
+            elif major_type == 6:
+                self.skip()
+            return
+
+        if major_type == 7:
+            if subtype == 31:
+                raise CBORDecodeValueError("unexpected break marker")
+
+            # Simple values and floats carry 1, 2, 4 or 8 bytes of payload
+            self.read({24: 1, 25: 2, 26: 4, 27: 8}.get(subtype, 0))
+            return
+
+        length = self._decode_length(subtype, allow_indefinite=major_type in (2, 3, 4, 5))
+        if major_type in (0, 1):
+            return
+
+        elif major_type == 6:
+            # Tagged item - the length is the tag number
+            self.skip()
+
+        elif length is not None:
+            if major_type in (2, 3):
+                self.read(length)
+            else:
+                for _ in range(length if major_type == 4 else length * 2):
+                    self.skip()
+
+        else:
+            # Indefinite length - items (or string chunks) follow until the break marker
+            while self._peek() != 0xFF:
+                self.skip()
+
+            self._pos += 1
+
+    def iter_map(self) -> Iterator[tuple[Any, int]]:
+        """
+        Decode the keys of the map at the current offset, yielding each key
+        together with the offset of its value. The values themselves are skipped,
+        not decoded; they can be decoded later with :func:`load_from`. The map is
+        scanned only as far as the iteration goes.
+        """
+        initial_byte = self._peek()
+        if initial_byte >> 5 != 5:
+            raise CBORDecodeValueError(f"expected a map, got major type {initial_byte >> 5}")
+
+        self._pos += 1
+        length = self._decode_length(initial_byte & 31, allow_indefinite=True)
+
+        count = 0
+        while True:
+            if length is None:
+                if self._peek() == 0xFF:
+                    self._pos += 1
+                    break
+            elif count == length:
+                break
+
+            key = self._decode(immutable=True, unshared=True)
+            value_offset = self._pos
+            self.skip()
+            count += 1
+            yield key, value_offset
+
+    def index_map(self) -> dict[Any, int]:
+        """
+        Decode the keys of the map at the current offset and return them mapped
+        to the offsets of their values, see :meth:`iter_map`.
+        """
+        return dict(self.iter_map())
+
+    def decode_from_bytes(self, buf: bytes) -> object:
+        # Decode the nested buffer with a separate decoder, sharing the shareables
+        decoder = CBORBufferDecoder(
+            buf, tag_hook=self._tag_hook, object_hook=self._object_hook, str_errors=self._str_errors
+        )
+        decoder._shareables = self._shareables
+        return decoder._decode()
+
+
 major_decoders: dict[int, Callable[[CBORDecoder, int], Any]] = {
     0: CBORDecoder.decode_uint,
     1: CBORDecoder.decode_negint,
@@ -819,6 +1026,63 @@ def loads(
         ).decode()
 
 
+def load_from(
+    buf: bytes | bytearray | memoryview,
+    offset: int = 0,
+    tag_hook: Callable[[CBORDecoder, CBORTag], Any] | None = None,
+    object_hook: Callable[[CBORDecoder, dict[Any, Any]], Any] | None = None,
+    str_errors: Literal["strict", "error", "replace"] = "strict",
+) -> tuple[Any, int]:
+    """
+    Deserialize an object from a buffer, starting at the given offset, without
+    copying the buffer.
+
+    :param buf:
+        the buffer to deserialize from (anything supporting the buffer protocol)
+    :param offset:
+        offset of the first byte of the encoded item in ``buf``
+    :param tag_hook:
+        see :func:`load`
+    :param object_hook:
+        see :func:`load`
+    :param str_errors:
+        see :func:`load`
+    :return:
+        a tuple of the deserialized object and the offset right after the end of
+        the encoded item
+
+    """
+    decoder = CBORBufferDecoder(
+        buf, offset, tag_hook=tag_hook, object_hook=object_hook, str_errors=str_errors
+    )
+    value = decoder.decode()
+    return value, decoder.offset
+
+
+def iter_map(buf: bytes | bytearray | memoryview, offset: int = 0) -> Iterator[tuple[Any, int]]:
+    """
+    Lazily iterate over the keys of the map encoded in the buffer at the given
+    offset, yielding each key together with the offset of its value in ``buf``.
+    The values are not decoded.
+    """
+    return CBORBufferDecoder(buf, offset).iter_map()
+
+
+def index_map(buf: bytes | bytearray | memoryview, offset: int = 0) -> tuple[dict[Any, int], int]:
+    """
+    Index the map encoded in the buffer at the given offset without decoding its
+    values.
+
+    :return:
+        a tuple of a dictionary mapping the map keys to the offsets of their
+        values in ``buf``, and the offset right after the end of the map
+
+    """
+    decoder = CBORBufferDecoder(buf, offset)
+    result = decoder.index_map()
+    return result, decoder.offset
+
+
 def load(
     fp: IO[bytes],
     tag_hook: Callable[[CBORDecoder, CBORTag], Any] | None = None,
@@ -848,6 +1112,15 @@ def load(
     .. _Error Handlers: https://docs.python.org/3/library/codecs.html#error-handlers
 
     """
+    if isinstance(fp, BufferReader):
+        # Decode straight from the underlying buffer, then advance the reader
+        decoder = CBORBufferDecoder(
+            fp._view, fp.tell(), tag_hook=tag_hook, object_hook=object_hook, str_errors=str_errors
+        )
+        value = decoder.decode()
+        fp.seek(decoder.offset)
+        return value
+
     return CBORDecoder(
         fp, tag_hook=tag_hook, object_hook=object_hook, str_errors=str_errors
     ).decode()
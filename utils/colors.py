@@ -0,0 +1,202 @@
+# Perceptual color similarity search over the color fields
+#
+# Colors are converted to CIELAB (D65), where the Euclidean distance (CIE76 ΔE) approximates the perceived difference.
+# ColorIndex buckets the colors into a uniform grid over the Lab space. A query visits the occupied cells in order
+# of their distance from the query cell, and stops once no unvisited cell can hold a closer color than the k-th best.
+
+import argparse
+import math
+import sys
+import typing
+
+import numpy
+import yaml
+
+from fields import DecodeConfig
+from batch import decode_batch
+from corpus import read_corpus
+from common import default_config_file
+
+primary_color_fields = ("primary_color",)
+all_color_fields = ("primary_color", "secondary_color_0", "secondary_color_1", "secondary_color_2", "secondary_color_3", "secondary_color_4")
+
+# D65 reference white
+_white = numpy.array([0.95047, 1.0, 1.08883])
+
+_rgb_to_xyz = numpy.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+
+
+def rgba(value) -> tuple[int, int, int, int]:
+    """Converts a color value as decoded ({"hex": ...} or RGBA tuple), raw bytes or a hex string into (r, g, b, a)"""
+    if isinstance(value, dict):
+        value = bytes.fromhex(value["hex"])
+    elif isinstance(value, str):
+        value = bytes.fromhex(value.removeprefix("#"))
+
+    assert len(value) in (3, 4), f"Invalid color {value!r}"
+    return (value[0], value[1], value[2], value[3] if len(value) == 4 else 255)
+
+
+def srgb_to_lab(rgb: numpy.ndarray) -> numpy.ndarray:
+    """Converts an (N, 3) array of sRGB colors (0-255) into an (N, 3) array of CIELAB colors"""
+    c = numpy.asarray(rgb, dtype=numpy.float64) / 255
+
+    # sRGB companding
+    linear = numpy.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+
+    xyz = linear @ _rgb_to_xyz.T / _white
+    f = numpy.where(xyz > (6 / 29) ** 3, numpy.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+
+    return numpy.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+class ColorIndex:
+    """Nearest neighbor index of colors in the CIELAB space
+
+    The distance is the Lab distance, optionally extended with weighted alpha and transmission distance differences:
+    sqrt(ΔE² + (alpha_weight * Δalpha)² + (td_weight * Δlog2(TD))²), alpha in 0-100. Entries without a transmission
+    distance do not contribute the TD term. The extra terms only add to ΔE, so the grid pruning by ΔE stays valid.
+    """
+
+    ids: numpy.ndarray  # (N,) ids of the entries (one item can have several entries, for example secondary colors)
+    rgba: numpy.ndarray  # (N, 4) uint8
+    lab: numpy.ndarray  # (N, 3)
+    log_td: numpy.ndarray  # (N,), NaN if the transmission distance is unknown
+
+    def __init__(self, ids: typing.Sequence[int], colors: typing.Sequence[tuple[int, int, int, int]], transmission_distances: typing.Sequence[float | None] = None, cell_size: float = 10.0):
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        self.rgba = numpy.asarray(colors, dtype=numpy.uint8).reshape(-1, 4)
+        self.lab = srgb_to_lab(self.rgba[:, :3])
+
+        if transmission_distances is None:
+            self.log_td = numpy.full(len(self.ids), numpy.nan)
+        else:
+            self.log_td = numpy.log2(numpy.array([numpy.nan if td is None else td for td in transmission_distances], dtype=numpy.float64))
+
+        self.cell_size = cell_size
+
+        # Group the entries by their grid cell
+        cells = numpy.floor(self.lab / cell_size).astype(numpy.int64)
+        self.cells, cell_of_entry = numpy.unique(cells, axis=0, return_inverse=True)
+        cell_of_entry = cell_of_entry.reshape(-1)
+        self.cell_order = numpy.argsort(cell_of_entry, kind="stable")
+        self.cell_starts = numpy.searchsorted(cell_of_entry[self.cell_order], numpy.arange(len(self.cells) + 1))
+
+    @classmethod
+    def from_items(cls, items: typing.Mapping[int, typing.Mapping[str, typing.Any]], fields: typing.Iterable[str] = primary_color_fields, cell_size: float = 10.0) -> "ColorIndex":
+        """Builds the index from {id: item} (for example Inventory.items), one entry per present color field"""
+        ids, colors, tds = [], [], []
+        for item_id, item in items.items():
+            for field_name in fields:
+                value = item.get(field_name)
+                if value is None:
+                    continue
+
+                ids.append(item_id)
+                colors.append(rgba(value))
+                tds.append(item.get("transmission_distance"))
+
+        return cls(ids, colors, tds, cell_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _distances(self, entries: numpy.ndarray, lab: numpy.ndarray, alpha: int, alpha_weight: float, log_td: float | None, td_weight: float) -> numpy.ndarray:
+        squared = ((self.lab[entries] - lab) ** 2).sum(axis=1)
+
+        if alpha_weight:
+            squared += (alpha_weight * (self.rgba[entries, 3].astype(numpy.float64) - alpha) * (100 / 255)) ** 2
+
+        if td_weight and log_td is not None:
+            td_diff = self.log_td[entries] - log_td
+            squared += numpy.where(numpy.isnan(td_diff), 0, (td_weight * td_diff) ** 2)
+
+        return numpy.sqrt(squared)
+
+    def query(self, color, k: int = 5, alpha_weight: float = 0.0, transmission_distance: float = None, td_weight: float = 0.0) -> list[tuple[int, float]]:
+        """Returns up to k (id, distance) pairs of the items with the closest color, closest first
+
+        An item with several entries is reported once, with its closest entry.
+        """
+        r, g, b, a = rgba(color)
+        lab = srgb_to_lab(numpy.array([[r, g, b]]))[0]
+        log_td = math.log2(transmission_distance) if transmission_distance is not None else None
+
+        # Chebyshev distance (in cells) of the occupied cells from the query cell. Entries in a cell at distance d
+        # are at least (d - 1) * cell_size far from the query.
+        query_cell = numpy.floor(lab / self.cell_size).astype(numpy.int64)
+        cell_distances = numpy.abs(self.cells - query_cell).max(axis=1) if len(self.cells) else numpy.zeros(0, dtype=numpy.int64)
+        cells_by_distance = numpy.argsort(cell_distances, kind="stable")
+        sorted_distances = cell_distances[cells_by_distance]
+
+        best: dict[int, float] = dict()
+        start = 0
+        while start < len(cells_by_distance):
+            ring = sorted_distances[start]
+            end = numpy.searchsorted(sorted_distances, ring, side="right")
+
+            entries = numpy.concatenate([self.cell_order[self.cell_starts[c] : self.cell_starts[c + 1]] for c in cells_by_distance[start:end]])
+            distances = self._distances(entries, lab, a, alpha_weight, log_td, td_weight)
+
+            for item_id, distance in zip(self.ids[entries].tolist(), distances.tolist()):
+                if distance < best.get(item_id, math.inf):
+                    best[item_id] = distance
+
+            start = end
+
+            # All the remaining cells are at least `ring` cells away
+            if len(best) >= k and sorted(best.values())[k - 1] <= ring * self.cell_size:
+                break
+
+        return sorted(best.items(), key=lambda x: (x[1], x[0]))[:k]
+
+    def query_brute(self, color, k: int = 5, alpha_weight: float = 0.0, transmission_distance: float = None, td_weight: float = 0.0) -> list[tuple[int, float]]:
+        """Same as query, but computes distances to all the entries"""
+        r, g, b, a = rgba(color)
+        lab = srgb_to_lab(numpy.array([[r, g, b]]))[0]
+        log_td = math.log2(transmission_distance) if transmission_distance is not None else None
+
+        distances = self._distances(numpy.arange(len(self.ids)), lab, a, alpha_weight, log_td, td_weight)
+
+        best: dict[int, float] = dict()
+        for item_id, distance in zip(self.ids.tolist(), distances.tolist()):
+            if distance < best.get(item_id, math.inf):
+                best[item_id] = distance
+
+        return sorted(best.items(), key=lambda x: (x[1], x[0]))[:k]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="colors", description="Finds the tags of a corpus (see corpus.py) with the color closest to the specified one")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("color", help="Color as hex RGB or RGBA, for example ff8000")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-k", type=int, default=5, help="Number of results")
+    parser.add_argument("--secondary", action=argparse.BooleanOptionalAction, default=False, help="Also match the secondary colors")
+    parser.add_argument("--alpha-weight", type=float, default=0.0, help="Weight of the alpha channel difference")
+    parser.add_argument("--td", type=float, default=None, help="Transmission distance to match")
+    parser.add_argument("--td-weight", type=float, default=0.0, help="Weight of the log2 transmission distance difference")
+    parser.add_argument("--check", action=argparse.BooleanOptionalAction, default=False, help="Check the index result against a brute force search")
+
+    args = parser.parse_args()
+
+    decoded = decode_batch(read_corpus(args.corpus), args.config_file, regions=("main",), config=DecodeConfig(rgba_colors=True))
+    index = ColorIndex.from_items({i: d["main"] for i, d in enumerate(decoded)}, all_color_fields if args.secondary else primary_color_fields)
+
+    query_args = dict(k=args.k, alpha_weight=args.alpha_weight, transmission_distance=args.td, td_weight=args.td_weight)
+    result = index.query(args.color, **query_args)
+
+    if args.check:
+        expected = index.query_brute(args.color, **query_args)
+        if [i for i, _ in result] != [i for i, _ in expected]:
+            print(f"Index result differs from the brute force search: {result} != {expected}", file=sys.stderr)
+            sys.exit(1)
+
+    output = [{"tag": item_id, "color": "%02x%02x%02x%02x" % decoded[item_id]["main"]["primary_color"] if "primary_color" in decoded[item_id]["main"] else None, "distance": round(distance, 2)} for item_id, distance in result]
+    print(yaml.dump(output, sort_keys=False), end="")
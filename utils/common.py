@@ -1,3 +1,30 @@
 import os
+import threading
+import typing
 
 default_config_file = os.path.join(os.path.dirname(__file__), "../data/config_nfcv.yaml")
+
+# Results of cached_load by (file path, modification time, size, load function, arguments)
+_file_cache: dict[tuple, typing.Any] = dict()
+_file_cache_lock = threading.Lock()
+
+
+def cached_load(file: str, load: typing.Callable, *args):
+    """Returns load(file, *args), reusing the result as long as the file is not modified
+
+    Used for the configuration and schema files, which are parsed once and then shared by all the records.
+    The results must thus be treated as read-only. Safe to call from multiple threads; concurrent first calls
+    can load the file more than once, but all of them return the same object.
+    """
+    stat = os.stat(file)
+    cache_key = (os.path.abspath(file), stat.st_mtime_ns, stat.st_size, load, args)
+
+    with _file_cache_lock:
+        result = _file_cache.get(cache_key)
+
+    if result is None:
+        result = load(file, *args)
+        with _file_cache_lock:
+            result = _file_cache.setdefault(cache_key, result)
+
+    return result
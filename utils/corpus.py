@@ -0,0 +1,377 @@
+# Generator of synthetic tag corpora for load testing, and reading/writing of the corpus files
+#
+# A corpus is either a directory of raw tag images (one .bin file per tag) or a single stream file,
+# which is a sequence of tag images, each prefixed by its length as a 2-byte big-endian integer.
+
+import simple_parsing
+import multiprocessing
+import random
+import os
+import sys
+import types
+import typing
+import uuid
+from dataclasses import dataclass, field
+
+from fields import Fields, EncodeConfig
+import formats
+from record import Record, load_config
+from nfc_initialize import nfc_initialize, Args as InitializeArgs
+from common import default_config_file, cached_load
+
+# Number of tags generated with a single RNG seed, also the work unit for parallel generation
+chunk_size = 1000
+
+# Placeholder URI, patched per tag with a random one of the same length
+uri_prefix = "https://3dtag.org/s/"
+uri_id_length = 10
+
+# Relative frequencies of material types, the remaining types share the rest
+material_type_weights = {
+    "PLA": 40,
+    "PETG": 22,
+    "ABS": 6,
+    "ASA": 6,
+    "TPU": 6,
+    "PC": 3,
+    "PCTG": 2,
+    "PA12": 2,
+}
+
+# Typical physical and printing parameters per material type: density, print temperature range, bed temperature range
+material_type_profiles = {
+    "PLA": (1.24, (190, 230), (50, 65)),
+    "PETG": (1.27, (220, 260), (70, 90)),
+    "ABS": (1.04, (230, 260), (90, 110)),
+    "ASA": (1.07, (240, 270), (90, 110)),
+    "TPU": (1.21, (210, 240), (40, 60)),
+    "PC": (1.20, (260, 300), (100, 120)),
+    "PCTG": (1.23, (230, 260), (70, 90)),
+}
+default_profile = (1.15, (220, 280), (60, 100))
+
+color_names = {
+    "Black": (0x20, 0x20, 0x20),
+    "White": (0xF0, 0xF0, 0xF0),
+    "Grey": (0x80, 0x80, 0x80),
+    "Red": (0xC0, 0x20, 0x20),
+    "Orange": (0xF0, 0x70, 0x10),
+    "Yellow": (0xF0, 0xD0, 0x20),
+    "Green": (0x30, 0xA0, 0x40),
+    "Blue": (0x20, 0x50, 0xC0),
+    "Purple": (0x70, 0x30, 0xA0),
+    "Silver": (0xB0, 0xB0, 0xB8),
+}
+
+nominal_weights = [1000] * 14 + [750] * 2 + [500] * 2 + [250, 2000]
+
+
+@dataclass
+class Args:
+    """Following command line arguments are accepted (you can also use the file as a module)"""
+
+    # Number of tags to generate
+    count: int = simple_parsing.field(alias=["-n"])
+
+    # Output stream file, or a directory if --directory is set
+    output: str = simple_parsing.field(alias=["-o"])
+
+    # Write one .bin file per tag into the output directory instead of a single stream file
+    directory: bool = False
+
+    # YAML file with the fields configuration
+    config_file: str = simple_parsing.field(default=default_config_file, alias=["-c", "--config-file"])
+
+    # Seed of the random generator. The same seed always produces the same corpus
+    seed: int = 0
+
+    # Probability that a field marked as recommended is present
+    recommended_rate: float = 0.9
+
+    # Probability that an optional field is present
+    optional_rate: float = 0.3
+
+    # Probability that an aux region (when allocated) contains consumption data
+    aux_data_rate: float = 0.5
+
+    # Probability that the tag carries a URI NDEF record
+    uri_rate: float = 0.5
+
+    # Tag sizes to pick from
+    sizes: list[int] = field(default_factory=lambda: [136, 304, 312, 504])
+
+    # Aux region sizes to pick from, 0 = no aux region
+    aux_sizes: list[int] = field(default_factory=lambda: [0, 16, 32])
+
+    # Number of worker processes
+    jobs: int = simple_parsing.field(default=1, alias=["-j"])
+
+
+class _Template:
+    """Initialized empty tag image of a given layout, with absolute region positions"""
+
+    def __init__(self, config_file: str, size: int, aux_size: int, uri: bool):
+        init_args = InitializeArgs(size=size, config_file=config_file, aux_region=aux_size or None, ndef_uri=(uri_prefix + "0" * uri_id_length) if uri else None)
+        self.data = nfc_initialize(init_args)
+
+        record = Record(config_file, memoryview(bytearray(self.data)))
+        self.main_offset = record.payload_offset + record.main_region.offset
+        self.main_size = len(record.main_region.memory)
+
+        self.aux_offset = None
+        if record.aux_region is not None:
+            self.aux_offset = record.payload_offset + record.aux_region.offset
+            self.aux_size = len(record.aux_region.memory)
+
+        self.uri_offset = None
+        if uri:
+            self.uri_offset = self.data.index(b"0" * uri_id_length)
+
+
+class Generator:
+    """Produces valid tag images with realistic data, following the field schemas from the config"""
+
+    def __init__(self, args: Args):
+        self.args = args
+
+        config_dir = os.path.dirname(args.config_file)
+        config = types.SimpleNamespace(**cached_load(args.config_file, load_config))
+
+        self.main_fields = Fields.from_file(os.path.join(config_dir, config.main_fields))
+        self.aux_fields = Fields.from_file(os.path.join(config_dir, config.aux_fields))
+        self.encode_config = EncodeConfig()
+
+        # Categories are not part of the Field objects, read them from the schema directly
+        schema = formats.load_file(os.path.join(config_dir, config.main_fields), "yaml")
+        self.categories = {row["name"]: row.get("category") for row in schema if not row.get("deprecated", False)}
+
+        self.templates = dict()
+
+        material_types = list(self.main_fields.fields_by_name["material_type"].items_by_name)
+        self.material_types = material_types
+        self.material_type_weights = [material_type_weights.get(t, 0.5) for t in material_types]
+
+        self.tags = list(self.main_fields.fields_by_name["tags"].items_by_name)
+
+        # A fixed pool of brands with Zipf-like popularity
+        brand_rng = random.Random(args.seed)
+        self.brands = [(f"Brand {brand_rng.randrange(16**4):04X}", [brand_rng.randrange(10**12) for _ in range(8)]) for _ in range(50)]
+        self.brand_weights = [1 / (i + 1) for i in range(len(self.brands))]
+
+    def template(self, size: int, aux_size: int, uri: bool) -> _Template:
+        key = (size, aux_size, uri)
+        result = self.templates.get(key)
+        if result is None:
+            result = self.templates[key] = _Template(self.args.config_file, size, aux_size, uri)
+
+        return result
+
+    def _present(self, rng: random.Random, field_name: str, material_class: str) -> bool:
+        category = self.categories.get(field_name)
+        if category is not None and category != material_class.lower():
+            return False
+
+        match self.main_fields.fields_by_name[field_name].required:
+            case True:
+                return True
+            case "recommended":
+                return rng.random() < self.args.recommended_rate
+            case _:
+                return rng.random() < self.args.optional_rate
+
+    def _generic_value(self, rng: random.Random, field):
+        """Random value of the field's type, for fields without a specific generator"""
+        match field.type_name:
+            case "bool":
+                return rng.random() < 0.5
+            case "int":
+                return rng.randrange(1, 300)
+            case "number":
+                return round(rng.uniform(0.1, 100), 1)
+            case "string":
+                return "".join(rng.choices("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789", k=rng.randrange(4, field.max_len + 1)))
+            case "enum":
+                return rng.choice(list(field.items_by_name))
+            case "enum_array":
+                return rng.sample(list(field.items_by_name), rng.randrange(0, 3))
+            case "timestamp":
+                return rng.randrange(1_700_000_000, 1_800_000_000)
+            case "bytes":
+                return rng.randbytes(field.max_len)
+            case "uuid":
+                return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            case _:
+                assert False, f"Unsupported field type '{field.type_name}'"
+
+    def main_data(self, rng: random.Random) -> dict[str, typing.Any]:
+        material_class = "FFF" if rng.random() < 0.9 else "SLA"
+        material_type = rng.choices(self.material_types, self.material_type_weights)[0]
+        density, print_temp, bed_temp = material_type_profiles.get(material_type, default_profile)
+        brand_name, brand_gtins = rng.choices(self.brands, self.brand_weights)[0]
+        color_name, color = rng.choice(list(color_names.items()))
+        nominal_weight = rng.choice(nominal_weights)
+        manufactured_date = rng.randrange(1_700_000_000, 1_760_000_000)
+
+        values = {
+            "material_class": material_class,
+            "material_type": material_type,
+            "brand_name": brand_name,
+            "material_name": f"{material_type} {color_name}",
+            "gtin": rng.choice(brand_gtins),
+            "primary_color": bytes(max(0, min(255, c + rng.randrange(-16, 17))) for c in color) + (bytes([rng.randrange(0x40, 0x100)]) if rng.random() < 0.1 else b""),
+            "tags": rng.sample(self.tags, rng.choices([0, 1, 2, 3], [50, 30, 15, 5])[0]),
+            "density": round(density + rng.uniform(-0.02, 0.02), 2),
+            "nominal_netto_full_weight": nominal_weight,
+            "actual_netto_full_weight": nominal_weight + rng.randrange(0, 25),
+            "empty_container_weight": rng.randrange(150, 300),
+            "manufactured_date": manufactured_date,
+            "expiration_date": manufactured_date + rng.randrange(2, 4) * 365 * 24 * 3600,
+            "min_print_temperature": print_temp[0],
+            "max_print_temperature": print_temp[1],
+            "preheat_temperature": print_temp[0] - 40,
+            "min_bed_temperature": bed_temp[0],
+            "max_bed_temperature": bed_temp[1],
+            "filament_diameter": 1.75 if rng.random() < 0.95 else 2.85,
+            "min_nozzle_diameter": rng.choice([0.2, 0.4, 0.6]),
+            "brand_specific_instance_id": "%010x" % rng.getrandbits(40),
+        }
+
+        result = dict()
+        for field_name, schema_field in self.main_fields.fields_by_name.items():
+            if not self._present(rng, field_name, material_class):
+                continue
+
+            result[field_name] = values[field_name] if field_name in values else self._generic_value(rng, schema_field)
+
+        return result
+
+    def aux_data(self, rng: random.Random, main_data: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        if rng.random() >= self.args.aux_data_rate:
+            return {}
+
+        full_weight = main_data.get("actual_netto_full_weight", main_data.get("nominal_netto_full_weight", 1000))
+        return {"consumed_weight": round(rng.uniform(0, full_weight), 1)}
+
+    def generate(self, rng: random.Random) -> bytes:
+        template = self.template(rng.choice(self.args.sizes), rng.choice(self.args.aux_sizes), rng.random() < self.args.uri_rate)
+        data = bytearray(template.data)
+
+        main_data = self.main_data(rng)
+        encoded = self.main_fields.encode(main_data, self.encode_config)
+
+        # Drop random non-required fields until the data fits the region
+        # Estimate the number of fields to drop from their encoded sizes, so that we don't have to re-encode the whole map after every drop
+        while len(encoded) > template.main_size:
+            optional = [name for name in main_data if self.main_fields.fields_by_name[name].required is not True]
+            assert optional, "Required fields do not fit into the main region"
+            rng.shuffle(optional)
+
+            excess = len(encoded) - template.main_size
+            for name in optional:
+                excess -= len(self.main_fields.encode({name: main_data.pop(name)}, self.encode_config)) - 2
+                if excess <= 0:
+                    break
+
+            encoded = self.main_fields.encode(main_data, self.encode_config)
+
+        data[template.main_offset : template.main_offset + len(encoded)] = encoded
+
+        if template.aux_offset is not None:
+            aux_encoded = self.aux_fields.encode(self.aux_data(rng, main_data), self.encode_config)
+            if len(aux_encoded) <= template.aux_size:
+                data[template.aux_offset : template.aux_offset + len(aux_encoded)] = aux_encoded
+
+        if template.uri_offset is not None:
+            data[template.uri_offset : template.uri_offset + uri_id_length] = b"%010x" % rng.getrandbits(4 * uri_id_length)
+
+        return bytes(data)
+
+    def generate_chunk(self, chunk: int) -> list[bytes]:
+        rng = random.Random(self.args.seed * 1_000_003 + chunk)
+        count = min(chunk_size, self.args.count - chunk * chunk_size)
+        return [self.generate(rng) for _ in range(count)]
+
+
+_worker_generator: Generator = None
+
+
+def _worker_init(args: Args):
+    global _worker_generator
+    _worker_generator = Generator(args)
+
+
+def _worker_generate_chunk(chunk: int) -> list[bytes]:
+    return _worker_generator.generate_chunk(chunk)
+
+
+def generate_corpus(args: Args) -> typing.Iterator[bytes]:
+    """Yields args.count generated tag images. The result only depends on the args, not on the number of jobs."""
+    chunks = range((args.count + chunk_size - 1) // chunk_size)
+
+    if args.jobs <= 1:
+        generator = Generator(args)
+        for chunk in chunks:
+            yield from generator.generate_chunk(chunk)
+        return
+
+    with multiprocessing.Pool(args.jobs, initializer=_worker_init, initargs=(args,)) as pool:
+        for images in pool.imap(_worker_generate_chunk, chunks):
+            yield from images
+
+
+def write_corpus(path: str, images: typing.Iterable[bytes], directory: bool = False) -> int:
+    """Writes the images into a stream file (or a directory), returns the number of images written"""
+    count = 0
+
+    if directory:
+        os.makedirs(path, exist_ok=True)
+        for count, image in enumerate(images, 1):
+            with open(os.path.join(path, f"{count - 1:08d}.bin"), "wb") as f:
+                f.write(image)
+
+        return count
+
+    with open(path, "wb") as f:
+        for count, image in enumerate(images, 1):
+            assert len(image) <= 0xFFFF, "Tag image too big for the corpus stream format"
+            f.write(len(image).to_bytes(2, "big"))
+            f.write(image)
+
+    return count
+
+
+def read_corpus(path: str) -> typing.Iterator[memoryview]:
+    """Yields tag images from a corpus stream file or a directory.
+
+    Images from a stream file are read-only views into the file contents, copy them (bytearray) to update them.
+    """
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            if fn.endswith(".bin"):
+                with open(os.path.join(path, fn), "rb") as f:
+                    yield memoryview(f.read())
+
+        return
+
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+
+    pos = 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos : pos + 2], "big")
+        pos += 2
+        assert pos + size <= len(data), "Truncated corpus stream"
+        yield data[pos : pos + size]
+        pos += size
+
+
+if __name__ == "__main__":
+    parser = simple_parsing.ArgumentParser(
+        prog="corpus",
+        description="Generates a corpus of synthetic tags with realistic data for load testing.",
+    )
+    parser.add_arguments(Args, dest="args")
+    args = parser.parse_args().args
+
+    count = write_corpus(args.output, generate_corpus(args), directory=args.directory)
+    print(f"Generated {count} tags into '{args.output}'", file=sys.stderr)
@@ -0,0 +1,101 @@
+# Cache of decoded region data, keyed by the region contents
+#
+# Printers poll the same tag over and over and archives contain many byte-identical regions (same product), so the
+# same bytes get decoded again and again. DecodeCache sits in front of Region.read (see its cache argument): the key is
+# a 128-bit BLAKE2b digest of the region bytes together with the schema (Fields object) and the decode config, so
+# identical regions are decoded once. The cached results are shared by all the readers, so they are frozen: dicts are
+# returned as read-only mappings (types.MappingProxyType) and lists as tuples.
+#
+# The cache is bounded both by the number of entries and by their size, measured as the encoded size of the regions
+# (a cheap proxy of the decoded size). The least recently used entries are evicted first. Thread-safe.
+
+import collections
+import hashlib
+import threading
+import types
+import typing
+
+from fields import Fields, DecodeConfig
+
+
+def freeze(value):
+    """Returns a read-only copy of the decoded data"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+
+    return value
+
+
+class DecodeCache:
+    __slots__ = ("max_entries", "max_bytes", "size", "hits", "misses", "evictions", "_entries", "_lock")
+
+    def __init__(self, max_entries: int = 4096, max_bytes: int = 4 * 1024 * 1024):
+        assert max_entries > 0 and max_bytes > 0
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0  # Sum of the encoded sizes of the cached regions
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (data, unknown fields, size), in the order of use
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, memory: memoryview, fields: Fields, config: DecodeConfig, decode: typing.Callable[[dict], typing.Any]) -> tuple[typing.Mapping, typing.Mapping]:
+        """Returns the frozen (data, unknown fields) of the region bytes, decoding them by decode(out_unknown_fields) on a miss"""
+        # The Fields object itself is a part of the key (not its id), so a reloaded schema never hits stale entries
+        key = (hashlib.blake2b(memory, digest_size=16).digest(), fields, config)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+
+            self.misses += 1
+
+        # Decode outside of the lock, concurrent misses of the same key just decode it twice
+        unknown_fields = dict()
+        data = freeze(decode(unknown_fields))
+        unknown_fields = freeze(unknown_fields)
+        size = len(memory)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (data, unknown_fields, size)
+                self.size += size
+
+            while len(self._entries) > self.max_entries or (self.size > self.max_bytes and len(self._entries) > 1):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+        return data, unknown_fields
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,4 +1,3 @@
-import yaml
 import os
 import numpy
 import uuid
@@ -7,9 +6,18 @@ import typing
 import cbor2_local as cbor2
 import io
 import dataclasses
+import threading
+import types
+import profiling
+from common import cached_load
+from formats import load_yaml
 
+# Thread safety: the schema objects (Fields, Field, EnumTable) are immutable once loaded and are shared between all
+# the records and threads (see Fields.from_file). Their lazily computed caches are filled idempotently, so a race only
+# costs a duplicate computation. The configs are frozen, so they can be shared as well.
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(frozen=True)
 class EncodeConfig:
     # Encode CBOR canonically (order map entries)
     canonical: bool = True
@@ -18,7 +26,125 @@ class EncodeConfig:
     indefinite_containers: bool = True
 
 
+@dataclasses.dataclass(frozen=True)
+class DecodeConfig:
+    # Decode into an instance of the compact Fields.data_class instead of a dict
+    compact: bool = False
+
+    # Decode enum_array fields (tags) into integer bitmasks of the item keys instead of lists of names
+    enum_array_masks: bool = False
+
+    # Add the items implied by the decoded enum_array items (tags `implies` lists), see EnumArrayField.expand_tags
+    expand_implied: bool = False
+
+    # Decode colors (bytes fields in the RGB(A) format) into (r, g, b, a) tuples instead of {"hex": ...}
+    rgba_colors: bool = False
+
+    def decoder_key(self) -> tuple:
+        """Options affecting the value conversions of the fields, see Field.decoder"""
+        return (self.compact, self.enum_array_masks, self.expand_implied, self.rgba_colors)
+
+
+class CompactData:
+    """Base of the classes generated by Fields.data_class
+
+    Stores the values of the fields present in the data in a tuple, in the key order, together with a bitmask of
+    the present fields, instead of a dict. Values of some fields are stored as read from the CBOR and converted on
+    access (see Field.compact_loader), the {"hex": ...} dicts of the bytes fields would be the largest part of the
+    data. Supports the read-only dict interface, to_dict() converts the data to a regular dict.
+    """
+
+    __slots__ = ("_present", "_values", "_loaders")
+
+    # Names of the fields in the key order and their indices (the bits of _present)
+    field_names: tuple[str, ...] = ()
+    field_indices: typing.Mapping[str, int] = types.MappingProxyType({})
+
+    def __init__(self, present: int = 0, values: tuple = (), loaders: tuple | None = None):
+        self._present = present
+        self._values = values
+
+        # Conversions of the stored values by field index (None = the value is stored decoded), None if there are none
+        self._loaders = loaders
+
+    @classmethod
+    def from_dict(cls, data: dict[str, typing.Any], loaders: tuple | None = None) -> "CompactData":
+        """Packs the decoded fields (values as stored, see Field.compact_loader)"""
+        field_indices = cls.field_indices
+        items = sorted((field_indices[name], value) for name, value in data.items())
+
+        present = 0
+        for index, _ in items:
+            present |= 1 << index
+
+        return cls(present, tuple(value for _, value in items), loaders)
+
+    def _load(self, index: int, value):
+        loader = self._loaders[index] if self._loaders is not None else None
+        return value if loader is None else loader(value)
+
+    def __getitem__(self, name: str):
+        index = self.field_indices.get(name)
+        if index is None or not (self._present >> index) & 1:
+            raise KeyError(name)
+
+        # The values of the lower present fields precede the value
+        return self._load(index, self._values[(self._present & ((1 << index) - 1)).bit_count()])
+
+    def __contains__(self, name: str):
+        index = self.field_indices.get(name)
+        return index is not None and bool((self._present >> index) & 1)
+
+    def __iter__(self):
+        return (name for index, name in enumerate(self.field_names) if (self._present >> index) & 1)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactData, dict)):
+            return self.to_dict() == dict(other.items())
+
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def get(self, name: str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        field_names = self.field_names
+        present = self._present
+        result = []
+
+        for value in self._values:
+            index = (present & -present).bit_length() - 1
+            present &= present - 1
+            result.append((field_names[index], self._load(index, value)))
+
+        return result
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return dict(self.items())
+
+    def stored_values(self) -> tuple:
+        """Values as held in memory, before the conversions on access"""
+        return self._values
+
+
 class Field:
+    __slots__ = ("type_name", "key", "name", "required")
+
     key: int
     name: str
     required: bool
@@ -29,8 +155,18 @@ class Field:
         self.name = str(config["name"])
         self.required = config.get("required", False)
 
+    def decoder(self, config: DecodeConfig) -> typing.Callable:
+        """Returns the function converting the CBOR value into the decoded value for the config"""
+        return self.decode
+
+    def compact_loader(self, config: DecodeConfig) -> typing.Callable | None:
+        """Returns the function converting the value stored in the compact data on access, None if the decoded value is stored"""
+        return None
+
 
 class BoolField(Field):
+    __slots__ = ()
+
     def decode(self, data):
         return bool(data)
 
@@ -39,6 +175,8 @@ class BoolField(Field):
 
 
 class IntField(Field):
+    __slots__ = ()
+
     def decode(self, data):
         return int(data)
 
@@ -47,6 +185,8 @@ class IntField(Field):
 
 
 class NumberField(Field):
+    __slots__ = ()
+
     def decode(self, data):
         num = float(data)
         return int(num) if num.is_integer() else round(num, 3)
@@ -70,6 +210,8 @@ class NumberField(Field):
 
 
 class StringField(Field):
+    __slots__ = ("max_len",)
+
     max_len: int
 
     def __init__(self, config, config_dir):
@@ -85,89 +227,315 @@ class StringField(Field):
         return result
 
 
-class EnumField(Field):
-    items_by_key: dict[str, int]
-    items_by_name: dict[int, str]
+class EnumTable:
+    """Items of an enum items file
 
-    def __init__(self, config, config_dir):
-        super().__init__(config, config_dir)
+    Tables are shared by all fields referencing the same items file (see EnumTable.load), and are not modified
+    after construction. Keys are small dense integers, so names are looked up by indexing a tuple.
+    """
+
+    __slots__ = ("file", "names_by_key", "items_by_key", "items_by_name", "rows_by_key", "implied_masks")
+
+    file: str
+    names_by_key: tuple[str | None, ...]  # Indexed by key, None for unused keys
+    items_by_key: dict[int, str]
+    items_by_name: dict[str, int]
+    rows_by_key: dict[int, dict]  # Raw items from the items file
 
+    # Indexed by key, bitmask of the item and all the items it transitively implies (the `implies` lists)
+    implied_masks: tuple[int, ...]
+
+    def __init__(self, file: str, items: list[dict], index_field: str = "key", name_field: str = "name"):
+        self.file = file
         self.items_by_key = dict()
         self.items_by_name = dict()
+        self.rows_by_key = dict()
 
-        items = yaml.safe_load(open(os.path.join(config_dir, config["items_file"]), "r"))
         for item in items:
-            key = int(item[config.get("index_field", "key")])
-            name = str(item[config.get("name_field", "name")])
+            if item.get("deprecated", False):
+                continue
+
+            key = int(item[index_field])
+            name = sys.intern(str(item[name_field]))
 
+            assert key >= 0, f"Negative key '{key}' in '{file}'"
             assert key not in self.items_by_key, f"Key '{key}' already exists"
             assert name not in self.items_by_name, f"Item '{name}' already exists"
 
             self.items_by_key[key] = name
             self.items_by_name[name] = key
+            self.rows_by_key[key] = item
 
-    def decode(self, data):
-        return self.items_by_key[data]
+        names_by_key = [None] * (max(self.items_by_key, default=-1) + 1)
+        for key, name in self.items_by_key.items():
+            names_by_key[key] = name
 
-    def encode(self, data):
-        return self.items_by_name[data]
+        self.names_by_key = tuple(names_by_key)
+
+        self._compute_implied_masks()
+
+    def _compute_implied_masks(self):
+        implies_by_key = dict()
+        for key, item in self.rows_by_key.items():
+            implies = item.get("implies") or []
+            for name in implies:
+                assert name in self.items_by_name, f"Item '{self.items_by_key[key]}' implies unknown item '{name}'"
+
+            implies_by_key[key] = [self.items_by_name[name] for name in implies]
+
+        implied_masks = [0] * len(self.names_by_key)
+
+        # Depth-first search from every item, the implication graph is tiny
+        for key in self.items_by_key:
+            mask = 0
+            stack = [key]
+            while stack:
+                current = stack.pop()
+                if mask & (1 << current):
+                    continue
+
+                mask |= 1 << current
+                stack.extend(implies_by_key[current])
+
+            implied_masks[key] = mask
+
+        self.implied_masks = tuple(implied_masks)
+
+    def name(self, key: int) -> str:
+        """Returns name of the item with the given key"""
+        names_by_key = self.names_by_key
+        if type(key) is int and 0 <= key < len(names_by_key):
+            name = names_by_key[key]
+            if name is not None:
+                return name
+
+        raise ValueError(f"Unknown key {key!r} of enum '{os.path.basename(self.file)}'")
+
+    def key(self, name: str) -> int:
+        """Returns key of the item with the given name"""
+        key = self.items_by_name.get(name) if type(name) is str else None
+        if key is None:
+            raise ValueError(f"Unknown item '{name}' of enum '{os.path.basename(self.file)}'")
+
+        return key
+
+    @property
+    def bit_count(self) -> int:
+        """Number of bits needed for a bitmask of the items (highest key + 1)"""
+        return len(self.names_by_key)
+
+    # Bitmasks: the item with key K is represented by bit (1 << K). Python ints are unbounded,
+    # so the masks are not limited to 64 items.
+
+    def mask_from_keys(self, keys: typing.Iterable[int]) -> int:
+        result = 0
+        for key in keys:
+            self.name(key)  # Validates the key
+            result |= 1 << key
+
+        return result
+
+    def mask_from_names(self, names: typing.Iterable[str]) -> int:
+        result = 0
+        for name in names:
+            result |= 1 << self.key(name)
+
+        return result
+
+    def keys_from_mask(self, mask: int) -> list[int]:
+        assert mask >= 0, "Negative mask"
+        result = []
+        key = 0
+        while mask:
+            # Skip runs of zero bits at once
+            skip = (mask & -mask).bit_length() - 1
+            key += skip
+            mask >>= skip
+
+            result.append(key)
+            key += 1
+            mask >>= 1
+
+        return result
+
+    def names_from_mask(self, mask: int) -> list[str]:
+        return [self.name(key) for key in self.keys_from_mask(mask)]
 
+    def has(self, mask: int, name: str) -> bool:
+        return (mask >> self.key(name)) & 1 == 1
 
-class EnumArrayField(Field):
-    items_by_key: dict[str, int]
-    items_by_name: dict[int, str]
+    def any_of(self, mask: int, names: typing.Iterable[str]) -> bool:
+        return mask & self.mask_from_names(names) != 0
+
+    def all_of(self, mask: int, names: typing.Iterable[str]) -> bool:
+        query = self.mask_from_names(names)
+        return mask & query == query
+
+    def expand_mask(self, mask: int) -> int:
+        """Adds all the items implied by the items of the mask"""
+        result = mask
+        implied_masks = self.implied_masks
+        for key in self.keys_from_mask(mask):
+            result |= implied_masks[key]
+
+        return result
+
+    def expand_names(self, names: typing.Iterable[str]) -> list[str]:
+        """Returns the names with all the implied items added, in key order"""
+        return self.names_from_mask(self.expand_mask(self.mask_from_names(names)))
+
+    def load(file: str, index_field: str = "key", name_field: str = "name"):
+        """Returns the table for the items file, the file is read only on the first call"""
+        return cached_load(file, EnumTable._load_file, index_field, name_field)
+
+    def _load_file(file: str, index_field: str, name_field: str):
+        with open(file, "r") as f:
+            items = load_yaml(f)
+
+        return EnumTable(file, items, index_field, name_field)
+
+
+class EnumField(Field):
+    __slots__ = ("table", "names_by_key", "items_by_key", "items_by_name")
+
+    # The lookup containers are shared with the table
+    table: EnumTable
+    names_by_key: tuple[str | None, ...]
+    items_by_key: dict[int, str]
+    items_by_name: dict[str, int]
 
     def __init__(self, config, config_dir):
         super().__init__(config, config_dir)
+        self.table = EnumTable.load(os.path.join(config_dir, config["items_file"]), config.get("index_field", "key"), config.get("name_field", "name"))
+        self.names_by_key = self.table.names_by_key
+        self.items_by_key = self.table.items_by_key
+        self.items_by_name = self.table.items_by_name
 
-        self.items_by_key = dict()
-        self.items_by_name = dict()
+    def decode(self, data):
+        try:
+            name = self.names_by_key[data]
+        except (IndexError, TypeError):
+            name = None
 
-        items = yaml.safe_load(open(os.path.join(config_dir, config["items_file"]), "r"))
-        for item in items:
-            if item.get("deprecated", False):
-                continue
+        if name is not None and data >= 0:
+            return name
 
-            key = int(item["key"])
-            name = str(item["name"])
+        # Raises a descriptive error
+        return self.table.name(data)
 
-            assert key not in self.items_by_key, f"Key '{key}' already exists"
-            assert name not in self.items_by_name, f"Item '{name}' already exists"
+    def encode(self, data):
+        try:
+            return self.items_by_name[data]
+        except (KeyError, TypeError):
+            # Raises a descriptive error
+            return self.table.key(data)
 
-            self.items_by_key[key] = name
-            self.items_by_name[name] = key
+
+class EnumArrayField(EnumField):
+    __slots__ = ()
 
     def decode(self, data):
         assert type(data) is list
 
+        names_by_key = self.names_by_key
         result = []
         for item in data:
-            result.append(self.items_by_key[item])
+            try:
+                name = names_by_key[item]
+            except (IndexError, TypeError):
+                name = None
+
+            if name is None or item < 0:
+                # Raises a descriptive error
+                self.table.name(item)
+
+            result.append(name)
 
         return result
 
-    def encode(self, data):
+    def decode_mask(self, data) -> int:
+        """Decodes the keys into a bitmask (see EnumTable.mask_from_keys)"""
         assert type(data) is list
+        return self.table.mask_from_keys(data)
+
+    def decoder(self, config: DecodeConfig) -> typing.Callable:
+        table = self.table
+        if config.enum_array_masks and config.expand_implied:
+            return lambda data: table.expand_mask(self.decode_mask(data))
+        elif config.expand_implied:
+            return lambda data: table.names_from_mask(table.expand_mask(self.decode_mask(data)))
+        elif config.enum_array_masks:
+            return self.decode_mask
+        else:
+            return self.decode
+
+    def expand_tags(self, value: int | list[str]) -> int | list[str]:
+        """Returns the decoded value (bitmask or list of names) with all the implied items added"""
+        if type(value) is int:
+            return self.table.expand_mask(value)
 
+        return self.table.expand_names(value)
+
+    def encode(self, data):
+        # Bitmask produced by decode_mask (bool is not a mask)
+        if type(data) is int:
+            keys = self.table.keys_from_mask(data)
+            for key in keys:
+                self.table.name(key)  # Validates the key
+
+            return keys
+
+        assert type(data) is list, f"Cannot encode {type(data).__name__} to an enum array"
+
+        items_by_name = self.items_by_name
         result = []
         for item in data:
-            result.append(self.items_by_name[item])
+            try:
+                result.append(items_by_name[item])
+            except (KeyError, TypeError):
+                # Raises a descriptive error
+                self.table.key(item)
 
         return result
 
 
 class BytesField(Field):
+    __slots__ = ("max_len", "is_color")
+
     max_len: int | None
 
+    # The field is a color in the [R, G, B] or [R, G, B, A] format
+    is_color: bool
+
     def __init__(self, config, config_dir):
         super().__init__(config, config_dir)
         assert "max_length" in config, f"max_length not specified for '{config['name']}'"
         self.max_len = config["max_length"]
+        self.is_color = str(config.get("unit", "")).startswith("[R, G, B]")
+
+    def decoder(self, config: DecodeConfig) -> typing.Callable:
+        if config.rgba_colors and self.is_color:
+            return self.decode_rgba
+
+        # Compact data keeps the bytes, see compact_loader
+        return self.decode_raw if config.compact else self.decode
+
+    def compact_loader(self, config: DecodeConfig) -> typing.Callable | None:
+        return None if config.rgba_colors and self.is_color else self.decode
 
     def decode(self, data):
         assert isinstance(data, bytes)
         return {"hex": data.hex()}
 
+    def decode_raw(self, data) -> bytes:
+        assert isinstance(data, bytes)
+        return data
+
+    def decode_rgba(self, data) -> tuple[int, int, int, int]:
+        """Decodes a color into (r, g, b, a), colors without the alpha channel are opaque"""
+        assert isinstance(data, bytes) and len(data) in (3, 4), f"Invalid color {data!r}"
+        return (data[0], data[1], data[2], data[3] if len(data) == 4 else 255)
+
     def encode(self, data):
         if isinstance(data, bytes):
             result = data
@@ -178,7 +546,7 @@ class BytesField(Field):
         elif isinstance(data, int):
             return data.to_bytes(64, "little").rstrip(b"\x00")
 
-        elif isinstance(data, list):
+        elif isinstance(data, (list, tuple)):
             result = bytearray(data)
 
         elif isinstance(data, dict):
@@ -192,13 +560,30 @@ class BytesField(Field):
 
 
 class UUIDField(Field):
+    __slots__ = ()
+
+    def decoder(self, config: DecodeConfig) -> typing.Callable:
+        # Compact data keeps the 16 bytes, see compact_loader
+        return self.decode_raw if config.compact else self.decode
+
+    def compact_loader(self, config: DecodeConfig) -> typing.Callable | None:
+        return self.decode
+
     def decode(self, data):
         return str(uuid.UUID(bytes=data))
 
+    def decode_raw(self, data) -> bytes:
+        assert isinstance(data, bytes) and len(data) == 16, f"Invalid UUID {data!r}"
+        return data
+
     def encode(self, data):
         return uuid.UUID(data).bytes
 
 
+# Compact data classes by their field names, see Fields.data_class
+_data_classes: dict[tuple[str, ...], type[CompactData]] = dict()
+_data_classes_lock = threading.Lock()
+
 field_types = {
     "bool": BoolField,
     "int": IntField,
@@ -212,16 +597,38 @@ field_types = {
 }
 
 
+def _new_encoder(fp, config: EncodeConfig) -> cbor2.CBOREncoder:
+    """Returns an encoder for a single encode call
+
+    Encoders keep mutable state (the output, the type dispatch table extended on lookups), so they are never shared.
+    """
+    encoder = cbor2.CBOREncoder(fp, canonical=config.canonical, indefinite_containers=config.indefinite_containers)
+
+    # Encode float optimally, even in non-canonical mode. The dispatch table is a copy owned by this encoder.
+    encoder._encoders[float] = cbor2.CBOREncoder.encode_minimal_float
+    return encoder
+
+
 class Fields:
-    fields_by_key: dict[int, Field]
-    fields_by_name: dict[str, Field]
+    """Schema of a region
+
+    Read-only once initialized (the field mappings are read-only views), instances returned by from_file are shared.
+    """
+
+    fields_by_key: typing.Mapping[int, Field]
+    fields_by_name: typing.Mapping[str, Field]
 
     def __init__(self):
-        self.fields_by_key = dict()
-        self.fields_by_name = dict()
+        self.fields_by_key = types.MappingProxyType(dict())
+        self.fields_by_name = types.MappingProxyType(dict())
         self.required_fields = list()
+        self._data_class = None
+        self._decoders = dict()
 
     def init_from_yaml(self, yaml, config_dir):
+        fields_by_key = dict(self.fields_by_key)
+        fields_by_name = dict(self.fields_by_name)
+
         for row in yaml:
             if row.get("deprecated", False):
                 continue
@@ -233,37 +640,98 @@ class Fields:
             assert field_type, f"Unknown field type '{field_type_str}'"
             field = field_type(row, config_dir)
 
-            assert field.key not in self.fields_by_key, f"Field {field.name} duplicit key {field.key}"
-            assert field.name not in self.fields_by_name
+            assert field.key not in fields_by_key, f"Field {field.name} duplicit key {field.key}"
+            assert field.name not in fields_by_name
+
+            fields_by_key[field.key] = field
+            fields_by_name[field.name] = field
 
-            self.fields_by_key[field.key] = field
-            self.fields_by_name[field.name] = field
+        self.fields_by_key = types.MappingProxyType(fields_by_key)
+        self.fields_by_name = types.MappingProxyType(fields_by_name)
+        self._data_class = None
+        self._decoders = dict()
 
     def from_file(file: str):
-        r = Fields()
-        r.init_from_yaml(yaml.safe_load(open(file, "r")), os.path.dirname(file))
+        """Returns the schema of the fields file, shared by all callers while the file is not modified"""
+        with profiling.stage("fields.from_file"):
+            return cached_load(file, Fields._load_file)
 
+    def _load_file(file: str):
+        with open(file, "r") as f:
+            data = load_yaml(f)
+
+        r = Fields()
+        r.init_from_yaml(data, os.path.dirname(file))
         return r
 
-    # Decodes the fields and values from the CBOR binary data
-    # If out_unknown_fields is provided, unknown fields are written into it instead of asserting
-    def decode(self, binary_data: typing.IO[bytes], out_unknown_fields: dict[any, any] = None):
-        data = cbor2.load(binary_data)
-        result = dict()
-        for key, value in data.items():
-            field = self.fields_by_key.get(key)
+    @property
+    def data_class(self) -> type[CompactData]:
+        """CompactData class of the fields, generated on first use"""
+        if self._data_class is None:
+            field_names = tuple(field.name for _, field in sorted(self.fields_by_key.items()))
 
-            if field is None and out_unknown_fields is not None:
-                out_unknown_fields[key] = value
-                continue
+            # Share the classes between Fields instances of the same schema
+            with _data_classes_lock:
+                data_class = _data_classes.get(field_names)
+                if data_class is None:
+                    field_indices = types.MappingProxyType({name: index for index, name in enumerate(field_names)})
+                    data_class = _data_classes[field_names] = type("FieldsData", (CompactData,), {"__slots__": (), "field_names": field_names, "field_indices": field_indices})
 
-            assert field, f"Unknown CBOR key '{key}'"
+            self._data_class = data_class
 
-            try:
-                result[field.name] = field.decode(value)
-            except Exception as e:
-                e.add_note(f"Field {key} {field.name}")
-                raise
+        return self._data_class
+
+    def decoders(self, config: DecodeConfig) -> dict[int, tuple[Field, typing.Callable]]:
+        """(field, value conversion function) by field key for the config, see Field.decoder"""
+        decoder_key = config.decoder_key()
+        result = self._decoders.get(decoder_key)
+        if result is None:
+            result = self._decoders[decoder_key] = {key: (field, field.decoder(config)) for key, field in self.fields_by_key.items()}
+
+        return result
+
+    def compact_loaders(self, config: DecodeConfig) -> tuple | None:
+        """Field.compact_loader by field index of the data class, None if no field has one"""
+        decoder_key = ("loaders",) + config.decoder_key()
+        result = self._decoders.get(decoder_key, ())
+        if result == ():
+            loaders = tuple(field.compact_loader(config) for _, field in sorted(self.fields_by_key.items()))
+            result = self._decoders[decoder_key] = loaders if any(loader is not None for loader in loaders) else None
+
+        return result
+
+    # Decodes the fields and values from the CBOR binary data
+    # If out_unknown_fields is provided, unknown fields are written into it instead of asserting
+    def decode(self, binary_data: typing.IO[bytes], out_unknown_fields: dict[any, any] = None, config: DecodeConfig = DecodeConfig()):
+        with profiling.stage("fields.cbor_decode"):
+            data = cbor2.load(binary_data)
+
+        profiler = profiling.active
+        decoders = self.decoders(config)
+        result = dict()
+        with profiling.stage("fields.convert"):
+            for key, value in data.items():
+                field_decoder = decoders.get(key)
+
+                if field_decoder is None and out_unknown_fields is not None:
+                    out_unknown_fields[key] = value
+                    continue
+
+                assert field_decoder, f"Unknown CBOR key '{key}'"
+                field, decode = field_decoder
+
+                try:
+                    if profiler is None:
+                        result[field.name] = decode(value)
+                    else:
+                        with profiler.stage(f"field.decode.{field.type_name}"):
+                            result[field.name] = decode(value)
+                except Exception as e:
+                    e.add_note(f"Field {key} {field.name}")
+                    raise
+
+        if config.compact:
+            return self.data_class.from_dict(result, self.compact_loaders(config))
 
         return result
 
@@ -294,16 +762,21 @@ class Fields:
                 raise
 
         data_io = io.BytesIO()
-        encoder = cbor2.CBOREncoder(
-            data_io,
-            canonical=config.canonical,
-            indefinite_containers=config.indefinite_containers,
-        )
-
-        # Encode float optimally, even in non-canonical mode
-        encoder._encoders[float] = cbor2.CBOREncoder.encode_minimal_float
+        encoder = _new_encoder(data_io, config)
+
+        if all(type(key) is int and key >= 0 for key in result):
+            # Canonical order of non-negative integer keys is the numeric order
+            # Encode the map directly instead of letting the canonical encoder serialize every key for sorting
+            encoder.encode_length(5, None if config.indefinite_containers else len(result))
+            for key in sorted(result) if config.canonical else result:
+                encoder.encode(key)
+                encoder.encode(result[key])
+
+            if config.indefinite_containers:
+                encoder.encode_break()
+        else:
+            encoder.encode(result)
 
-        encoder.encode(result)
         return data_io.getvalue()
 
     def validate(self, decoded_data):
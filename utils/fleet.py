@@ -0,0 +1,141 @@
+# Vectorized remaining material computation and aggregation over many spools
+#
+# The decoded tags are turned into columns (one NumPy array per field, NaN for missing values), so that the
+# remaining weight and length of the whole fleet are computed by a few array operations instead of per-spool code.
+
+import argparse
+import typing
+
+import numpy
+import yaml
+
+from fields import DecodeConfig
+from batch import decode_batch
+from corpus import read_corpus
+from common import default_config_file
+
+numeric_fields = (
+    "actual_netto_full_weight",
+    "nominal_netto_full_weight",
+    "consumed_weight",
+    "actual_full_length",
+    "nominal_full_length",
+    "density",
+    "filament_diameter",
+)
+
+group_fields = ("material_type", "material_class", "brand_name", "primary_color")
+
+# Assumed when filament_diameter is not present (see main_fields.yaml)
+default_filament_diameter = 1.75
+
+
+def _group_value(field_name: str, value):
+    if field_name == "primary_color" and not isinstance(value, str):
+        # Group by the color hex, regardless of the decoded representation
+        if isinstance(value, dict):
+            return value["hex"]
+
+        return bytes(value).hex()
+
+    return value
+
+
+def columns(items: typing.Iterable[typing.Mapping[str, typing.Any]]) -> dict[str, numpy.ndarray]:
+    """Converts {field name: value} items (main and aux region data merged, or inventory.flatten items) into float columns of the numeric fields (NaN = missing) and object columns of the group fields (None = missing)"""
+    items = list(items)
+    result = dict()
+
+    for field_name in numeric_fields:
+        result[field_name] = numpy.fromiter((item.get(field_name, numpy.nan) for item in items), dtype=numpy.float64, count=len(items))
+
+    for field_name in group_fields:
+        column = numpy.empty(len(items), dtype=object)
+        column[:] = [_group_value(field_name, item[field_name]) if field_name in item else None for item in items]
+        result[field_name] = column
+
+    return result
+
+
+def batch_columns(decoded: typing.Iterable[typing.Mapping[str, typing.Mapping[str, typing.Any]]]) -> dict[str, numpy.ndarray]:
+    """columns() of batch.decode_batch results"""
+    # Only the region data is needed, not the derived values of inventory.flatten (UUIDs are costly to compute)
+    return columns({**(d.get("main") or {}), **(d.get("aux") or {})} for d in decoded)
+
+
+def remaining_material(cols: dict[str, numpy.ndarray]) -> dict[str, numpy.ndarray]:
+    """Computes full and remaining weight (g) and length (mm) of all the spools
+
+    - full weight: actual_netto_full_weight, or nominal_netto_full_weight if not present
+    - remaining weight: full weight - consumed_weight (0 if not present)
+    - full length: actual_full_length, or nominal_full_length, or computed from the full weight, density and filament_diameter (1.75 mm if not present)
+    - remaining length: full length scaled by the remaining weight fraction (the full length if nothing was consumed and the full weight is unknown)
+
+    Values that cannot be determined are NaN.
+    """
+    full_weight = numpy.where(numpy.isnan(cols["actual_netto_full_weight"]), cols["nominal_netto_full_weight"], cols["actual_netto_full_weight"])
+    consumed_weight = numpy.nan_to_num(cols["consumed_weight"], nan=0.0)
+    remaining_weight = full_weight - consumed_weight
+
+    diameter = numpy.where(numpy.isnan(cols["filament_diameter"]), default_filament_diameter, cols["filament_diameter"])
+
+    # density g/cm³ * cross section mm² * 0.001 = g/mm
+    weight_per_mm = cols["density"] * (numpy.pi / 4 * diameter**2) * 0.001
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        computed_length = full_weight / weight_per_mm
+
+        full_length = numpy.where(numpy.isnan(cols["actual_full_length"]), cols["nominal_full_length"], cols["actual_full_length"])
+        full_length = numpy.where(numpy.isnan(full_length), computed_length, full_length)
+
+        remaining_fraction = numpy.where(full_weight > 0, remaining_weight / full_weight, numpy.where(consumed_weight == 0, 1.0, numpy.nan))
+
+    return {
+        "full_weight": full_weight,
+        "remaining_weight": remaining_weight,
+        "full_length": full_length,
+        "remaining_length": full_length * remaining_fraction,
+    }
+
+
+def aggregate(cols: dict[str, numpy.ndarray], values: dict[str, numpy.ndarray], by: typing.Sequence[str]) -> list[dict[str, typing.Any]]:
+    """Sums the values (NaN ignored) per group of the by columns, returns rows sorted by the group"""
+    if len(by) == 0:
+        keys = numpy.zeros(len(next(iter(values.values()))), dtype=numpy.int64)
+        groups = [()]
+    else:
+        # Map the group tuples to consecutive ints, the sums are then computed by bincount
+        group_ids = dict()
+        keys = numpy.fromiter((group_ids.setdefault(group, len(group_ids)) for group in zip(*(cols[name] for name in by))), dtype=numpy.int64, count=len(cols[by[0]]))
+        groups = list(group_ids)
+
+    result = [{name: value for name, value in zip(by, group)} for group in groups]
+
+    counts = numpy.bincount(keys, minlength=len(groups))
+    for row, count in zip(result, counts.tolist()):
+        row["count"] = count
+
+    for name, column in values.items():
+        known = ~numpy.isnan(column)
+        sums = numpy.bincount(keys[known], weights=column[known], minlength=len(groups))
+        known_counts = numpy.bincount(keys[known], minlength=len(groups))
+
+        for row, total, known_count in zip(result, sums.tolist(), known_counts.tolist()):
+            row[name] = round(total, 3)
+            row[f"{name}_known"] = known_count
+
+    return sorted(result, key=lambda row: tuple((row[name] is None, row[name] or "") for name in by))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="fleet", description="Computes remaining material of all tags of a corpus (see corpus.py), aggregated by the specified fields")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-b", "--by", action="append", choices=group_fields, default=[], help="Group by the field, can be repeated")
+
+    args = parser.parse_args()
+
+    cols = batch_columns(decode_batch(read_corpus(args.corpus), args.config_file, regions=("main", "aux"), config=DecodeConfig(compact=True)))
+    material = remaining_material(cols)
+    rows = aggregate(cols, {"remaining_weight": material["remaining_weight"], "remaining_length": material["remaining_length"]}, args.by)
+
+    print(yaml.dump(rows, sort_keys=False), end="")
@@ -0,0 +1,124 @@
+# Serialization of the CLI inputs and outputs
+#
+# YAML is parsed and emitted with the libyaml C implementation when PyYAML is built with it (several times faster than
+# the pure Python one). JSON, NDJSON (one document per line) and CBOR are offered for pipelines. Bytes are written
+# as "0x" + hex strings in all the output formats, so the outputs carry the same data regardless of the format.
+# The frozen data of the decode cache (read-only mappings and tuples) is written as regular maps and lists.
+
+import json
+import os
+import sys
+import types
+import typing
+
+import yaml
+
+import cbor2_local as cbor2
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+output_formats = ("yaml", "json", "ndjson", "cbor")
+input_formats = ("yaml", "json", "cbor")
+
+
+def load_yaml(stream) -> typing.Any:
+    """yaml.safe_load, using the C loader if available"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def yaml_hex_bytes_representer(dumper: yaml.SafeDumper, data: bytes):
+    return dumper.represent_str("0x" + data.hex())
+
+
+class InfoDumper(SafeDumper):
+    pass
+
+
+InfoDumper.add_representer(bytes, yaml_hex_bytes_representer)
+InfoDumper.add_representer(types.MappingProxyType, lambda dumper, data: dumper.represent_dict(data.items()))
+InfoDumper.add_representer(tuple, lambda dumper, data: dumper.represent_list(data))
+
+
+def json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "0x" + bytes(value).hex()
+
+    if isinstance(value, types.MappingProxyType):
+        return dict(value)
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _hex_bytes(value):
+    """Returns the value with bytes replaced by hex strings, for the CBOR output"""
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return {key: _hex_bytes(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_hex_bytes(item) for item in value]
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "0x" + bytes(value).hex()
+
+    return value
+
+
+def dumps(data, format: str = "yaml") -> bytes:
+    """Serializes the data in one of the output_formats"""
+    match format:
+        case "yaml":
+            return yaml.dump(data, Dumper=InfoDumper, sort_keys=False).encode("utf-8")
+
+        case "json":
+            return (json.dumps(data, default=json_default, indent=2) + "\n").encode("utf-8")
+
+        case "ndjson":
+            return (json.dumps(data, default=json_default, separators=(",", ":")) + "\n").encode("utf-8")
+
+        case "cbor":
+            return cbor2.dumps(_hex_bytes(data))
+
+        case _:
+            assert False, f"Unknown output format '{format}'"
+
+
+def dump(data, format: str = "yaml", stream: typing.BinaryIO = None):
+    """Writes the serialized data into the binary stream (stdout by default)"""
+    stream = stream or sys.stdout.buffer
+    stream.write(dumps(data, format))
+    stream.flush()
+
+
+def format_of_file(file: str) -> str:
+    """Guesses the input format by the file extension, YAML by default"""
+    match os.path.splitext(file)[1].lower():
+        case ".json":
+            return "json"
+
+        case ".cbor":
+            return "cbor"
+
+        case _:
+            return "yaml"
+
+
+def load_file(file: str, format: str = None) -> typing.Any:
+    """Loads a document in one of the input_formats, guessed from the extension if format is None"""
+    format = format or format_of_file(file)
+
+    match format:
+        case "yaml":
+            with open(file, "r") as f:
+                return load_yaml(f)
+
+        case "json":
+            with open(file, "r") as f:
+                return json.load(f)
+
+        case "cbor":
+            with open(file, "rb") as f:
+                return cbor2.load(f)
+
+        case _:
+            assert False, f"Unknown input format '{format}'"
@@ -0,0 +1,548 @@
+# In-memory inventory of decoded tags with secondary indexes
+#
+# An item is the decoded main and aux region data of a tag, flattened into a single {field name: value} mapping,
+# plus the derived remaining_weight and UUIDs (see uuids.resolve). Queries are conjunctions of (field, operator, value) conditions. Conditions
+# on indexed fields are evaluated on the indexes, most selective first; only the conditions the indexes cannot
+# answer are checked on the remaining candidates.
+#
+# Ranges defined by pairs of fields (print temperature etc.) are represented by derived (min, max) interval values,
+# None meaning unbounded, so "spools compatible with 240 °C" is the condition ("print_temperature_range", "contains", 240).
+# The derived names have the _range suffix, so that they do not replace the fields of the base name (chamber_temperature).
+
+import argparse
+import bisect
+import operator
+import random
+import sys
+import typing
+
+import yaml
+
+from record import Record
+from fields import DecodeConfig, EnumTable
+from batch import decode_batch, field_enum_table
+from corpus import read_corpus
+import uuids
+from common import default_config_file
+
+Condition = tuple[str, str, typing.Any]
+
+# Fields indexed by value
+default_hash_fields = ("material_class", "material_type", "brand_name", "brand_uuid", "material_uuid", "gtin")
+
+# Fields indexed by sorted value, for range queries
+default_sorted_fields = (
+    "manufactured_date",
+    "expiration_date",
+    "min_print_temperature",
+    "max_print_temperature",
+    "min_bed_temperature",
+    "max_bed_temperature",
+    "min_chamber_temperature",
+    "max_chamber_temperature",
+    "min_nozzle_diameter",
+    "filament_diameter",
+    "remaining_weight",
+)
+
+# Enum array fields indexed by item
+default_mask_fields = ("tags",)
+
+# Derived interval values: name -> (lower bound field, upper bound field), None if the range has no such bound
+default_interval_fields = {
+    "print_temperature_range": ("min_print_temperature", "max_print_temperature"),
+    "bed_temperature_range": ("min_bed_temperature", "max_bed_temperature"),
+    "chamber_temperature_range": ("min_chamber_temperature", "max_chamber_temperature"),
+    "nozzle_diameter_range": ("min_nozzle_diameter", None),
+}
+
+
+def _matches(item: dict, condition: Condition) -> bool:
+    """Evaluates the condition on the item without any index (also defines the semantics of the operators)"""
+    field, op, value = condition
+
+    if field not in item:
+        # Missing values never compare, but they are unequal to anything and lack any tag
+        return op in ("!=", "lacks")
+
+    item_value = item[field]
+    match op:
+        case "in":
+            return item_value in value
+        case "between":
+            return value[0] <= item_value <= value[1]
+        case "has":
+            return value in item_value
+        case "lacks":
+            return value not in item_value
+        case "any_of":
+            return any(v in item_value for v in value)
+        case "all_of":
+            return all(v in item_value for v in value)
+        case "contains":
+            low, high = item_value
+            return (low is None or low <= value) and (high is None or value <= high)
+        case _:
+            return _comparisons[op](item_value, value)
+
+
+_comparisons = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+operators = tuple(_comparisons) + ("in", "between", "has", "lacks", "any_of", "all_of", "contains")
+
+
+class HashIndex:
+    """Item ids by field value, answers ==, != and in"""
+
+    __slots__ = ("ids_by_value",)
+
+    def __init__(self):
+        self.ids_by_value: dict[typing.Any, set[int]] = dict()
+
+    def add(self, item_id: int, value):
+        ids = self.ids_by_value.get(value)
+        if ids is None:
+            ids = self.ids_by_value[value] = set()
+
+        ids.add(item_id)
+
+    def remove(self, item_id: int, value):
+        ids = self.ids_by_value[value]
+        ids.discard(item_id)
+        if not ids:
+            del self.ids_by_value[value]
+
+    def lookup(self, op: str, value, all_ids: typing.Collection[int]) -> typing.Collection[int] | None:
+        match op:
+            case "==":
+                return self.ids_by_value.get(value, ())
+            case "!=":
+                return all_ids - self.ids_by_value.get(value, set())
+            case "in":
+                result = set()
+                for v in value:
+                    result.update(self.ids_by_value.get(v, ()))
+
+                return result
+
+        return None
+
+
+class SortedIndex:
+    """(value, item id) pairs kept sorted, answers comparisons and ranges by bisection"""
+
+    __slots__ = ("entries",)
+
+    def __init__(self):
+        self.entries: list[tuple[typing.Any, int]] = list()
+
+    def add(self, item_id: int, value):
+        bisect.insort(self.entries, (value, item_id))
+
+    def remove(self, item_id: int, value):
+        i = bisect.bisect_left(self.entries, (value, item_id))
+        assert self.entries[i] == (value, item_id)
+        del self.entries[i]
+
+    def range(self, low=None, high=None, low_inclusive: bool = True, high_inclusive: bool = True) -> list[int]:
+        """Ids of the items with value between low and high (None = unbounded)"""
+        entries = self.entries
+
+        # Ids are ints, so (value, -inf/inf) sort before/after all the entries with the value
+        if low is None:
+            start = 0
+        elif low_inclusive:
+            start = bisect.bisect_left(entries, (low, -float("inf")))
+        else:
+            start = bisect.bisect_right(entries, (low, float("inf")))
+
+        if high is None:
+            end = len(entries)
+        elif high_inclusive:
+            end = bisect.bisect_right(entries, (high, float("inf")))
+        else:
+            end = bisect.bisect_left(entries, (high, -float("inf")))
+
+        return [item_id for _, item_id in entries[start:end]]
+
+    def lookup(self, op: str, value, all_ids: typing.Collection[int]) -> typing.Collection[int] | None:
+        match op:
+            case "==":
+                return self.range(value, value)
+            case "<":
+                return self.range(high=value, high_inclusive=False)
+            case "<=":
+                return self.range(high=value)
+            case ">":
+                return self.range(low=value, low_inclusive=False)
+            case ">=":
+                return self.range(low=value)
+            case "between":
+                return self.range(value[0], value[1])
+
+        return None
+
+
+class MaskIndex:
+    """Item ids by enum array item (tag), answers has, lacks, any_of and all_of"""
+
+    __slots__ = ("table", "ids_by_key")
+
+    def __init__(self, table: EnumTable):
+        self.table = table
+        self.ids_by_key: list[set[int]] = [set() for _ in range(table.bit_count)]
+
+    def _mask(self, value) -> int:
+        # Items can hold the names or the mask, depending on DecodeConfig.enum_array_masks
+        return value if type(value) is int else self.table.mask_from_names(value)
+
+    def add(self, item_id: int, value):
+        for key in self.table.keys_from_mask(self._mask(value)):
+            self.ids_by_key[key].add(item_id)
+
+    def remove(self, item_id: int, value):
+        for key in self.table.keys_from_mask(self._mask(value)):
+            self.ids_by_key[key].discard(item_id)
+
+    def lookup(self, op: str, value, all_ids: typing.Collection[int]) -> typing.Collection[int] | None:
+        match op:
+            case "has":
+                return self.ids_by_key[self.table.key(value)]
+            case "lacks":
+                return all_ids - self.ids_by_key[self.table.key(value)]
+            case "any_of":
+                return set().union(*(self.ids_by_key[self.table.key(v)] for v in value))
+            case "all_of":
+                sets = sorted((self.ids_by_key[self.table.key(v)] for v in value), key=len)
+                return sets[0].intersection(*sets[1:]) if sets else all_ids
+
+        return None
+
+
+class _IntervalNode:
+    __slots__ = ("key", "high", "priority", "max_high", "left", "right")
+
+    def __init__(self, key: tuple[float, int], high: float):
+        self.key = key  # (low, item id)
+        self.high = high
+        self.priority = random.random()
+        self.max_high = high  # Maximum high in the subtree
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.max_high = self.high
+        if self.left is not None and self.left.max_high > self.max_high:
+            self.max_high = self.left.max_high
+        if self.right is not None and self.right.max_high > self.max_high:
+            self.max_high = self.right.max_high
+
+
+def _split(node: _IntervalNode | None, key: tuple) -> tuple[_IntervalNode | None, _IntervalNode | None]:
+    """Splits the treap into the nodes with keys < key and >= key"""
+    if node is None:
+        return None, None
+
+    if node.key < key:
+        node.right, right = _split(node.right, key)
+        node.update()
+        return node, right
+    else:
+        left, node.left = _split(node.left, key)
+        node.update()
+        return left, node
+
+
+def _merge(left: _IntervalNode | None, right: _IntervalNode | None) -> _IntervalNode | None:
+    """Joins two treaps, all the keys of left are smaller than the keys of right"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        right.update()
+        return right
+
+
+class IntervalIndex:
+    """Item ids by (low, high) intervals, answers contains (stabbing) queries
+
+    An interval tree: a treap (randomized balanced search tree) of the intervals ordered by low, each node holding
+    the maximum high of its subtree. add and remove take O(log n) expected time. A stabbing query only descends into
+    the subtrees whose maximum high reaches x and, right of a node, only if the node's low does not exceed x, which
+    is O(min(n, k log n)) for k results.
+    """
+
+    __slots__ = ("root", "intervals")
+
+    def __init__(self):
+        self.root: _IntervalNode | None = None
+        self.intervals: dict[int, tuple[float, float]] = dict()
+
+    def add(self, item_id: int, value: tuple):
+        low, high = value
+        low = -float("inf") if low is None else low
+        high = float("inf") if high is None else high
+
+        self.intervals[item_id] = (low, high)
+        left, right = _split(self.root, (low, item_id))
+        self.root = _merge(_merge(left, _IntervalNode((low, item_id), high)), right)
+
+    def remove(self, item_id: int, value: tuple):
+        low, _ = self.intervals.pop(item_id)
+        left, rest = _split(self.root, (low, item_id))
+        _, right = _split(rest, (low, item_id + 1))  # Ids are ints, the node is the only one between the keys
+        self.root = _merge(left, right)
+
+    def stab(self, x) -> list[int]:
+        """Ids of the items whose interval contains x"""
+        result = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_high < x:
+                continue
+
+            stack.append(node.left)
+            if node.key[0] <= x:
+                if node.high >= x:
+                    result.append(node.key[1])
+
+                # Lows in the right subtree are >= this one
+                stack.append(node.right)
+
+        return result
+
+    def lookup(self, op: str, value, all_ids: typing.Collection[int]) -> typing.Collection[int] | None:
+        if op == "contains":
+            return self.stab(value)
+
+        return None
+
+
+def flatten(decoded: typing.Mapping[str, typing.Mapping[str, typing.Any]], interval_fields: dict[str, tuple[str | None, str | None]] = default_interval_fields) -> dict[str, typing.Any]:
+    """Merges the main and aux region data (as returned by batch.decode_record) into a single item"""
+    result = dict()
+    for region_name in ("main", "aux"):
+        region_data = decoded.get(region_name)
+        if region_data:
+            result.update(region_data.items())
+
+    full_weight = result.get("actual_netto_full_weight", result.get("nominal_netto_full_weight"))
+    if full_weight is not None:
+        result["remaining_weight"] = full_weight - result.get("consumed_weight", 0)
+
+    # Effective UUIDs, so that the items can be looked up by brand_uuid etc. even if the fields are not present
+    result.update(uuids.resolve(result))
+
+    # Missing bounds mean that the material does not restrict that side of the range
+    for name, (low_field, high_field) in interval_fields.items():
+        result[name] = (result.get(low_field), result.get(high_field))
+
+    return result
+
+
+class Inventory:
+    """Store of decoded tags with secondary indexes, evaluating conjunctive queries without full scans"""
+
+    # Flattened items by id
+    items: dict[int, dict[str, typing.Any]]
+
+    # Decoded region data by id, as passed to add_decoded
+    decoded: dict[int, dict[str, typing.Mapping[str, typing.Any]]]
+
+    # Indexes by field name
+    indexes: dict[str, HashIndex | SortedIndex | MaskIndex | IntervalIndex]
+
+    def __init__(
+        self,
+        config_file: str = default_config_file,
+        hash_fields: typing.Iterable[str] = default_hash_fields,
+        sorted_fields: typing.Iterable[str] = default_sorted_fields,
+        mask_fields: typing.Iterable[str] = default_mask_fields,
+        interval_fields: dict[str, tuple[str | None, str | None]] = default_interval_fields,
+    ):
+        self.interval_fields = interval_fields
+        self.items = dict()
+        self.decoded = dict()
+        self.next_id = 0
+
+        self.indexes = dict()
+        for field_name in hash_fields:
+            self.indexes[field_name] = HashIndex()
+
+        for field_name in sorted_fields:
+            self.indexes[field_name] = SortedIndex()
+
+        for field_name in mask_fields:
+            self.indexes[field_name] = MaskIndex(field_enum_table(config_file, "main", field_name))
+
+        for field_name in interval_fields:
+            self.indexes[field_name] = IntervalIndex()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _index(self, item_id: int, item: dict, fields: typing.Iterable[str], remove: bool = False):
+        for field_name in fields:
+            index = self.indexes.get(field_name)
+            if index is None or field_name not in item:
+                continue
+
+            if remove:
+                index.remove(item_id, item[field_name])
+            else:
+                index.add(item_id, item[field_name])
+
+    def add(self, record: Record) -> int:
+        """Decodes the record and adds it, returns id of the item"""
+        return self.add_decoded({name: region.read() for name, region in record.regions.items() if name != "meta"})
+
+    def add_decoded(self, decoded: typing.Mapping[str, typing.Mapping[str, typing.Any]]) -> int:
+        """Adds decoded region data (an item of batch.decode_batch), returns id of the item"""
+        item_id = self.next_id
+        self.next_id += 1
+
+        item = flatten(decoded, self.interval_fields)
+        self.items[item_id] = item
+        self.decoded[item_id] = dict(decoded)
+        self._index(item_id, item, item.keys())
+
+        return item_id
+
+    def add_batch(self, decoded: typing.Iterable[typing.Mapping[str, typing.Mapping[str, typing.Any]]]) -> list[int]:
+        return [self.add_decoded(d) for d in decoded]
+
+    def remove(self, item_id: int):
+        item = self.items.pop(item_id)
+        del self.decoded[item_id]
+        self._index(item_id, item, item.keys(), remove=True)
+
+    def update(self, item_id: int, decoded: typing.Mapping[str, typing.Mapping[str, typing.Any]]):
+        """Replaces the item data, only the indexes of the changed fields are updated"""
+        old_item = self.items[item_id]
+        new_item = flatten(decoded, self.interval_fields)
+
+        changed = [name for name in old_item.keys() | new_item.keys() if old_item.get(name, _missing) != new_item.get(name, _missing)]
+        self._index(item_id, old_item, changed, remove=True)
+        self._index(item_id, new_item, changed)
+
+        self.items[item_id] = new_item
+        self.decoded[item_id] = dict(decoded)
+
+    def update_aux(self, item_id: int, aux_data: typing.Mapping[str, typing.Any]):
+        """Replaces the aux region data of the item (for example after the consumed weight was updated)"""
+        decoded = dict(self.decoded[item_id])
+        decoded["aux"] = aux_data
+        self.update(item_id, decoded)
+
+    def query(self, *conditions: Condition) -> list[int]:
+        """Returns sorted ids of the items matching all the conditions"""
+        all_ids = self.items.keys()
+
+        indexed = []
+        residual = []
+        for condition in conditions:
+            field, op, value = condition
+            assert op in operators, f"Unknown operator '{op}'"
+
+            index = self.indexes.get(field)
+            ids = index.lookup(op, value, all_ids) if index is not None else None
+            if ids is None:
+                residual.append(condition)
+            else:
+                indexed.append(ids)
+
+        # Intersect from the smallest set, so that the intermediate results are small
+        indexed.sort(key=len)
+        candidates = None
+        for ids in indexed:
+            if candidates is None:
+                candidates = set(ids)
+            else:
+                candidates.intersection_update(ids)
+
+            if not candidates:
+                return []
+
+        if candidates is None:
+            candidates = all_ids
+
+        items = self.items
+        return sorted(item_id for item_id in candidates if all(_matches(items[item_id], condition) for condition in residual))
+
+    def compatible(self, **values) -> list[int]:
+        """Returns sorted ids of the items whose ranges contain all the values, for example compatible(nozzle_diameter=0.4, print_temperature=240)"""
+        return self.query(*((f"{name}_range", "contains", value) for name, value in values.items()))
+
+    def scan(self, *conditions: Condition) -> list[int]:
+        """Same as query, but evaluates the conditions on every item without using the indexes"""
+        mask_tables = {name: index.table for name, index in self.indexes.items() if type(index) is MaskIndex}
+
+        result = []
+        for item_id, item in self.items.items():
+            # The conditions work with names, convert the masks
+            for name, table in mask_tables.items():
+                if type(item.get(name)) is int:
+                    item = dict(item)
+                    item[name] = table.names_from_mask(item[name])
+
+            if all(_matches(item, condition) for condition in conditions):
+                result.append(item_id)
+
+        return sorted(result)
+
+    def get(self, item_id: int) -> dict[str, typing.Any]:
+        return self.items[item_id]
+
+
+_missing = object()
+
+
+def parse_condition(text: str) -> Condition:
+    """Parses a condition in the form "field op value", value in the YAML syntax (for example `tags any_of [abrasive, glitter]`)"""
+    field, op, value = text.split(maxsplit=2)
+    assert op in operators, f"Unknown operator '{op}'"
+    return field, op, yaml.safe_load(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="inventory", description="Loads a corpus (see corpus.py) into an indexed inventory and evaluates a query on it")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-w", "--where", action="append", default=[], help=f"Condition 'field op value', can be repeated. Operators: {', '.join(operators)}")
+    parser.add_argument("--check", action=argparse.BooleanOptionalAction, default=False, help="Check the indexed query result against a full scan")
+    parser.add_argument("--show-items", action=argparse.BooleanOptionalAction, default=False, help="Print the matching items")
+
+    args = parser.parse_args()
+
+    inventory = Inventory(args.config_file)
+    inventory.add_batch(decode_batch(read_corpus(args.corpus), args.config_file, regions=("main", "aux"), config=DecodeConfig(enum_array_masks=True)))
+
+    conditions = [parse_condition(c) for c in args.where]
+    result = inventory.query(*conditions)
+
+    output = {"items": len(inventory), "matches": len(result)}
+    if args.show_items:
+        output["matching_items"] = {item_id: inventory.get(item_id) for item_id in result}
+
+    if args.check:
+        expected = inventory.scan(*conditions)
+        if result != expected:
+            print(f"Indexed query result differs from the full scan: {result} != {expected}", file=sys.stderr)
+            sys.exit(1)
+
+    print(yaml.dump(output, sort_keys=False), end="")
@@ -0,0 +1,181 @@
+# Memory footprint measurement of the batch decode path (tracemalloc based)
+#
+# All the decoded objects are kept alive during the measurement, so the reported numbers are
+# the bytes retained by each kind of object, which is what holding a decoded fleet in memory costs.
+# The Record figures exclude the record's own Region objects, which are reported separately.
+
+import os
+import sys
+import tracemalloc
+import typing
+
+from record import Record
+from fields import DecodeConfig, CompactData
+
+# Allocation sites in these files are reported as the top allocation sites
+site_filters = [
+    tracemalloc.Filter(True, os.path.join("*", "cbor2_local", "*")),
+    tracemalloc.Filter(True, os.path.join("*", "fields.py")),
+]
+
+
+def peak_rss() -> int | None:
+    """Peak resident set size of the process in bytes, None if not available on the platform"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def deep_size(value) -> int:
+    """Size of the object including the contained objects (for dicts, lists, tuples and compact data)"""
+    result = sys.getsizeof(value)
+
+    if isinstance(value, CompactData):
+        # The values as held, not the ones converted on access
+        result += deep_size(value.stored_values())
+
+    elif isinstance(value, dict):
+        result += sum(deep_size(k) + deep_size(v) for k, v in value.items())
+
+    elif isinstance(value, (list, tuple)):
+        result += sum(deep_size(v) for v in value)
+
+    return result
+
+
+def region_size(region) -> int:
+    """Size of the Region object and its memory view (the memory itself belongs to the image, the schema is shared)"""
+    return sys.getsizeof(region) + sys.getsizeof(region.memory)
+
+
+class _Counter:
+    __slots__ = ("count", "bytes")
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+
+    def add(self, allocated: int):
+        self.count += 1
+        self.bytes += allocated
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_bytes": self.bytes,
+            "mean_bytes": self.bytes / self.count if self.count else 0,
+        }
+
+
+def profile_decode(images: typing.Iterable[memoryview], config_file: str, top: int = 10, decode_config: DecodeConfig = None) -> dict:
+    """Decodes the images the same way batch.decode_batch does and measures the memory retained by the individual objects"""
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(1)
+
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+
+    records = _Counter()
+    regions = _Counter()
+    dicts = _Counter()
+    field_types: dict[str, _Counter] = dict()
+
+    # Keep everything alive until the end of the measurement
+    retained = []
+
+    try:
+        for image in images:
+            if type(image) is not memoryview:
+                image = memoryview(image)
+
+            before = tracemalloc.get_traced_memory()[0]
+            record = Record(config_file, image)
+            record_bytes = tracemalloc.get_traced_memory()[0] - before
+            retained.append(record)
+
+            # The regions are allocated by the record constructor, split them out of its figure
+            for region in record.regions.values():
+                size = region_size(region)
+                regions.add(size)
+                record_bytes -= size
+
+            records.add(record_bytes)
+
+            for region in record.regions.values():
+                before = tracemalloc.get_traced_memory()[0]
+                decoded = region.read(config=decode_config)
+                dicts.add(tracemalloc.get_traced_memory()[0] - before)
+                retained.append(decoded)
+
+                if region.is_corrupt:
+                    continue
+
+                # Field values often are the very objects allocated by the CBOR decoder (strings, ints),
+                # so they are accounted by their size rather than by the allocations during the conversion.
+                # Compact data is accounted by the values it holds, not the ones converted on access.
+                values = zip(decoded, decoded.stored_values()) if isinstance(decoded, CompactData) else decoded.items()
+                for name, value in values:
+                    type_name = region.fields.fields_by_name[name].type_name
+                    counter = field_types.get(type_name)
+                    if counter is None:
+                        counter = field_types[type_name] = _Counter()
+
+                    counter.add(deep_size(value))
+
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(site_filters)
+
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    return {
+        "records": records.as_dict(),
+        "regions": regions.as_dict(),
+        "decoded_dicts": dicts.as_dict(),
+        "field_types": {name: counter.as_dict() for name, counter in sorted(field_types.items(), key=lambda x: -x[1].bytes)},
+        "traced_bytes": current_memory - start_memory,
+        "traced_peak_bytes": peak_memory,
+        "peak_rss_bytes": peak_rss(),
+        "top_sites": [
+            {
+                "site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:top]
+        ],
+    }
+
+
+def format_report(report: dict) -> str:
+    def row(name, stats):
+        return f"{name:<28} {stats['count']:>10} {stats['total_bytes']:>14} {stats['mean_bytes']:>12.1f}"
+
+    lines = [f"{'object':<28} {'count':>10} {'total bytes':>14} {'mean bytes':>12}"]
+    lines.append(row("Record", report["records"]))
+    lines.append(row("Region", report["regions"]))
+    lines.append(row("decoded dict", report["decoded_dicts"]))
+
+    for name, stats in report["field_types"].items():
+        lines.append(row(f"field value: {name}", stats))
+
+    lines.append("")
+    lines.append(f"Traced memory retained: {report['traced_bytes']} B, traced peak: {report['traced_peak_bytes']} B")
+    if report["peak_rss_bytes"] is not None:
+        lines.append(f"Peak RSS: {report['peak_rss_bytes']} B")
+
+    lines.append("")
+    lines.append("Top allocation sites (cbor2_local, fields.py):")
+    for site in report["top_sites"]:
+        lines.append(f"  {site['bytes']:>12} B {site['count']:>8}x  {site['site']}")
+
+    return "\n".join(lines)
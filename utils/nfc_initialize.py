@@ -1,5 +1,11 @@
 # Reference implementation of initializing an "empty" Prusa Material NFC tag
 
+import worker
+
+# Hand the call over to the resident worker if it is running, before the costly imports
+if __name__ == "__main__":
+    worker.forward("nfc_initialize")
+
 import simple_parsing
 import ndef
 import cbor2_local as cbor2
@@ -7,9 +13,9 @@ import os
 import sys
 import types
 from dataclasses import dataclass
-import yaml
 
 from fields import Fields, EncodeConfig
+from formats import load_yaml
 from common import default_config_file
 
 # Maximum expected size of the meta section
@@ -42,7 +48,7 @@ class Args:
 def nfc_initialize(args: Args):
     config_dir = os.path.dirname(args.config_file)
     with open(args.config_file, "r") as f:
-        config = types.SimpleNamespace(**yaml.safe_load(f))
+        config = types.SimpleNamespace(**load_yaml(f))
 
     assert config.root == "nfcv", "nfc_initialize only supports NFC-V tags"
 
@@ -199,10 +205,15 @@ def nfc_initialize(args: Args):
     return full_data
 
 
-if __name__ == "__main__":
+def main(argv: list[str] = None, input: bytes = None) -> bytes:
+    """Runs nfc_initialize with the command line arguments, returns the tag data (input is unused, for consistency with the other utilities)"""
     parser = simple_parsing.ArgumentParser(
         prog="nfc_initialize",
         description="Initializes an 'empty' (with no static or aux data) NFC tag to be used as a Prusa Material tag.\nThe resulting bytes to be written on the tag are returned to stdout.",
     )
     parser.add_arguments(Args, dest="args")
-    sys.stdout.buffer.write(nfc_initialize(parser.parse_args().args))
+    return nfc_initialize(parser.parse_args(argv).args)
+
+
+if __name__ == "__main__":
+    sys.stdout.buffer.write(main())
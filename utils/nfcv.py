@@ -0,0 +1,524 @@
+# Asyncio transport for NFC-V (ISO/IEC 15693) tags and an in-memory ICODE SLIX2 simulator
+#
+# Transport exchanges raw ISO 15693 frames (flags, command code, parameters; the CRC is left to the reader) with a
+# tag in the field of a single reader. Commands on one reader are serialized, different readers work concurrently.
+# Tag builds the commands used by the library (Get System Info, Read Single/Multiple Blocks, Write Single Block)
+# on top of a transport, and the read/write functions below implement the strategies of reading the tag image.
+#
+# Slix2Simulator is a Transport emulating an ICODE SLIX2 (80 blocks of 4 bytes) with a latency model of the reader
+# and the air interface, the local stand-in for the hardware. A live reader is supported by subclassing Transport
+# and implementing _exchange with the reader driver.
+#
+# The lazy strategy does not read the image upfront: open_buffer returns a PagedBuffer (see paged.py) that reads the
+# blocks from the tag as the record accesses them, so parsing a record only transfers the blocks of the NDEF headers
+# and of the regions that are actually read. PagedBuffer reads synchronously, so the record backed by it must be
+# constructed and read outside of the event loop thread (asyncio.to_thread), the block reads are run on the loop.
+
+import abc
+import argparse
+import asyncio
+import dataclasses
+import random
+import statistics
+import threading
+import time
+
+import yaml
+
+from paged import PagedBuffer
+from record import Record
+from corpus import read_corpus
+from common import default_config_file
+
+# Request flags
+flag_high_data_rate = 0x02
+flag_addressed = 0x20
+
+# Response flags
+flag_error = 0x01
+
+# Command codes
+cmd_read_single_block = 0x20
+cmd_write_single_block = 0x21
+cmd_read_multiple_blocks = 0x23
+cmd_get_system_info = 0x2B
+
+# Error codes
+error_not_supported = 0x01
+error_not_recognized = 0x02
+error_block_not_available = 0x10
+
+# Strategies of read_image
+read_strategies = ("single", "multiple", "ndef", "lazy")
+
+
+class NfcvError(Exception):
+    """The tag responded with an error"""
+
+    def __init__(self, code: int):
+        super().__init__(f"Tag error 0x{code:02X}")
+        self.code = code
+
+
+class NfcvTimeout(Exception):
+    """The tag did not respond"""
+
+
+@dataclasses.dataclass(frozen=True)
+class SystemInfo:
+    uid: bytes  # MSB first
+    block_size: int
+    block_count: int
+    dsfid: int = None
+    afi: int = None
+    ic_reference: int = None
+
+    @property
+    def memory_size(self) -> int:
+        return self.block_size * self.block_count
+
+
+class Transport(abc.ABC):
+    """Reader with a tag in its field, exchanges raw ISO 15693 frames
+
+    Commands are serialized per transport (a reader has one RF field), concurrent transceive calls queue up.
+    Subclasses implement _exchange.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    async def transceive(self, request: bytes) -> bytes:
+        """Sends the request frame, returns the response frame (without CRC). Raises NfcvTimeout if the tag did not respond."""
+        async with self._lock:
+            return await self._exchange(request)
+
+    @abc.abstractmethod
+    async def _exchange(self, request: bytes) -> bytes:
+        """Exchanges a single frame with the reader, called with the transport lock held"""
+
+
+class Tag:
+    """ISO 15693 commands addressed to a tag, optionally by its UID (MSB first)"""
+
+    def __init__(self, transport: Transport, uid: bytes = None, max_read_blocks: int = 32):
+        self.transport = transport
+        self.uid = uid
+
+        # Maximum blocks of a single Read Multiple Blocks command, readers have limited buffers
+        self.max_read_blocks = max_read_blocks
+
+        self._system_info = None
+
+    async def command(self, command: int, params: bytes = b"") -> bytes:
+        """Sends the command, returns the response payload (without the flags). Raises NfcvError if the tag responded with an error."""
+        if self.uid is not None:
+            request = bytes((flag_high_data_rate | flag_addressed, command)) + self.uid[::-1] + params
+        else:
+            request = bytes((flag_high_data_rate, command)) + params
+
+        response = await self.transport.transceive(request)
+        if response[0] & flag_error:
+            raise NfcvError(response[1])
+
+        return response[1:]
+
+    async def system_info(self) -> SystemInfo:
+        """Get System Info, cached"""
+        if self._system_info is None:
+            self._system_info = parse_system_info(await self.command(cmd_get_system_info))
+
+        return self._system_info
+
+    async def read_single_block(self, block: int) -> bytes:
+        return await self.command(cmd_read_single_block, bytes((block,)))
+
+    async def read_multiple_blocks(self, first_block: int, count: int) -> bytes:
+        assert 1 <= count <= 256
+        return await self.command(cmd_read_multiple_blocks, bytes((first_block, count - 1)))
+
+    async def write_single_block(self, block: int, data: bytes):
+        await self.command(cmd_write_single_block, bytes((block,)) + bytes(data))
+
+    async def read_blocks(self, first_block: int, count: int) -> bytes:
+        """Reads the blocks by as few Read Multiple Blocks commands as the reader allows"""
+        result = bytearray()
+        for chunk_start in range(first_block, first_block + count, self.max_read_blocks):
+            result += await self.read_multiple_blocks(chunk_start, min(self.max_read_blocks, first_block + count - chunk_start))
+
+        return bytes(result)
+
+
+def parse_system_info(response: bytes) -> SystemInfo:
+    info_flags = response[0]
+    uid = response[1:9][::-1]
+    pos = 9
+    values = dict()
+
+    if info_flags & 0x01:
+        values["dsfid"] = response[pos]
+        pos += 1
+
+    if info_flags & 0x02:
+        values["afi"] = response[pos]
+        pos += 1
+
+    assert info_flags & 0x04, "The tag does not report its memory size"
+    block_count = response[pos] + 1
+    block_size = (response[pos + 1] & 0x1F) + 1
+    pos += 2
+
+    if info_flags & 0x08:
+        values["ic_reference"] = response[pos]
+
+    return SystemInfo(uid=bytes(uid), block_size=block_size, block_count=block_count, **values)
+
+
+def ndef_extent(data: bytes) -> int | None:
+    """Returns the number of bytes from the tag start to the end of the NDEF TLV value, None if more data are needed
+
+    Walks the capability container and the TLVs the same way Record does.
+    """
+    if len(data) < 4:
+        return None
+
+    assert data[0] == 0xE1, "Capability container magic number does not match"
+
+    pos = 4
+    while True:
+        if pos + 2 > len(data):
+            return None
+
+        tlv_tag, tlv_len = data[pos], data[pos + 1]
+        assert tlv_tag != 0xFE, "Did not find the NDEF TLV"
+        pos += 2
+
+        if tlv_len == 0xFF:
+            if pos + 2 > len(data):
+                return None
+
+            tlv_len = data[pos] * 256 | data[pos + 1]
+            pos += 2
+
+        if tlv_tag == 0x03:
+            return pos + tlv_len
+
+        pos += tlv_len
+
+
+async def read_image(tag: Tag, strategy: str = "ndef") -> bytearray:
+    """Reads the tag memory image
+
+    - single: the whole memory by Read Single Block commands
+    - multiple: the whole memory by Read Multiple Blocks commands
+    - ndef: only the blocks up to the end of the NDEF message, the rest of the image is zero. Reads the first
+      blocks to find the NDEF TLV length, then the remaining blocks by Read Multiple Blocks commands. The NDEF
+      message usually spans most of the tag, so the first read is as large as the reader allows.
+    """
+    info = await tag.system_info()
+    image = bytearray(info.memory_size)
+
+    match strategy:
+        case "single":
+            for block in range(info.block_count):
+                image[block * info.block_size : (block + 1) * info.block_size] = await tag.read_single_block(block)
+
+        case "multiple":
+            image[:] = await tag.read_blocks(0, info.block_count)
+
+        case "ndef":
+            read_blocks = min(tag.max_read_blocks, info.block_count)
+            image[: read_blocks * info.block_size] = await tag.read_blocks(0, read_blocks)
+
+            # Other TLVs can precede the NDEF one
+            while (extent := ndef_extent(image[: read_blocks * info.block_size])) is None and read_blocks < info.block_count:
+                count = min(tag.max_read_blocks, info.block_count - read_blocks)
+                image[read_blocks * info.block_size : (read_blocks + count) * info.block_size] = await tag.read_blocks(read_blocks, count)
+                read_blocks += count
+
+            assert extent is not None and extent <= info.memory_size, "NDEF TLV exceeds the tag memory"
+
+            end_block = -(-extent // info.block_size)
+            if end_block > read_blocks:
+                image[read_blocks * info.block_size : end_block * info.block_size] = await tag.read_blocks(read_blocks, end_block - read_blocks)
+
+        case _:
+            assert False, f"Unknown read strategy '{strategy}'"
+
+    return image
+
+
+async def write_image(tag: Tag, data: bytes, original: bytes = None) -> int:
+    """Writes the image to the tag, only the blocks that differ from the original image if provided, returns the number of written blocks"""
+    info = await tag.system_info()
+    assert len(data) <= info.memory_size, "The image exceeds the tag memory"
+
+    written = 0
+    for block in range(-(-len(data) // info.block_size)):
+        block_data = bytes(data[block * info.block_size : (block + 1) * info.block_size]).ljust(info.block_size, b"\x00")
+        if original is not None and block_data == bytes(original[block * info.block_size : (block + 1) * info.block_size]).ljust(info.block_size, b"\x00"):
+            continue
+
+        await tag.write_single_block(block, block_data)
+        written += 1
+
+    return written
+
+
+def _blocking(loop: asyncio.AbstractEventLoop, loop_thread: int, coroutine) -> any:
+    """Runs the coroutine on the loop from another thread and waits for its result"""
+    if threading.get_ident() == loop_thread:
+        coroutine.close()
+        assert False, "The tag can not be accessed synchronously from the event loop thread, use asyncio.to_thread"
+
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def open_buffer(tag: Tag, prefetch_blocks: int = 1) -> PagedBuffer:
+    """Returns a PagedBuffer over the tag memory that reads the blocks from the tag when they are first accessed
+
+    The buffer must only be accessed outside of the event loop thread.
+    """
+    info = await tag.system_info()
+    loop, loop_thread = asyncio.get_running_loop(), threading.get_ident()
+
+    def read_blocks(first_block: int, count: int) -> bytes:
+        return _blocking(loop, loop_thread, tag.read_blocks(first_block, count))
+
+    return PagedBuffer(info.memory_size, read_blocks, block_size=info.block_size, max_read_blocks=tag.max_read_blocks, prefetch_blocks=prefetch_blocks)
+
+
+async def write_buffer(tag: Tag, buffer: PagedBuffer) -> int:
+    """Writes the blocks changed through the buffer back to the tag, returns the number of written blocks"""
+    loop, loop_thread = asyncio.get_running_loop(), threading.get_ident()
+
+    def write_block(block: int, data: bytes):
+        _blocking(loop, loop_thread, tag.write_single_block(block, data))
+
+    return await asyncio.to_thread(buffer.flush, write_block)
+
+
+async def read_record(tag: Tag, config_file: str = default_config_file, strategy: str = "ndef") -> Record:
+    """Reads the tag (see read_image) and parses the record
+
+    With the lazy strategy, the record is backed by open_buffer and reads the regions from the tag on demand, its
+    regions must be read outside of the event loop thread.
+    """
+    if strategy == "lazy":
+        return await asyncio.to_thread(Record, config_file, await open_buffer(tag))
+
+    return Record(config_file, memoryview(await read_image(tag, strategy)))
+
+
+@dataclasses.dataclass(frozen=True)
+class LatencyModel:
+    """Time of a command: command_overhead + per_byte * (request + response bytes, with CRC) [+ write_time]
+
+    The defaults approximate a USB reader at the ISO 15693 high data rate (26.48 kbit/s, ~0.3 ms per byte) and the
+    EEPROM programming time of a write.
+    """
+
+    command_overhead: float = 1.0e-3
+    per_byte: float = 0.302e-3
+    write_time: float = 4.5e-3
+
+    # Relative random variation of the command time
+    jitter: float = 0.0
+
+    def scaled(self, factor: float) -> "LatencyModel":
+        return dataclasses.replace(self, command_overhead=self.command_overhead * factor, per_byte=self.per_byte * factor, write_time=self.write_time * factor)
+
+    def command_time(self, request_size: int, response_size: int, write: bool, rng: random.Random) -> float:
+        result = self.command_overhead + self.per_byte * (request_size + response_size + 4) + (self.write_time if write else 0)
+        if self.jitter:
+            result *= 1 + rng.uniform(-self.jitter, self.jitter)
+
+        return result
+
+
+class Slix2Simulator(Transport):
+    """In-memory ICODE SLIX2 tag in the field of a simulated reader"""
+
+    block_size = 4
+    ic_reference = 0x01
+
+    def __init__(self, data: bytes = None, uid: bytes = bytes.fromhex("E0040108662F6FBC"), latency: LatencyModel = LatencyModel(), seed: int = 0, block_count: int = 80):
+        super().__init__()
+        self.uid = bytes(uid)
+
+        # 80 blocks is the SLIX2 memory, larger memories allow simulating the bigger tags of the corpora
+        assert 1 <= block_count <= 256
+        self.block_count = block_count
+        self.latency = latency
+        self.memory = bytearray(self.block_size * self.block_count)
+        self._rng = random.Random(seed)
+
+        # Command counts, transferred bytes and the simulated busy time of the reader
+        self.commands: dict[str, int] = dict()
+        self.transferred_bytes = 0
+        self.busy_time = 0.0
+
+        if data is not None:
+            self.place(data)
+
+    def place(self, data: bytes):
+        """Replaces the tag in the field by one with the specified memory contents"""
+        assert len(data) <= len(self.memory), "The image exceeds the tag memory"
+        self.memory[:] = bytes(data).ljust(len(self.memory), b"\x00")
+
+    def _error(self, code: int) -> bytes:
+        return bytes((flag_error, code))
+
+    def _respond(self, request: bytes) -> bytes:
+        flags, command = request[0], request[1]
+        params = request[2:]
+
+        if flags & flag_addressed:
+            if params[:8][::-1] != self.uid:
+                raise NfcvTimeout("No tag with the addressed UID")
+
+            params = params[8:]
+
+        match command:
+            case 0x2B:
+                self._count("get_system_info")
+                return bytes((0x00, 0x0F)) + self.uid[::-1] + bytes((0x00, 0x00, self.block_count - 1, self.block_size - 1, self.ic_reference))
+
+            case 0x20:
+                self._count("read_single_block")
+                block = params[0]
+                if block >= self.block_count:
+                    return self._error(error_block_not_available)
+
+                return b"\x00" + self.memory[block * self.block_size : (block + 1) * self.block_size]
+
+            case 0x23:
+                self._count("read_multiple_blocks")
+                first, count = params[0], params[1] + 1
+                if first + count > self.block_count:
+                    return self._error(error_block_not_available)
+
+                return b"\x00" + self.memory[first * self.block_size : (first + count) * self.block_size]
+
+            case 0x21:
+                self._count("write_single_block")
+                block, data = params[0], params[1:]
+                if block >= self.block_count:
+                    return self._error(error_block_not_available)
+
+                if len(data) != self.block_size:
+                    return self._error(error_not_recognized)
+
+                self.memory[block * self.block_size : (block + 1) * self.block_size] = data
+                return b"\x00"
+
+            case _:
+                return self._error(error_not_supported)
+
+    def _count(self, command: str):
+        self.commands[command] = self.commands.get(command, 0) + 1
+
+    async def _exchange(self, request: bytes) -> bytes:
+        response = self._respond(request)
+
+        duration = self.latency.command_time(len(request), len(response), request[1] == cmd_write_single_block, self._rng)
+        self.transferred_bytes += len(request) + len(response)
+        self.busy_time += duration
+
+        await asyncio.sleep(duration)
+        return response
+
+
+async def simulate(images: list[bytes], readers: int, strategy: str, config_file: str, latency: LatencyModel, write: bool, check: bool) -> dict:
+    """Scans the images on simulated readers, each reader processing its share of the tags one after another
+
+    Every scan reads the record and decodes its regions; with write, the aux region consumed_weight is updated and
+    the changed blocks written back.
+    """
+    block_count = max(80, max(-(-len(image) // Slix2Simulator.block_size) for image in images))
+    simulators = [Slix2Simulator(latency=latency, uid=bytes.fromhex("E00401080000") + i.to_bytes(2, "big"), seed=i, block_count=block_count) for i in range(readers)]
+    scan_times = []
+
+    async def scan_reader(reader: int):
+        simulator = simulators[reader]
+        for index in range(reader, len(images), readers):
+            simulator.place(images[index])
+
+            start = time.perf_counter()
+            tag = Tag(simulator, uid=simulator.uid)
+            if strategy == "lazy":
+                record = await read_record(tag, config_file, strategy)
+                decoded = await asyncio.to_thread(lambda: {name: region.read() for name, region in record.regions.items()})
+            else:
+                image = await read_image(tag, strategy)
+                original = bytes(image)
+                record = Record(config_file, memoryview(image))
+                decoded = {name: region.read() for name, region in record.regions.items()}
+
+            if check:
+                expected = Record(config_file, memoryview(bytearray(images[index])))
+                assert decoded == {name: region.read() for name, region in expected.regions.items()}, f"Tag {index} decoded differently"
+
+            if write and record.aux_region is not None:
+                if strategy == "lazy":
+                    await asyncio.to_thread(record.aux_region.update, {"consumed_weight": 100})
+                    await write_buffer(tag, record.buffer)
+                else:
+                    record.aux_region.update({"consumed_weight": 100})
+                    await write_image(tag, record.data, original)
+
+                if check:
+                    # Re-read the tag, only the aux region may have changed
+                    changed = expected.refresh(memoryview(bytearray(simulator.memory[: len(images[index])])))
+                    assert set(changed) <= {"aux"}, f"Tag {index} write changed the regions {changed}"
+                    assert expected.aux_region.read()["consumed_weight"] == 100, f"Tag {index} write failed"
+
+            scan_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(scan_reader(i) for i in range(readers)))
+    elapsed = time.perf_counter() - start
+
+    commands = dict()
+    for simulator in simulators:
+        for command, count in simulator.commands.items():
+            commands[command] = commands.get(command, 0) + count
+
+    scan_times.sort()
+    return {
+        "tags": len(images),
+        "readers": readers,
+        "strategy": strategy,
+        "elapsed_s": round(elapsed, 3),
+        "tags_per_s": round(len(images) / elapsed, 1),
+        "scan_ms": {
+            "mean": round(statistics.mean(scan_times) * 1e3, 2),
+            "p50": round(scan_times[len(scan_times) // 2] * 1e3, 2),
+            "max": round(scan_times[-1] * 1e3, 2),
+        },
+        "commands_per_tag": {command: round(count / len(images), 2) for command, count in sorted(commands.items())},
+        "bytes_per_tag": round(sum(s.transferred_bytes for s in simulators) / len(images), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="nfcv", description="Scans the tags of a corpus (see corpus.py) on simulated SLIX2 tags and readers, and reports the throughput of the read strategy")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-n", "--count", type=int, default=None, help="Only scan the first N tags")
+    parser.add_argument("-r", "--readers", type=int, default=1, help="Number of concurrent simulated readers")
+    parser.add_argument("-s", "--strategy", choices=read_strategies, default="ndef", help="Tag reading strategy")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply the default latencies, 0 = no simulated latency")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Relative random variation of the command times")
+    parser.add_argument("--write", action=argparse.BooleanOptionalAction, default=False, help="Also update the aux region and write the changed blocks back")
+    parser.add_argument("--check", action=argparse.BooleanOptionalAction, default=False, help="Check the scanned data against the corpus images")
+
+    args = parser.parse_args()
+
+    images = [bytes(image) for image in read_corpus(args.corpus)][: args.count]
+    assert images, "The corpus is empty"
+
+    latency = dataclasses.replace(LatencyModel().scaled(args.latency_scale), jitter=args.jitter)
+    result = asyncio.run(simulate(images, args.readers, args.strategy, args.config_file, latency, args.write, args.check))
+
+    print(yaml.dump(result, sort_keys=False), end="")
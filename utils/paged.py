@@ -0,0 +1,210 @@
+# Lazily fetched tag memory image
+#
+# Reading a whole tag block by block over RF is the slowest part of a scan. PagedBuffer stands in for the memoryview
+# of the tag image in Record: the blocks are fetched on demand through a synchronous read callback (typically
+# a reader driver) and cached, so constructing a record only pulls the blocks touched by the CC/TLV scan, the NDEF
+# record headers and the meta region, and every other region is fetched when it is first read.
+#
+# Blocks that have not been fetched yet read as zeroes through the view, use fetch() before accessing the memory
+# directly. Changes made through the view are written back block by block by flush().
+
+import argparse
+import io
+import typing
+
+ReadBlocks = typing.Callable[[int, int], bytes]  # (first block, block count) -> data
+WriteBlock = typing.Callable[[int, bytes], None]  # (block, data)
+
+
+class PagedBuffer:
+    """Tag memory of size bytes, fetched in blocks of block_size bytes through read_blocks
+
+    A single call of read_blocks reads at most max_read_blocks blocks (the limit of Read Multiple Blocks of the
+    tag). Each fetch is extended to at least prefetch_blocks blocks, trading the size of the transfers for
+    the number of round trips. Not thread-safe, the same as Record.
+    """
+
+    __slots__ = ("size", "block_size", "max_read_blocks", "prefetch_blocks", "view", "reads", "_read_blocks", "_data", "_original", "_loaded")
+
+    def __init__(self, size: int, read_blocks: ReadBlocks, block_size: int = 4, max_read_blocks: int = 32, prefetch_blocks: int = 1):
+        assert size > 0 and block_size > 0
+        assert max_read_blocks >= 1 and prefetch_blocks >= 1
+
+        self.size = size
+        self.block_size = block_size
+        self.max_read_blocks = max_read_blocks
+        self.prefetch_blocks = min(prefetch_blocks, max_read_blocks)
+        self.reads = 0  # Number of read_blocks calls
+
+        self._read_blocks = read_blocks
+        self._data = bytearray(size)
+        self._original = bytearray(size)  # Contents of the fetched blocks as read from the tag
+        self._loaded = bytearray(self.block_count)
+
+        self.view = memoryview(self._data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, **kwargs) -> "PagedBuffer":
+        """Buffer backed by an in-memory image, for tests and measurements"""
+        block_size = kwargs.get("block_size", 4)
+        return cls(len(data), lambda first, count: bytes(data[first * block_size : (first + count) * block_size]), **kwargs)
+
+    @property
+    def block_count(self) -> int:
+        return -(-self.size // self.block_size)
+
+    @property
+    def fetched_blocks(self) -> int:
+        return sum(self._loaded)
+
+    def is_fetched(self, start: int, end: int) -> bool:
+        return all(self._loaded[start // self.block_size : -(-end // self.block_size)])
+
+    def fetch(self, start: int = 0, end: int = None) -> memoryview:
+        """Makes sure the bytes [start, end) are fetched, returns the view of them"""
+        end = self.size if end is None else min(end, self.size)
+        block = start // self.block_size
+        end_block = -(-end // self.block_size)
+
+        while block < end_block:
+            if self._loaded[block]:
+                block += 1
+                continue
+
+            # Fetch the run of missing blocks in one read, extended up to prefetch_blocks
+            count = 1
+            while block + count < self.block_count and not self._loaded[block + count] and (block + count < end_block or count < self.prefetch_blocks) and count < self.max_read_blocks:
+                count += 1
+
+            self._load(block, count)
+            block += count
+
+        return self.view[start:end]
+
+    def _load(self, block: int, count: int):
+        start = block * self.block_size
+        end = min(start + count * self.block_size, self.size)
+
+        data = self._read_blocks(block, count)
+        self.reads += 1
+        assert len(data) >= end - start, f"Read of {count} blocks from block {block} returned {len(data)} bytes"
+
+        self._data[start:end] = data[: end - start]
+        self._original[start:end] = data[: end - start]
+        self._loaded[block : block + count] = b"\x01" * count
+
+    def open(self, start: int = 0, end: int = None) -> "PagedReader":
+        """Returns a binary stream over the bytes [start, end) of the buffer that fetches the blocks as they are read
+
+        The stream positions are absolute (relative to the buffer start), not relative to start.
+        """
+        reader = PagedReader(self, self.size if end is None else min(end, self.size))
+        reader.seek(start)
+        return reader
+
+    def changed_blocks(self) -> list[int]:
+        """Indices of the fetched blocks that were modified through the view"""
+        bs = self.block_size
+        return [block for block in range(self.block_count) if self._loaded[block] and self._data[block * bs : (block + 1) * bs] != self._original[block * bs : (block + 1) * bs]]
+
+    def flush(self, write_block: WriteBlock) -> int:
+        """Writes the modified blocks through write_block, returns the number of blocks written"""
+        bs = self.block_size
+        changed = self.changed_blocks()
+
+        for block in changed:
+            start, end = block * bs, min((block + 1) * bs, self.size)
+            write_block(block, bytes(self._data[start:end]).ljust(bs, b"\x00"))
+            self._original[start:end] = self._data[start:end]
+
+        return len(changed)
+
+
+class PagedReader(io.RawIOBase):
+    """Unbuffered seekable stream over a PagedBuffer, reads fetch only the blocks they cover"""
+
+    def __init__(self, buffer: PagedBuffer, end: int):
+        self._buffer = buffer
+        self._end = end
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self._position = offset
+            case io.SEEK_CUR:
+                self._position += offset
+            case io.SEEK_END:
+                self._position = self._end + offset
+
+        assert self._position >= 0, "Negative seek position"
+        return self._position
+
+    def readinto(self, target) -> int:
+        start = min(self._position, self._end)
+        end = min(start + len(target), self._end)
+        data = self._buffer.fetch(start, end)
+        target[: len(data)] = data
+        self._position = start + len(data)
+        return len(data)
+
+
+if __name__ == "__main__":
+    import sys
+
+    import formats
+    from common import default_config_file
+    from rec_info import InfoOptions, info
+    from record import Record
+
+    # The class Record knows, not the one of the __main__ module
+    from paged import PagedBuffer
+
+    parser = argparse.ArgumentParser(prog="paged", description="Parses a tag image through a lazily fetched buffer and reports how much of the tag had to be read")
+    parser.add_argument("image", help="Binary tag image file ('-' for stdin)")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file)
+    parser.add_argument("-r", "--regions", type=str, default="", help="Comma-separated regions to read after the record is constructed")
+    parser.add_argument("-b", "--block-size", type=int, default=4)
+    parser.add_argument("--prefetch", type=int, default=1, help="Minimum number of blocks per read")
+    parser.add_argument("--check", action=argparse.BooleanOptionalAction, default=False, help="Check that the regions read the same as from the fully read image")
+
+    args = parser.parse_args()
+
+    if args.image == "-":
+        image = sys.stdin.buffer.read()
+    else:
+        with open(args.image, "rb") as f:
+            image = f.read()
+
+    buffer = PagedBuffer.from_bytes(image, block_size=args.block_size, prefetch_blocks=args.prefetch)
+    record = Record(args.config_file, buffer)
+    construct_blocks, construct_reads = buffer.fetched_blocks, buffer.reads
+
+    regions = [name for name in args.regions.split(",") if name]
+    data = {name: record.regions[name].read() for name in regions}
+    total_blocks, total_reads = buffer.fetched_blocks, buffer.reads
+
+    if args.check:
+        full_record = Record(args.config_file, memoryview(bytearray(image)))
+        for name in regions:
+            assert data[name] == full_record.regions[name].read(), f"Region '{name}' differs from the fully read image"
+
+        options = InfoOptions(show_region_info=True, show_data=True)
+        assert info(record, options) == info(full_record, options), "Record info differs from the fully read image"
+
+    result = {
+        "block_count": buffer.block_count,
+        "construct": {"blocks": construct_blocks, "reads": construct_reads},
+        "total": {"blocks": total_blocks, "reads": total_reads},
+        "data": data,
+    }
+    sys.stdout.buffer.write(formats.dumps(result))
@@ -0,0 +1,142 @@
+# Opt-in instrumentation of the record parsing stages
+#
+# Instrumented code wraps its stages in `with profiling.stage("name"):`. When no profiler is enabled,
+# stage() returns a shared no-op context, so the instrumentation costs a single function call per stage.
+
+import json
+import os
+import threading
+import time
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.add(self.name, self.start, time.perf_counter_ns())
+        return False
+
+
+class Profiler:
+    """Collects timings and counts per stage, and optionally individual events for a trace export
+
+    Stages can be measured from multiple threads, the collected data are updated under a lock.
+    """
+
+    # name -> [count, total_ns]
+    stats: dict[str, list[int]]
+
+    # (name, start_ns, end_ns, thread_id), only collected if trace is enabled
+    events: list[tuple[str, int, int, int]]
+
+    def __init__(self, trace: bool = False):
+        self.stats = dict()
+        self.events = list()
+        self.trace = trace
+        self.start_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def stage(self, name: str):
+        return _Stage(self, name)
+
+    def add(self, name: str, start_ns: int, end_ns: int):
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0]
+
+            stat[0] += 1
+            stat[1] += end_ns - start_ns
+
+            if self.trace:
+                self.events.append((name, start_ns, end_ns, threading.get_ident()))
+
+    def summary(self) -> list[dict]:
+        """Returns per-stage statistics, sorted by total time"""
+        with self._lock:
+            stats = {name: tuple(stat) for name, stat in self.stats.items()}
+
+        result = []
+        for name, (count, total_ns) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            result.append(
+                {
+                    "stage": name,
+                    "count": count,
+                    "total_ms": total_ns / 1e6,
+                    "mean_us": total_ns / count / 1e3,
+                }
+            )
+
+        return result
+
+    def format_table(self) -> str:
+        lines = [f"{'stage':<32} {'count':>8} {'total ms':>10} {'mean us':>10}"]
+        for row in self.summary():
+            lines.append(f"{row['stage']:<32} {row['count']:>8} {row['total_ms']:>10.3f} {row['mean_us']:>10.2f}")
+
+        return "\n".join(lines)
+
+    def trace_events(self) -> list[dict]:
+        """Returns the collected events in the Chrome trace event format (complete events)"""
+        pid = os.getpid()
+        return [
+            {
+                "name": name,
+                "cat": name.split(".", 1)[0],
+                "ph": "X",
+                "ts": (start_ns - self.start_ns) / 1e3,
+                "dur": (end_ns - start_ns) / 1e3,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start_ns, end_ns, tid in self.events
+        ]
+
+    def write_trace(self, file: str):
+        """Writes a Chrome trace event JSON file, viewable in chrome://tracing or Perfetto"""
+        with open(file, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+
+
+# Currently enabled profiler, None if profiling is disabled
+active: Profiler = None
+
+
+def enable(trace: bool = False) -> Profiler:
+    global active
+    active = Profiler(trace=trace)
+    return active
+
+
+def disable() -> Profiler:
+    global active
+    result = active
+    active = None
+    return result
+
+
+def stage(name: str):
+    """Returns a context manager measuring the enclosed stage with the active profiler, if any"""
+    if active is None:
+        return _null_stage
+
+    return _Stage(active, name)
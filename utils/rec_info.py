@@ -1,122 +1,193 @@
 import argparse
+import dataclasses
 import sys
-import yaml
+import typing
 
+import worker
+
+# Hand the call over to the resident worker if it is running, before the costly imports
+if __name__ == "__main__":
+    worker.forward("rec_info")
+
+import profiling
+import formats
 from record import Record
+from fields import DecodeConfig
+from decode_cache import DecodeCache
 from common import default_config_file
 
-parser = argparse.ArgumentParser(prog="rec_info", description="Reads a record from the STDIN and prints various information about it in the YAML format")
-parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
-parser.add_argument("-r", "--show-region-info", action=argparse.BooleanOptionalAction, default=False, help="Print information about regions")
-parser.add_argument("-u", "--show-root-info", action=argparse.BooleanOptionalAction, default=False, help="Print general info about the NFC tag")
-parser.add_argument("-d", "--show-data", action=argparse.BooleanOptionalAction, default=False, help="Parse and print region data")
-parser.add_argument("-b", "--show-raw-data", action=argparse.BooleanOptionalAction, default=False, help="Print raw region data (HEX)")
-parser.add_argument("-m", "--show-meta", action=argparse.BooleanOptionalAction, default=False, help="By default, --show-data hides the meta region. Enabling this option will print it, too.")
-parser.add_argument("-i", "--show-uri", action=argparse.BooleanOptionalAction, default=False, help="If a URI NDEF record is present, report it as well.")
-parser.add_argument("-a", "--show-all", action=argparse.BooleanOptionalAction, default=False, help="Apply all --show options")
-parser.add_argument("-v", "--validate", action=argparse.BooleanOptionalAction, default=False, help="Check that the data are valid")
-parser.add_argument("-f", "--extra-required-fields", type=str, default=None, help="Check that all fields from the specified YAML file are present in the record")
-parser.add_argument("--unhex", action=argparse.BooleanOptionalAction, default=False, help="Interpret the stdin as a hex string instead of raw bytes")
 
-args = parser.parse_args()
+@dataclasses.dataclass
+class InfoOptions:
+    """What info() reports about the record, see the rec_info command line arguments"""
+
+    show_region_info: bool = False
+    show_root_info: bool = False
+    show_data: bool = False
+    show_raw_data: bool = False
+    show_meta: bool = False
+    show_uri: bool = False
+    validate: bool = False
+    expand_tags: bool = False
+
+    # Region name -> names of the fields that must be present (the --extra-required-fields file contents)
+    extra_required_fields: typing.Mapping[str, typing.Iterable[str]] = None
+
+    def show_all(self):
+        """Applies all the show options except show_raw_data (same as --show-all)"""
+        self.show_root_info = True
+        self.show_region_info = True
+        self.show_data = True
+        self.show_meta = True
+        self.show_uri = True
+
+
+def info(record: Record, options: InfoOptions, cache: DecodeCache = None) -> dict:
+    """Returns the information about the record, as printed by rec_info
+
+    The regions are decoded through the cache if given, the returned data is frozen then (see Region.read).
+    Raises AssertionError if the validation (options.validate, options.extra_required_fields) fails.
+    """
+    output = {}
 
-if args.show_all:
-    args.show_root_info = True
-    args.show_region_info = True
-    args.show_data = True
-    args.show_meta = True
-    args.show_uri = True
+    if options.show_region_info or options.show_root_info:
+        regions_info = dict()
+        payload_used_size = 0
 
-data = sys.stdin.buffer.read()
+        for name, region in record.regions.items():
+            region_info = region.info_dict()
+            payload_used_size += region.used_size()
+            regions_info[name] = region_info
 
-if args.unhex:
-    data = data.decode()
-    data = data.replace("0x", "").replace(" ", "")
-    data = bytearray.fromhex(data)
-else:
-    data = bytearray(data)
+        if options.show_region_info:
+            output["regions"] = regions_info
 
-record = Record(args.config_file, memoryview(data))
-output = {}
+        if options.show_root_info:
+            overhead = len(record.data) - len(record.payload)
+            output["root"] = {
+                "data_size": len(record.data),
+                "payload_size": len(record.payload),
+                "overhead": overhead,
+                "payload_used_size": payload_used_size,
+                "total_used_size": payload_used_size + overhead,
+            }
 
-if args.show_region_info or args.show_root_info:
-    regions_info = dict()
-    payload_used_size = 0
+    if options.show_data:
+        data = {}
+        unknown_fields = {}
 
-    for name, region in record.regions.items():
-        region_info = region.info_dict()
-        payload_used_size += region.used_size()
-        regions_info[name] = region_info
+        for name, region in record.regions.items():
+            if name == "meta" and not options.show_meta:
+                continue
 
-    if args.show_region_info:
-        output["regions"] = regions_info
+            unknown_fields = dict()
+            data[name] = region.read(out_unknown_fields=unknown_fields, config=DecodeConfig(expand_implied=options.expand_tags), cache=cache)
 
-    if args.show_root_info:
-        overhead = len(record.data) - len(record.payload)
-        output["root"] = {
-            "data_size": len(record.data),
-            "payload_size": len(record.payload),
-            "overhead": overhead,
-            "payload_used_size": payload_used_size,
-            "total_used_size": payload_used_size + overhead,
-        }
+            if len(unknown_fields) > 0:
+                unknown_fields[name] = unknown_fields
 
-if args.show_data:
-    data = {}
-    unknown_fields = {}
+        output["data"] = data
 
-    for name, region in record.regions.items():
-        if name == "meta" and not args.show_meta:
-            continue
+        if len(unknown_fields):
+            output["unknown_fields"] = unknown_fields
 
-        unknown_fields = dict()
-        data[name] = region.read(out_unknown_fields=unknown_fields)
+    if options.show_raw_data:
+        data = {}
 
-        if len(unknown_fields) > 0:
-            unknown_fields[name] = unknown_fields
+        for name, region in record.regions.items():
+            if options.show_meta or name != "meta":
+                data[name] = region.fetch().hex()
 
-    output["data"] = data
+        output["raw_data"] = data
 
-    if len(unknown_fields):
-        output["unknown_fields"] = unknown_fields
+    if options.show_uri:
+        output["uri"] = record.uri
+
+    if options.validate:
+        for name, region in record.regions.items():
+            region.fields.validate(region.read(cache=cache))
+
+    if options.extra_required_fields:
+        for region_name, region_req_fields in options.extra_required_fields.items():
+            region = record.regions.get(region_name)
+            assert region, f"Missing region {region_name}"
+
+            region_data = region.read(cache=cache)
+
+            for req_field_name in region_req_fields:
+                assert req_field_name in region_data, f"Missing field '{req_field_name}' in region '{region_name}'"
+
+    return output
+
+
+parser = argparse.ArgumentParser(prog="rec_info", description="Reads a record from the STDIN and prints various information about it (in the YAML format by default)")
+parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+parser.add_argument("-r", "--show-region-info", action=argparse.BooleanOptionalAction, default=False, help="Print information about regions")
+parser.add_argument("-u", "--show-root-info", action=argparse.BooleanOptionalAction, default=False, help="Print general info about the NFC tag")
+parser.add_argument("-d", "--show-data", action=argparse.BooleanOptionalAction, default=False, help="Parse and print region data")
+parser.add_argument("-b", "--show-raw-data", action=argparse.BooleanOptionalAction, default=False, help="Print raw region data (HEX)")
+parser.add_argument("-m", "--show-meta", action=argparse.BooleanOptionalAction, default=False, help="By default, --show-data hides the meta region. Enabling this option will print it, too.")
+parser.add_argument("-i", "--show-uri", action=argparse.BooleanOptionalAction, default=False, help="If a URI NDEF record is present, report it as well.")
+parser.add_argument("-a", "--show-all", action=argparse.BooleanOptionalAction, default=False, help="Apply all --show options")
+parser.add_argument("-v", "--validate", action=argparse.BooleanOptionalAction, default=False, help="Check that the data are valid")
+parser.add_argument("-f", "--extra-required-fields", type=str, default=None, help="Check that all fields from the specified YAML file are present in the record")
+parser.add_argument("--expand-tags", action=argparse.BooleanOptionalAction, default=False, help="Show tags with all the tags they imply when printing data")
+parser.add_argument("--format", choices=formats.output_formats, default="yaml", help="Output format, bytes are printed as 0x-prefixed hex strings in all the formats")
+parser.add_argument("--unhex", action=argparse.BooleanOptionalAction, default=False, help="Interpret the stdin as a hex string instead of raw bytes")
+parser.add_argument("--profile", action=argparse.BooleanOptionalAction, default=False, help="Measure time spent in the individual parsing stages and print a summary table to stderr")
+parser.add_argument("--profile-trace", type=str, default=None, help="Write the measured parsing stages into the specified file in the Chrome trace event format")
 
-if args.show_raw_data:
-    data = {}
 
-    for name, region in record.regions.items():
-        if args.show_meta or name != "meta":
-            data[name] = region.memory.hex()
+def main(argv: list[str] = None, input: bytes = None) -> bytes:
+    """Runs rec_info with the command line arguments on the input record data (stdin if None), returns the output"""
+    args = parser.parse_args(argv)
 
-    output["raw_data"] = data
+    if args.profile or args.profile_trace:
+        profiling.enable(trace=args.profile_trace is not None)
 
-if args.show_uri:
-    output["uri"] = record.uri
+    options = InfoOptions(
+        show_region_info=args.show_region_info,
+        show_root_info=args.show_root_info,
+        show_data=args.show_data,
+        show_raw_data=args.show_raw_data,
+        show_meta=args.show_meta,
+        show_uri=args.show_uri,
+        validate=args.validate,
+        expand_tags=args.expand_tags,
+    )
 
-if args.validate:
-    for name, region in record.regions.items():
-        region.fields.validate(region.read())
+    if args.show_all:
+        options.show_all()
 
-if args.extra_required_fields:
-    with open(args.extra_required_fields, "r") as f:
-        req_fields = yaml.safe_load(f)
+    if args.extra_required_fields:
+        with open(args.extra_required_fields, "r") as f:
+            options.extra_required_fields = formats.load_yaml(f)
 
-    for region_name, region_req_fields in req_fields.items():
-        region = record.regions.get(region_name)
-        assert region, f"Missing region {region_name}"
+    data = input if input is not None else sys.stdin.buffer.read()
 
-        region_data = region.read()
+    if args.unhex:
+        data = data.decode()
+        data = data.replace("0x", "").replace(" ", "")
+        data = bytearray.fromhex(data)
+    else:
+        data = bytearray(data)
 
-        for req_field_name in region_req_fields:
-            assert req_field_name in region_data, f"Missing field '{req_field_name}' in region '{region_name}'"
+    try:
+        with profiling.stage("record.init"):
+            record = Record(args.config_file, memoryview(data))
 
+        output = formats.dumps(info(record, options), args.format)
 
-def yaml_hex_bytes_representer(dumper: yaml.SafeDumper, data: bytes):
-    return dumper.represent_str("0x" + data.hex())
+    finally:
+        if profiler := profiling.disable():
+            if args.profile:
+                print(profiler.format_table(), file=sys.stderr)
 
+            if args.profile_trace:
+                profiler.write_trace(args.profile_trace)
 
-class InfoDumper(yaml.SafeDumper):
-    pass
+    return output
 
 
-InfoDumper.add_representer(bytes, yaml_hex_bytes_representer)
-yaml.dump(output, stream=sys.stdout, Dumper=InfoDumper, sort_keys=False)
+if __name__ == "__main__":
+    sys.stdout.buffer.write(main())
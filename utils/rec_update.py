@@ -1,29 +1,52 @@
 import sys
 import argparse
-import yaml
+import typing
 
+import worker
+
+# Hand the call over to the resident worker if it is running, before the costly imports
+if __name__ == "__main__":
+    worker.forward("rec_update")
+
+import formats
 from record import Record
+from fields import EncodeConfig
 from common import default_config_file
 
+
+def update(record: Record, plan: typing.Mapping[str, typing.Any], clear: bool = False):
+    """Updates the record in place according to the update document
+
+    The plan has the format of the rec_update files: {"data": {region: {field: value}}, "remove": {region: [field]}}.
+    If clear is set, the regions are cleared instead of updated (only the plan fields are then present).
+    """
+    for region_name, region in record.regions.items():
+        region.update(
+            update_fields=plan.get("data", dict()).get(region_name, dict()),
+            remove_fields=plan.get("remove", dict()).get(region_name, dict()),
+            clear=clear,
+        )
+
+
 parser = argparse.ArgumentParser(prog="rec_update", description="Reads a record from STDIN and updates its fields according to the provided YAML file. Updated record is then printed to stdout.")
-parser.add_argument("update_data", help="YAML file with instructions how to update the file")
+parser.add_argument("update_data", help="YAML, JSON or CBOR file with instructions how to update the file")
 parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+parser.add_argument("--format", choices=formats.input_formats, default=None, help="Format of the update file, guessed from the file extension by default (.json, .cbor, YAML otherwise)")
 parser.add_argument("--clear", action=argparse.BooleanOptionalAction, default=False, help="If set, the regions mentioned in the YAML file will be cleared rather than updated")
 parser.add_argument("--indefinite-containers", action=argparse.BooleanOptionalAction, default=True, help="Encode CBOR containers as indefinite (using stop code instead of specifying length)")
 parser.add_argument("--canonical", action=argparse.BooleanOptionalAction, default=True, help="Encode the CBOR maps canonically (order map keys)")
 
-args = parser.parse_args()
 
-record = Record(args.config_file, memoryview(bytearray(sys.stdin.buffer.read())))
-record.encode_config.canonical = args.canonical
-record.encode_config.indefinite_containers = args.indefinite_containers
+def main(argv: list[str] = None, input: bytes = None) -> bytes:
+    """Runs rec_update with the command line arguments on the input record data (stdin if None), returns the updated record"""
+    args = parser.parse_args(argv)
+
+    record = Record(args.config_file, memoryview(bytearray(input if input is not None else sys.stdin.buffer.read())))
+    record.encode_config = EncodeConfig(canonical=args.canonical, indefinite_containers=args.indefinite_containers)
+
+    update(record, formats.load_file(args.update_data, args.format), clear=args.clear)
+    return bytes(record.data)
 
-update_data = yaml.safe_load(open(args.update_data, "r"))
-for region_name, region in record.regions.items():
-    region.update(
-        update_fields=update_data.get("data", dict()).get(region_name, dict()),
-        remove_fields=update_data.get("remove", dict()).get(region_name, dict()),
-        clear=args.clear,
-    )
 
-sys.stdout.buffer.write(record.data)
+if __name__ == "__main__":
+    sys.stdout.buffer.write(main())
@@ -1,20 +1,100 @@
 import os
 import ndef
-import yaml
 import cbor2_local as cbor2
 import io
 import types
 import typing
+import collections.abc
+import profiling
 
-from fields import Fields, EncodeConfig
+from fields import Fields, EncodeConfig, DecodeConfig
+from common import cached_load
+from formats import load_yaml
+from paged import PagedBuffer
+from decode_cache import DecodeCache
+
+
+class RegionView(collections.abc.Mapping):
+    """Read-only mapping over the region data that decodes the fields lazily
+
+    Offsets of the fields are indexed on access, scanning the region only as far as needed to find the accessed field,
+    and each field is decoded only when it is accessed. Decoded values are cached, so the view reflects the region data
+    at the time they were accessed. Unknown fields are not present in the view.
+    """
+
+    __slots__ = ("region", "_offsets", "_scanner", "_cache")
+
+    region: typing.Any
+    _offsets: dict[int, int]  # Field key -> offset of the value in the region memory
+    _scanner: typing.Iterator[tuple[typing.Any, int]]  # Continues indexing the region, None when fully indexed
+    _cache: dict[str, typing.Any]
+
+    def __init__(self, region):
+        self.region = region
+        self._offsets = dict()
+        self._scanner = None if region.is_corrupt else cbor2.iter_map(region.memory)
+        self._cache = dict()
+
+    def _offset(self, key: int) -> int | None:
+        offset = self._offsets.get(key)
+        if offset is not None or self._scanner is None:
+            return offset
+
+        with profiling.stage("region.view_index"):
+            for scanned_key, offset in self._scanner:
+                self._offsets[scanned_key] = offset
+                if scanned_key == key:
+                    return offset
+
+        self._scanner = None
+        return None
+
+    def _index(self) -> dict[int, int]:
+        if self._scanner is not None:
+            self._offset(None)
+
+        return self._offsets
+
+    def __getitem__(self, name: str):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        field = self.region.fields.fields_by_name.get(name)
+        offset = self._offset(field.key) if field is not None else None
+        if offset is None:
+            raise KeyError(name)
+
+        try:
+            value = field.decode(cbor2.load_from(self.region.memory, offset)[0])
+        except Exception as e:
+            e.add_note(f"Field {field.key} {field.name}")
+            raise
+
+        self._cache[name] = value
+        return value
+
+    def __iter__(self):
+        fields_by_key = self.region.fields.fields_by_key
+        return (fields_by_key[key].name for key in self._index() if key in fields_by_key)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        field = self.region.fields.fields_by_name.get(name)
+        return field is not None and self._offset(field.key) is not None
 
 
 class Region:
+    __slots__ = ("memory", "offset", "fields", "record", "_is_corrupt")
+
     memory: memoryview
     offset: int  # Offset of the region relative to payload start
     fields: Fields
     record: typing.Any
-    is_corrupt: bool = False
+    _is_corrupt: bool | None  # None until validated
 
     def __init__(self, record, offset: int, memory: memoryview, fields: Fields):
         assert type(memory) is memoryview
@@ -24,14 +104,42 @@ class Region:
         self.offset = offset
         self.memory = memory
         self.fields = fields
+        self._is_corrupt = None
+
+        # Regions of a lazily fetched record are validated (and fetched) on the first access
+        if record.buffer is None:
+            self._validate()
+
+    def _validate(self):
+        self._is_corrupt = False
 
         try:
-            cbor2.load(io.BytesIO(self.memory))
+            with profiling.stage("region.validate"):
+                cbor2.load_from(self.fetch())
         except cbor2.CBORError:
-            self.is_corrupt = True
+            self._is_corrupt = True
 
         if len(self.memory) == 0:
-            self.is_corrupt = True
+            self._is_corrupt = True
+
+    @property
+    def is_corrupt(self) -> bool:
+        if self._is_corrupt is None:
+            self._validate()
+
+        return self._is_corrupt
+
+    @is_corrupt.setter
+    def is_corrupt(self, value: bool):
+        self._is_corrupt = value
+
+    def fetch(self) -> memoryview:
+        """Returns the region memory, fetching it first if the record is backed by a PagedBuffer"""
+        if self.record.buffer is not None:
+            start = self.record.payload_offset + self.offset
+            self.record.buffer.fetch(start, start + len(self.memory))
+
+        return self.memory
 
     def info_dict(self):
         result = {
@@ -50,15 +158,35 @@ class Region:
         if self.is_corrupt:
             return 0
 
-        data_io = io.BytesIO(self.memory)
-        cbor2.load(data_io)
-        return data_io.tell()
+        return cbor2.load_from(self.memory)[1]
+
+    def read(self, out_unknown_fields: dict[any, any] = None, config: DecodeConfig = None, cache: DecodeCache = None) -> dict[str, any]:
+        """Decodes the region data
+
+        With a cache, identical region contents are decoded only once and the returned data is frozen and shared
+        (see decode_cache.py). Compact reads are not cached.
+        """
+        config = config or self.record.decode_config
 
-    def read(self, out_unknown_fields: dict[any, any] = None) -> dict[str, any]:
         if self.is_corrupt:
-            return {}
+            return self.fields.data_class() if config.compact else {}
+
+        if cache is not None and not config.compact:
+            data, unknown_fields = cache.get(self.memory, self.fields, config, lambda out: self._decode(out, config))
+            if out_unknown_fields is not None:
+                out_unknown_fields.update(unknown_fields)
+
+            return data
+
+        return self._decode(out_unknown_fields, config)
 
-        return self.fields.decode(io.BytesIO(self.memory), out_unknown_fields=out_unknown_fields)
+    def _decode(self, out_unknown_fields: dict[any, any], config: DecodeConfig) -> dict[str, any]:
+        with profiling.stage("region.read"):
+            return self.fields.decode(cbor2.BufferReader(self.memory), out_unknown_fields=out_unknown_fields, config=config)
+
+    def view(self) -> RegionView:
+        """Returns a read-only mapping over the region data that decodes fields only when they are accessed"""
+        return RegionView(self)
 
     def write(self, data: dict[str, any]):
         return self.update(data, clear=True)
@@ -68,7 +196,8 @@ class Region:
             # Nothing to do
             return
 
-        encoded = self.fields.update(original_data=io.BytesIO(self.memory) if not clear else None, update_fields=update_fields, remove_fields=remove_fields, config=self.record.encode_config)
+        self.fetch()
+        encoded = self.fields.update(original_data=cbor2.BufferReader(self.memory) if not clear else None, update_fields=update_fields, remove_fields=remove_fields, config=self.record.encode_config)
         encoded_len = len(encoded)
 
         assert encoded_len <= len(self.memory), f"Data of size {encoded_len} does not fit into region of size {len(self.memory)}"
@@ -79,31 +208,72 @@ class Region:
         return encoded_len
 
 
+def load_config(file: str) -> dict:
+    """Parses the record configuration file, use through common.cached_load to share the parsed file"""
+    with open(file, "r") as f:
+        return load_yaml(f)
+
+
 class Record:
+    """Parsed record (tag memory image)
+
+    The data is either the memoryview of the whole image or a PagedBuffer (see paged.py) that fetches the image
+    lazily, in which case the regions are fetched on their first access and record.data reads zeroes in place of
+    the blocks not fetched yet.
+
+    A record and its regions are not thread-safe, use one record per thread (or lock around the updates). The schema
+    objects and configs a record refers to are immutable and shared, so records of the same config can be processed
+    in parallel. The encode/decode configs are frozen, assign a new config to change the options of a record.
+    """
+
+    __slots__ = ("data", "payload", "payload_offset", "config", "config_dir", "uri", "meta_region", "main_region", "aux_region", "regions", "encode_config", "decode_config", "buffer", "_layout")
+
     data: memoryview
     payload: memoryview
     payload_offset: int  # Offset of the payload relative to the NDEF message start
     config: types.SimpleNamespace
     config_dir: str
-    uri: str = None
+    uri: str
 
-    meta_region: Region = None
-    main_region: Region = None
-    aux_region: Region = None
+    meta_region: Region
+    main_region: Region
+    aux_region: Region
 
-    regions: dict[str, Region] = None
+    regions: dict[str, Region]
 
     encode_config: EncodeConfig
+    decode_config: DecodeConfig
+    buffer: PagedBuffer | None
 
-    def __init__(self, config_file: str, data: memoryview):
-        assert type(data) is memoryview
+    _layout: dict[str, tuple[int, int]]  # Region name -> (offset, size) as declared by the meta region
 
-        self.data = data
+    def __init__(self, config_file: str, data: memoryview | PagedBuffer):
         self.encode_config = EncodeConfig()
+        self.decode_config = DecodeConfig()
 
         self.config_dir = os.path.dirname(config_file)
-        with open(config_file, "r") as f:
-            self.config = types.SimpleNamespace(**yaml.safe_load(f))
+        with profiling.stage("record.load_config"):
+            # The parsed file is shared, the namespace is a copy owned by the record
+            self.config = types.SimpleNamespace(**cached_load(config_file, load_config))
+
+        self._parse(data)
+
+    def _parse(self, data: memoryview | PagedBuffer):
+        if type(data) is PagedBuffer:
+            self.buffer = data
+            data = data.view
+        else:
+            self.buffer = None
+
+        assert type(data) is memoryview
+
+        self.data = data
+        self.uri = None
+        self.meta_region = None
+        self.main_region = None
+        self.aux_region = None
+        self.regions = None
+        self._layout = {}
 
         # Decode the root and find payload
         match self.config.root:
@@ -112,57 +282,103 @@ class Record:
                 self.payload_offset = 0
 
             case "nfcv":
-                data_io = io.BytesIO(data)
-                cc = data_io.read(4)
+                data_io = io.BytesIO(data) if self.buffer is None else self.buffer.open()
 
-                # TODO: Support 8-byte CC (with a different magic)
-                assert cc[0] == 0xE1, "Capability container magic number does not match"
+                with profiling.stage("record.cc_tlv_scan"):
+                    cc = data_io.read(4)
 
-                # Find the NDEF TLV
-                while True:
-                    base_tlv = data_io.read(2)
-                    tag = base_tlv[0]
+                    # TODO: Support 8-byte CC (with a different magic)
+                    assert cc[0] == 0xE1, "Capability container magic number does not match"
 
-                    # Either gone out of range or hit a terminator TLV
-                    if (tag is None) or (tag == 0xFE):
-                        assert base_tlv is not None, "Did not found NDEF TLV"
+                    # Find the NDEF TLV
+                    while True:
+                        base_tlv = data_io.read(2)
+                        tag = base_tlv[0]
 
-                    tlv_len = base_tlv[1]
+                        # Either gone out of range or hit a terminator TLV
+                        if (tag is None) or (tag == 0xFE):
+                            assert base_tlv is not None, "Did not found NDEF TLV"
 
-                    # 0xFF means that length takes two bytes
-                    if tlv_len == 0xFF:
-                        ext_len = data_io.read(2)
-                        assert ext_len is not None
-                        tlv_len = ext_len[0] * 256 | ext_len[1]
+                        tlv_len = base_tlv[1]
 
-                    # 0x03 = NDEF TLV
-                    if tag == 0x03:
-                        # Found it -
-                        break
-                    else:
-                        # Skip the TLV block
-                        data_io.seek(tlv_len, 1)
+                        # 0xFF means that length takes two bytes
+                        if tlv_len == 0xFF:
+                            ext_len = data_io.read(2)
+                            assert ext_len is not None
+                            tlv_len = ext_len[0] * 256 | ext_len[1]
 
-                for record in ndef.message_decoder(data_io):
-                    if type(record) is ndef.UriRecord:
-                        self.uri = record.uri
+                        # 0x03 = NDEF TLV
+                        if tag == 0x03:
+                            # Found it -
+                            break
+                        else:
+                            # Skip the TLV block
+                            data_io.seek(tlv_len, 1)
 
-                    if record.type == self.config.mime_type:
-                        # We have to create a sub memoryview so that when we update the region, the outer data updates as well
-                        end = data_io.tell()
-                        self.payload_offset = end - len(record.data)
-                        self.payload = data[self.payload_offset : end]
-                        assert self.payload == record.data
-                        break
+                with profiling.stage("record.ndef_decode"):
+                    if self.buffer is not None:
+                        self._find_payload(data_io)
 
-                else:
-                    raise Exception(f"Did not find a record of type '{self.config.mime_type}'")
+                    else:
+                        self._decode_ndef(data_io)
 
             case _:
                 raise Exception(f"Unknown root type '{self.config.root}'")
 
         assert type(self.payload) is memoryview
-        self._setup_regions()
+        with profiling.stage("record.setup_regions"):
+            self._setup_regions()
+
+    def _decode_ndef(self, data_io: io.BytesIO):
+        for record in ndef.message_decoder(data_io):
+            if type(record) is ndef.UriRecord:
+                self.uri = record.uri
+
+            if record.type == self.config.mime_type:
+                # We have to create a sub memoryview so that when we update the region, the outer data updates as well
+                end = data_io.tell()
+                self.payload_offset = end - len(record.data)
+                self.payload = self.data[self.payload_offset : end]
+                assert self.payload == record.data
+                break
+
+        else:
+            raise Exception(f"Did not find a record of type '{self.config.mime_type}'")
+
+    def _find_payload(self, data_io: typing.BinaryIO):
+        """Finds the payload by the NDEF record headers, seeking over the payloads so that they are not fetched"""
+        mime_type = self.config.mime_type.encode("ascii")
+
+        while True:
+            record_offset = data_io.tell()
+            header = data_io.read(2)
+            assert len(header) == 2, "NDEF message ended prematurely"
+
+            flags, type_length = header
+            tnf = flags & 0x07
+            payload_length = int.from_bytes(data_io.read(1 if flags & 0x10 else 4), "big")  # SR flag
+            id_length = data_io.read(1)[0] if flags & 0x08 else 0  # IL flag
+            record_type = data_io.read(type_length)
+            payload_offset = data_io.tell() + id_length
+
+            # 0x02 = media type
+            if tnf == 0x02 and record_type == mime_type:
+                self.payload_offset = payload_offset
+                self.payload = self.data[payload_offset : payload_offset + payload_length]
+                assert len(self.payload) == payload_length, "NDEF record exceeds the tag memory"
+                return
+
+            # 0x01 = well-known type, the URI record is small and decoded whole
+            if tnf == 0x01 and record_type == b"U":
+                data_io.seek(record_offset)
+                raw = data_io.read(payload_offset + payload_length - record_offset)
+                self.uri = next(ndef.message_decoder(bytes([raw[0] | 0xC0]) + raw[1:])).uri  # As a message of its own (MB, ME)
+
+            data_io.seek(payload_offset + payload_length)
+
+            # ME flag
+            if flags & 0x40:
+                raise Exception(f"Did not find a record of type '{self.config.mime_type}'")
 
     def _setup_regions(self):
         if "meta_fields" not in self.config.__dict__:
@@ -171,10 +387,18 @@ class Record:
             self.regions = {"main", self.main_region}
             return
 
-        meta_io = io.BytesIO(self.payload)
-        cbor2.load(meta_io)
-        meta_section_size = meta_io.tell()
-        metadata = Region(self, 0, self.payload[0:meta_section_size], Fields.from_file(os.path.join(self.config_dir, self.config.meta_fields))).read()
+        meta_fields = Fields.from_file(os.path.join(self.config_dir, self.config.meta_fields))
+        with profiling.stage("record.meta_decode"):
+            if self.buffer is None:
+                meta_section_size = cbor2.load_from(self.payload)[1]
+
+            else:
+                # Fetch only as far as the meta section goes
+                payload_io = self.buffer.open(self.payload_offset, self.payload_offset + len(self.payload))
+                cbor2.load(payload_io)
+                meta_section_size = payload_io.tell() - self.payload_offset
+
+            metadata = Region(self, 0, self.payload[0:meta_section_size], meta_fields).read()
 
         main_region_offset = metadata.get("main_region_offset", meta_section_size)
         main_region_size = metadata.get("main_region_size")
@@ -187,10 +411,11 @@ class Record:
         region_stops = list(filter(lambda x: x is not None, [main_region_offset, aux_region_offset, len(self.payload)]))
         region_stops.sort()
 
-        def create_region(offset, size, fields):
+        def create_region(name, offset, size, fields):
             if size is None:
                 size = list(filter(lambda a: a > offset, region_stops))[0] - offset
 
+            self._layout[name] = (offset, size)
             result = Region(self, offset, self.payload[offset : offset + size], Fields.from_file(os.path.join(self.config_dir, fields)))
 
             if len(result.memory) != size:
@@ -198,10 +423,59 @@ class Record:
 
             return result
 
-        self.meta_region = create_region(0, None, self.config.meta_fields)
-        self.main_region = create_region(main_region_offset, main_region_size, self.config.main_fields)
+        self.meta_region = create_region("meta", 0, None, self.config.meta_fields)
+        self.main_region = create_region("main", main_region_offset, main_region_size, self.config.main_fields)
         self.regions = {"meta": self.meta_region, "main": self.main_region}
 
         if has_aux_region:
-            self.aux_region = create_region(aux_region_offset, aux_region_size, self.config.aux_fields)
+            self.aux_region = create_region("aux", aux_region_offset, aux_region_size, self.config.aux_fields)
             self.regions["aux"] = self.aux_region
+
+    def refresh(self, data: memoryview) -> list[str]:
+        """Re-parses the record from a new image of the tag, returns the names of the regions whose bytes changed
+
+        The new image is compared with the current one. If the root (CC, TLVs, NDEF headers) and the meta region are
+        unchanged, their parsed layout is reused: the unchanged regions are kept as they are and only the changed
+        ones are validated again. Otherwise the record is parsed from scratch and all the regions are reported.
+        The new image must be a buffer of its own, not the one the record was parsed from.
+        """
+        assert type(data) is memoryview
+        assert data.obj is not self.data.obj, "The new image shares the buffer of the record"
+
+        if self.meta_region is None or len(data) != len(self.data) or not self._same(data, 0, self.payload_offset + len(self.meta_region.memory)):
+            with profiling.stage("record.refresh.parse"):
+                self._parse(data)
+
+            return list(self.regions)
+
+        with profiling.stage("record.refresh.compare"):
+            changed = []
+            payload = data[self.payload_offset : self.payload_offset + len(self.payload)]
+
+            for name, region in self.regions.items():
+                start = self.payload_offset + region.offset
+                if not self._same(data, start, start + len(region.memory)):
+                    changed.append(name)
+
+                region.memory = payload[region.offset : region.offset + len(region.memory)]
+
+            self.data = data
+            self.payload = payload
+            self.buffer = None
+
+        for name in changed:
+            region = self.regions[name]
+            region._validate()
+
+            if len(region.memory) != self._layout[name][1]:
+                region.is_corrupt = True
+
+        return changed
+
+    def _same(self, data: memoryview, start: int, end: int) -> bool:
+        """Whether the bytes [start, end) of the new image are the same as of the current one"""
+        if self.buffer is not None and not self.buffer.is_fetched(start, end):
+            # Not known, as the bytes were never read
+            return False
+
+        return self.data[start:end] == data[start:end]
@@ -0,0 +1,423 @@
+# HTTP service for decoding, updating and initializing tags (rec_info, rec_update and nfc_initialize over HTTP)
+#
+# A minimal HTTP/1.1 server on asyncio (keep-alive, Content-Length bodies, JSON in and out). The event loop only parses
+# the requests and moves bytes around; the tag processing runs in a pool of worker processes, which also serialize
+# the results, so the service scales with the number of CPUs. Batch endpoints take many tags per request and split
+# them into one chunk per worker.
+#
+# Endpoints (tag images are hex strings, optionally 0x-prefixed; bytes in the outputs are 0x-prefixed hex strings):
+#   POST /info, /batch/info              {"data": hex, "options": {...}}, {"items": [hex, ...], "options": {...}}
+#   POST /update, /batch/update          {"data": hex, "plan": {...}}, {"items": [{"data": hex, "plan": {...}}, ...]}
+#   POST /initialize, /batch/initialize  {"args": {...}}, {"items": [{...}, ...]}
+#   GET /metrics                         request counts and latency percentiles per endpoint
+#
+# The options are the rec_info InfoOptions (plus "show_all"), the plans are rec_update documents and the args are
+# nfc_initialize Args (except config_file, all the requests use the config of the service). update also accepts
+# "clear", "canonical" and "indefinite_containers". Requests with invalid options or args are rejected with status 400.
+# Single item endpoints return {"info": ...} / {"data": hex} or an {"error": ...} with status 422, batch endpoints
+# return {"results": [...]} with the per-item results or errors.
+#
+# The headers and the body of a request must arrive within the request timeout since its request line, slow clients
+# are disconnected instead of holding the connection indefinitely.
+#
+# Printers poll the same tags over and over, so the info requests decode the regions through a decode cache (one per
+# process) and identical regions are decoded once.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import math
+import os
+import signal
+import sys
+import time
+import typing
+
+import formats
+import rec_info
+import rec_update
+import worker
+from record import Record
+from fields import EncodeConfig
+from nfc_initialize import nfc_initialize, Args as InitializeArgs
+from common import default_config_file
+from decode_cache import DecodeCache
+
+# Latencies kept per endpoint for the percentiles
+metrics_window = 10000
+
+max_body_size = 64 * 1024 * 1024
+
+# Decoded regions of the info requests, each worker process has its own
+decode_cache = DecodeCache()
+
+_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error", 501: "Not Implemented"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return math.nan
+
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+class Metrics:
+    """Request counts and latencies per endpoint"""
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.in_flight = 0
+        self.endpoints: dict[str, dict] = dict()
+
+    def add(self, endpoint: str, status: int, items: int, duration: float):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {"requests": 0, "errors": 0, "items": 0, "latencies": collections.deque(maxlen=metrics_window)}
+
+        stats["requests"] += 1
+        stats["errors"] += status >= 400
+        stats["items"] += items
+        stats["latencies"].append(duration)
+
+    def summary(self) -> dict:
+        endpoints = dict()
+        for endpoint, stats in sorted(self.endpoints.items()):
+            latencies = sorted(stats["latencies"])
+            endpoints[endpoint] = {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "items": stats["items"],
+                "latency_ms": {
+                    "mean": round(sum(latencies) / len(latencies) * 1e3, 3),
+                    "p50": round(percentile(latencies, 50) * 1e3, 3),
+                    "p90": round(percentile(latencies, 90) * 1e3, 3),
+                    "p99": round(percentile(latencies, 99) * 1e3, 3),
+                    "max": round(latencies[-1] * 1e3, 3),
+                },
+            }
+
+        return {"uptime_s": round(time.monotonic() - self.start_time, 3), "in_flight": self.in_flight, "endpoints": endpoints}
+
+
+# Tag processing, runs in the worker processes. Returns the results serialized to JSON, so that the event loop only
+# joins them into the response.
+
+
+def _json(data) -> bytes:
+    return json.dumps(data, default=formats.json_default, separators=(",", ":")).encode("utf-8")
+
+
+def _error(e: Exception) -> bytes:
+    return _json({"error": f"{type(e).__name__}: {e}"})
+
+
+def _image(value: str) -> memoryview:
+    if not isinstance(value, str):
+        raise TypeError("Tag data must be a hex string")
+
+    return memoryview(bytearray.fromhex(value.removeprefix("0x")))
+
+
+def info_items(config_file: str, images: list[str], options: rec_info.InfoOptions) -> list[bytes]:
+    result = []
+    for image in images:
+        try:
+            result.append(_json({"info": rec_info.info(Record(config_file, _image(image)), options, decode_cache)}))
+        except (Exception, SystemExit) as e:
+            # The utilities exit on some failures, that must not take the worker down
+            result.append(_error(e))
+
+    return result
+
+
+def update_items(config_file: str, items: list[dict], clear: bool, encode_config: EncodeConfig) -> list[bytes]:
+    result = []
+    for item in items:
+        try:
+            record = Record(config_file, _image(item["data"]))
+            record.encode_config = encode_config
+            rec_update.update(record, item.get("plan") or {}, clear=clear)
+            result.append(_json({"data": bytes(record.data)}))
+        except (Exception, SystemExit) as e:
+            # The utilities exit on some failures, that must not take the worker down
+            result.append(_error(e))
+
+    return result
+
+
+def initialize_items(config_file: str, items: list[dict]) -> list[bytes]:
+    result = []
+    for item in items:
+        try:
+            result.append(_json({"data": nfc_initialize(InitializeArgs(**item, config_file=config_file))}))
+        except (Exception, SystemExit) as e:
+            # The utilities exit on some failures, that must not take the worker down
+            result.append(_error(e))
+
+    return result
+
+
+def _info_options(options: dict) -> rec_info.InfoOptions:
+    if not isinstance(options, dict):
+        raise BadRequest("options must be an object")
+
+    options = dict(options)
+    show_all = options.pop("show_all", False)
+
+    # extra_required_fields is passed as the mapping itself, not a file
+    known = {field.name for field in dataclasses.fields(rec_info.InfoOptions)}
+    if unknown := set(options) - known:
+        raise BadRequest(f"Unknown options {sorted(unknown)}")
+
+    result = rec_info.InfoOptions(**options)
+    if show_all:
+        result.show_all()
+
+    return result
+
+
+def _check_initialize_args(args: dict):
+    if not isinstance(args, dict):
+        raise BadRequest("initialize args must be objects")
+
+    if "config_file" in args:
+        raise BadRequest("config_file cannot be specified, the service config is used")
+
+    fields = {field.name: field for field in dataclasses.fields(InitializeArgs) if field.name != "config_file"}
+    if unknown := set(args) - set(fields):
+        raise BadRequest(f"Unknown args {sorted(unknown)}")
+
+    arg_types = typing.get_type_hints(InitializeArgs)
+    for name, field in fields.items():
+        if name not in args:
+            if field.default is dataclasses.MISSING:
+                raise BadRequest(f"Missing arg '{name}'")
+
+            continue
+
+        # bool is not accepted for int
+        value = args[name]
+        if not (type(value) is arg_types[name] or (value is None and field.default is None)):
+            raise BadRequest(f"Arg '{name}' must be {arg_types[name].__name__}")
+
+
+class Service:
+    def __init__(self, config_file: str, workers: int, keep_alive_timeout: float = 15.0, request_timeout: float = 30.0):
+        self.config_file = config_file
+        self.workers = workers
+        self.keep_alive_timeout = keep_alive_timeout
+        self.request_timeout = request_timeout
+        self.metrics = Metrics()
+
+        # workers = 0 processes the tags in the event loop, for debugging
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=worker.preload, initargs=(config_file,)) if workers > 0 else None
+
+        self.routes = {
+            "/info": (self.info, False),
+            "/batch/info": (self.info, True),
+            "/update": (self.update, False),
+            "/batch/update": (self.update, True),
+            "/initialize": (self.initialize, False),
+            "/batch/initialize": (self.initialize, True),
+        }
+
+    async def run_items(self, func, items: list, *args) -> list[bytes]:
+        """Runs func(config_file, chunk, *args) on chunks of the items in the pool, returns the concatenated results"""
+        if self.pool is None:
+            return func(self.config_file, items, *args)
+
+        chunk_size = max(1, math.ceil(len(items) / self.workers))
+        loop = asyncio.get_running_loop()
+        chunks = await asyncio.gather(*(loop.run_in_executor(self.pool, func, self.config_file, items[i : i + chunk_size], *args) for i in range(0, len(items), chunk_size)))
+        return [result for chunk in chunks for result in chunk]
+
+    async def info(self, request: dict, batch: bool) -> list[bytes]:
+        return await self.run_items(info_items, self.items(request, batch, "data"), _info_options(request.get("options", {})))
+
+    async def update(self, request: dict, batch: bool) -> list[bytes]:
+        items = self.items(request, batch, None)
+        if any(not isinstance(item, dict) or "data" not in item for item in items):
+            raise BadRequest("update items must be objects with data")
+
+        encode_config = EncodeConfig(canonical=request.get("canonical", True), indefinite_containers=request.get("indefinite_containers", True))
+        return await self.run_items(update_items, items, bool(request.get("clear", False)), encode_config)
+
+    async def initialize(self, request: dict, batch: bool) -> list[bytes]:
+        items = self.items(request, batch, "args")
+        for item in items:
+            _check_initialize_args(item)
+
+        return await self.run_items(initialize_items, items)
+
+    def items(self, request: dict, batch: bool, key: str | None) -> list:
+        if batch:
+            items = request.get("items")
+            if not isinstance(items, list):
+                raise BadRequest("items must be a list")
+
+            return items
+
+        # Single item requests carry the item in the request itself (update) or under the key
+        if key is None:
+            return [request]
+
+        if key not in request:
+            raise BadRequest(f"Missing '{key}'")
+
+        return [request[key]]
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> tuple[int, bytes, int]:
+        """Returns (status, response body, number of processed items)"""
+        if path == "/metrics":
+            if method != "GET":
+                return 405, _json({"error": "Use GET"}), 0
+
+            return 200, _json(self.metrics.summary()), 0
+
+        route = self.routes.get(path)
+        if route is None:
+            return 404, _json({"error": f"Unknown endpoint '{path}'"}), 0
+
+        if method != "POST":
+            return 405, _json({"error": "Use POST"}), 0
+
+        handler, batch = route
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise BadRequest("The request must be a JSON object")
+
+            results = await handler(request, batch)
+
+        except (BadRequest, ValueError) as e:
+            return 400, _json({"error": str(e)}), 0
+
+        if batch:
+            return 200, b'{"results":[' + b",".join(results) + b"]}", len(results)
+
+        return (422 if results[0].startswith(b'{"error"') else 200), results[0], 1
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if not request_line:
+                    break
+
+                start = time.perf_counter()
+                self.metrics.in_flight += 1
+                try:
+                    keep_alive = await self.handle_request(request_line, reader, writer, start)
+                finally:
+                    self.metrics.in_flight -= 1
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def handle_request(self, request_line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, start: float) -> bool:
+        """Reads the request and writes the response, returns whether to keep the connection open"""
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            await self.respond(writer, 400, _json({"error": "Malformed request line"}), False, "invalid", 0, start)
+            return False
+
+        headers = dict()
+        while True:
+            line = await self.read(reader.readline(), start)
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        path = target.split("?", 1)[0]
+
+        if "transfer-encoding" in headers:
+            await self.respond(writer, 501, _json({"error": "Chunked requests are not supported, send Content-Length"}), False, path, 0, start)
+            return False
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            await self.respond(writer, 400, _json({"error": "Invalid Content-Length"}), False, path, 0, start)
+            return False
+
+        if length > max_body_size:
+            await self.respond(writer, 413, _json({"error": f"Request body exceeds {max_body_size} bytes"}), False, path, 0, start)
+            return False
+
+        body = await self.read(reader.readexactly(length), start)
+
+        try:
+            status, response, items = await self.dispatch(method, path, body)
+        except Exception as e:
+            status, response, items = 500, _error(e), 0
+
+        await self.respond(writer, status, response, keep_alive, path if path in self.routes or path == "/metrics" else "unknown", items, start)
+        return keep_alive
+
+    async def read(self, read, start: float) -> bytes:
+        """Awaits the read of a part of the request, raises asyncio.TimeoutError if the request timeout since start expires"""
+        return await asyncio.wait_for(read, start + self.request_timeout - time.perf_counter())
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, body: bytes, keep_alive: bool, endpoint: str, items: int, start: float):
+        duration = time.perf_counter() - start
+        self.metrics.add(endpoint, status, items, duration)
+
+        head = f"HTTP/1.1 {status} {_reasons[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\nServer-Timing: total;dur={duration * 1e3:.3f}\r\n\r\n"
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Service listening on http://{host}:{port}", file=sys.stderr, flush=True)
+
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="service", description="HTTP service providing the rec_info, rec_update and nfc_initialize operations, including batch variants")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file, used for all the requests")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on, 0 = any free port")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes, 0 = process the tags in the event loop")
+    parser.add_argument("--keep-alive-timeout", type=float, default=15.0, help="Close idle connections after the specified number of seconds")
+    parser.add_argument("--request-timeout", type=float, default=30.0, help="Close connections that do not send the request headers and body within the specified number of seconds")
+
+    args = parser.parse_args()
+
+    service = Service(args.config_file, args.workers, args.keep_alive_timeout, args.request_timeout)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
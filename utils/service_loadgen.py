@@ -0,0 +1,133 @@
+# Load generator for the HTTP service (service.py)
+#
+# Opens a number of keep-alive connections and sends info/update requests with the tags of a corpus over each of them
+# in a closed loop (next request once the previous response arrives). Reports the throughput and latency
+# percentiles measured on the client side.
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+
+import yaml
+
+from corpus import read_corpus
+from service import percentile
+
+
+async def _request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str, body: bytes) -> tuple[int, bytes]:
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+
+    return status, await reader.readexactly(length)
+
+
+def _bodies(endpoint: str, images: list[bytes], batch: int, plan: dict) -> list[bytes]:
+    """Returns the request bodies, cycling through the images"""
+    images = [bytes(image).hex() for image in images]
+    path_items = [images[i : i + batch] for i in range(0, len(images), batch)] if batch > 1 else [[image] for image in images]
+
+    result = []
+    for items in path_items:
+        match endpoint, batch > 1:
+            case "info", False:
+                request = {"data": items[0], "options": {"show_data": True}}
+            case "info", True:
+                request = {"items": items, "options": {"show_data": True}}
+            case "update", False:
+                request = {"data": items[0], "plan": plan}
+            case "update", True:
+                request = {"items": [{"data": item, "plan": plan} for item in items]}
+
+        result.append(json.dumps(request).encode())
+
+    return result
+
+
+async def run(host: str, port: int, path: str, bodies: list[bytes], concurrency: int, requests: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    statuses = dict()
+    next_body = itertools.cycle(bodies)
+    sent = 0
+
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    async def client():
+        nonlocal errors, sent
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while (requests is None or sent < requests) and (deadline is None or time.perf_counter() < deadline):
+                sent += 1
+                request_start = time.perf_counter()
+                status, response = await _request(reader, writer, host, path, next(next_body))
+                latencies.append(time.perf_counter() - request_start)
+
+                statuses[status] = statuses.get(status, 0) + 1
+                if status != 200 or b'"error"' in response:
+                    errors += 1
+
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1e3, 3),
+            "p90": round(percentile(latencies, 90) * 1e3, 3),
+            "p99": round(percentile(latencies, 99) * 1e3, 3),
+            "max": round(latencies[-1] * 1e3, 3) if latencies else None,
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="service_loadgen", description="Sends requests with the tags of a corpus (see corpus.py) to the HTTP service and reports throughput and latency")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-e", "--endpoint", choices=("info", "update"), default="info")
+    parser.add_argument("-b", "--batch", type=int, default=1, help="Tags per request, more than 1 uses the batch endpoints")
+    parser.add_argument("-n", "--concurrency", type=int, default=8, help="Number of concurrent keep-alive connections")
+    parser.add_argument("-r", "--requests", type=int, default=None, help="Total number of requests to send")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Duration of the test in seconds, if --requests is not specified")
+    parser.add_argument("--update-file", type=str, default=None, help="rec_update YAML file used as the plan of the update requests (consumed_weight update by default)")
+    parser.add_argument("--strict", action=argparse.BooleanOptionalAction, default=False, help="Exit with an error code if any of the requests failed")
+
+    args = parser.parse_args()
+
+    plan = {"data": {"aux": {"consumed_weight": 100}}}
+    if args.update_file:
+        with open(args.update_file, "r") as f:
+            plan = yaml.safe_load(f)
+
+    bodies = _bodies(args.endpoint, list(read_corpus(args.corpus)), args.batch, plan)
+    assert bodies, "The corpus is empty"
+
+    path = f"/batch/{args.endpoint}" if args.batch > 1 else f"/{args.endpoint}"
+    result = asyncio.run(run(args.host, args.port, path, bodies, args.concurrency, args.requests, None if args.requests else args.duration))
+    result = {"endpoint": path, "batch": args.batch, "concurrency": args.concurrency, **result, "tags_per_s": round(result["requests_per_s"] * args.batch, 1)}
+
+    print(yaml.dump(result, sort_keys=False), end="")
+
+    if args.strict and result["errors"]:
+        sys.exit(1)
@@ -0,0 +1,161 @@
+# Derivation of the brand/material/package/instance UUIDs (see "UUIDs" in docs_src/nfc_data_format.md)
+#
+# The UUIDs are UUIDv5 of binary concatenations: brand_uuid = N + brand_name, material_uuid = N + brand_uuid + material_name,
+# package_uuid = N + brand_uuid + gtin, instance_uuid = N + brand_uuid + nfc_tag_uid.
+# Brand, material and package UUIDs repeat across many tags, so their derivations are memoized.
+
+import argparse
+import functools
+import hashlib
+import sys
+import typing
+import uuid
+
+brand_namespace = uuid.UUID("5269dfb7-1559-440a-85be-aba5f3eff2d2")
+material_namespace = uuid.UUID("616fc86d-7d99-4953-96c7-46d2836b9be9")
+package_namespace = uuid.UUID("6f7d485e-db8d-4979-904e-a231cd6602b2")
+instance_namespace = uuid.UUID("31062f81-b5bd-4f86-a5f8-46367e841508")
+
+# Number of memoized derivations per UUID kind
+cache_size = 65536
+
+
+def _uuid5_str(digest: bytes) -> str:
+    """Formats a SHA-1 digest as a UUIDv5 string (RFC 4122, section 4.3)"""
+    h = digest[:16].hex()
+
+    # Version 5 and the RFC 4122 variant bits
+    return f"{h[:8]}-{h[8:12]}-5{h[13:16]}-{(int(h[16], 16) & 0x3) | 0x8:x}{h[17:20]}-{h[20:32]}"
+
+
+def _uuid5(namespace: uuid.UUID, *parts: bytes) -> str:
+    # uuid.uuid5 does not accept binary names before Python 3.12
+    return _uuid5_str(hashlib.sha1(namespace.bytes + b"".join(parts)).digest())
+
+
+def normalize_tag_uid(tag_uid: bytes | str) -> bytes:
+    """Returns the NFC tag UID as bytes, MSB first
+
+    Accepts bytes or a hex string (optionally with ':' or ' ' separators). Readers often report NFC-V UIDs LSB first,
+    so 8 byte UIDs ending with the 0xE0 manufacturer prefix are reversed.
+    """
+    if isinstance(tag_uid, str):
+        tag_uid = bytes.fromhex(tag_uid.replace(":", "").replace(" ", ""))
+    else:
+        tag_uid = bytes(tag_uid)
+
+    if len(tag_uid) == 8 and tag_uid[0] != 0xE0 and tag_uid[-1] == 0xE0:
+        tag_uid = tag_uid[::-1]
+
+    return tag_uid
+
+
+@functools.lru_cache(maxsize=cache_size)
+def brand_uuid(brand_name: str) -> str:
+    return _uuid5(brand_namespace, brand_name.encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def material_uuid(brand_uuid: str, material_name: str) -> str:
+    return _uuid5(material_namespace, uuid.UUID(brand_uuid).bytes, material_name.encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=cache_size)
+def package_uuid(brand_uuid: str, gtin: int | str) -> str:
+    # Numbers are hashed as decimal strings
+    return _uuid5(package_namespace, uuid.UUID(brand_uuid).bytes, str(gtin).encode("utf-8"))
+
+
+def instance_uuid(brand_uuid: str, tag_uid: bytes | str) -> str:
+    return _uuid5(instance_namespace, uuid.UUID(brand_uuid).bytes, normalize_tag_uid(tag_uid))
+
+
+def instance_uuids(brand_uuid: str, tag_uids: typing.Iterable[bytes | str]) -> list[str]:
+    """Derives instance_uuid for many tags of the same brand (production line batches)
+
+    The hash state after the namespace and brand UUID is computed only once and copied for each of the tags.
+    """
+    prefix = hashlib.sha1(instance_namespace.bytes + uuid.UUID(brand_uuid).bytes)
+
+    result = []
+    for tag_uid in tag_uids:
+        h = prefix.copy()
+        h.update(normalize_tag_uid(tag_uid))
+        result.append(_uuid5_str(h.digest()))
+
+    return result
+
+
+def resolve(data: typing.Mapping[str, typing.Any], tag_uid: bytes | str = None) -> dict[str, str]:
+    """Returns the effective UUIDs of the decoded main region data
+
+    Explicit *_uuid fields take precedence over the derivation. UUIDs that can be neither read nor derived are left out;
+    instance_uuid is only derived if tag_uid is provided.
+    """
+    result = dict()
+
+    brand = data.get("brand_uuid")
+    if brand is None and data.get("brand_name") is not None:
+        brand = brand_uuid(data["brand_name"])
+
+    if brand is None:
+        # Everything else is derived from the brand
+        for name in ("material_uuid", "package_uuid", "instance_uuid"):
+            if data.get(name) is not None:
+                result[name] = data[name]
+
+        return result
+
+    result["brand_uuid"] = brand
+
+    if data.get("material_uuid") is not None:
+        result["material_uuid"] = data["material_uuid"]
+    elif data.get("material_name") is not None:
+        result["material_uuid"] = material_uuid(brand, data["material_name"])
+
+    if data.get("package_uuid") is not None:
+        result["package_uuid"] = data["package_uuid"]
+    elif data.get("gtin") is not None:
+        result["package_uuid"] = package_uuid(brand, data["gtin"])
+
+    if data.get("instance_uuid") is not None:
+        result["instance_uuid"] = data["instance_uuid"]
+    elif tag_uid is not None:
+        result["instance_uuid"] = instance_uuid(brand, tag_uid)
+
+    return result
+
+
+def resolve_batch(data: typing.Iterable[typing.Mapping[str, typing.Any]], tag_uids: typing.Iterable[bytes | str | None] = None) -> list[dict[str, str]]:
+    """resolve() for many records, tag_uids (if provided) are matched with the data by position"""
+    if tag_uids is None:
+        return [resolve(d) for d in data]
+
+    return [resolve(d, tag_uid) for d, tag_uid in zip(data, tag_uids, strict=True)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="uuids", description="Derives the brand, material, package and instance UUIDs as defined by the specification")
+    parser.add_argument("--brand-name", type=str, default=None)
+    parser.add_argument("--brand-uuid", type=str, default=None, help="Use the specified brand UUID instead of deriving it from --brand-name")
+    parser.add_argument("--material-name", type=str, default=None)
+    parser.add_argument("--gtin", type=int, default=None)
+    parser.add_argument("--tag-uid", type=str, default=None, help="NFC tag UID as a hex string")
+    parser.add_argument("--tag-uids-file", type=str, default=None, help="File with one tag UID (hex) per line ('-' for stdin), prints one instance_uuid per line")
+
+    args = parser.parse_args()
+
+    data = {name: value for name, value in (("brand_name", args.brand_name), ("brand_uuid", args.brand_uuid), ("material_name", args.material_name), ("gtin", args.gtin)) if value is not None}
+    result = resolve(data, args.tag_uid)
+
+    if args.tag_uids_file is not None:
+        assert "brand_uuid" in result, "--brand-name or --brand-uuid is required for the batch mode"
+        with open(args.tag_uids_file, "r") if args.tag_uids_file != "-" else sys.stdin as f:
+            tag_uids = [line.strip() for line in f if line.strip()]
+
+        for instance in instance_uuids(result["brand_uuid"], tag_uids):
+            print(instance)
+
+    else:
+        for name, value in result.items():
+            print(f"{name}: {value}")
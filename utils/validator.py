@@ -0,0 +1,332 @@
+# Batch validation of tags against the field schemas and extra requirement files
+#
+# The validator is compiled once: the required/recommended/known fields of each region become key bitmasks and each
+# field gets a check of its raw CBOR value. Validating a region then takes a single raw CBOR decode (no field
+# conversions), one mask comparison for the presence checks and the value checks. All the problems of a record
+# are collected into a structured report instead of stopping at the first failed assertion.
+#
+# Implementations must skip unknown keys (new keys can be added to the specification at any time), so unknown keys are
+# only reported as warnings, and the vendor-specific keys of the aux region are accepted silently.
+
+import argparse
+import dataclasses
+import os
+import sys
+import typing
+
+import yaml
+
+import cbor2_local as cbor2
+from record import Record, Region
+from fields import Fields, Field, StringField, BytesField, EnumField, EnumArrayField, UUIDField
+from corpus import read_corpus
+from common import default_config_file
+
+
+@dataclasses.dataclass
+class Issue:
+    region: str
+
+    # Field name, or the CBOR key for unknown fields, None for issues of the whole region/record
+    field: str | int | None
+
+    # missing_required, missing_recommended, unknown_field, invalid_type, too_long, unknown_enum_item, corrupt_region, missing_region, invalid_record
+    code: str
+
+    message: str
+
+
+@dataclasses.dataclass
+class Report:
+    """Validation result of a single record"""
+
+    errors: list[Issue] = dataclasses.field(default_factory=list)
+    warnings: list[Issue] = dataclasses.field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+# Python types of the raw CBOR values per field type
+_raw_types = {
+    "bool": (bool,),
+    "int": (int,),
+    "number": (int, float),
+    "string": (str,),
+    "enum": (int,),
+    "enum_array": (list,),
+    "timestamp": (int,),
+    "bytes": (bytes,),
+    "uuid": (bytes,),
+}
+
+# Keys permitted for vendor-specific fields, per region (see the Vendor-specific fields section of the specification)
+vendor_key_ranges = {
+    "aux": range(65300, 65535),
+}
+
+
+def _compile_check(field: Field) -> typing.Callable[[typing.Any], tuple[str, str] | None]:
+    """Returns a function checking the raw value of the field, returning (code, message) or None if the value is valid"""
+    raw_types = _raw_types[field.type_name]
+
+    # bool is a subclass of int, but not a valid int value
+    allow_bool = bool in raw_types
+
+    def check_type(value):
+        if type(value) not in raw_types and not (isinstance(value, raw_types) and (allow_bool or not isinstance(value, bool))):
+            return "invalid_type", f"Expected {field.type_name}, got {type(value).__name__}"
+
+        return None
+
+    if type(field) is StringField or type(field) is BytesField:
+        max_len = field.max_len
+
+        def check(value):
+            return check_type(value) or (("too_long", f"Length {len(value)} exceeds max_length {max_len}") if max_len is not None and len(value) > max_len else None)
+
+    elif type(field) is UUIDField:
+
+        def check(value):
+            return check_type(value) or (("invalid_type", f"UUID must have 16 bytes, got {len(value)}") if len(value) != 16 else None)
+
+    elif type(field) is EnumField:
+        names_by_key = field.names_by_key
+
+        def check(value):
+            if type(value) is not int or not (0 <= value < len(names_by_key)) or names_by_key[value] is None:
+                return "unknown_enum_item", f"Unknown item {value!r}"
+
+            return None
+
+    elif type(field) is EnumArrayField:
+        names_by_key = field.names_by_key
+
+        def check(value):
+            if type(value) is not list:
+                return check_type(value)
+
+            for item in value:
+                if type(item) is not int or not (0 <= item < len(names_by_key)) or names_by_key[item] is None:
+                    return "unknown_enum_item", f"Unknown item {item!r}"
+
+            return None
+
+    else:
+        check = check_type
+
+    return check
+
+
+def _mask(keys: typing.Iterable[int]) -> int:
+    result = 0
+    for key in keys:
+        result |= 1 << key
+
+    return result
+
+
+class RegionValidator:
+    """Presence and value checks of a single region, compiled from its fields schema"""
+
+    def __init__(self, fields: Fields, extra_required: typing.Iterable[str] = (), extra_recommended: typing.Iterable[str] = (), vendor_keys: range = range(0)):
+        self.fields = fields
+        self.vendor_keys = vendor_keys
+
+        def keys(names):
+            result = []
+            for name in names:
+                field = fields.fields_by_name.get(name)
+                assert field, f"Unknown field '{name}' in the requirements"
+                result.append(field.key)
+
+            return result
+
+        self.known_mask = _mask(fields.fields_by_key)
+        self.required_mask = _mask(key for key, field in fields.fields_by_key.items() if field.required is True) | _mask(keys(extra_required))
+        self.recommended_mask = (_mask(key for key, field in fields.fields_by_key.items() if field.required == "recommended") | _mask(keys(extra_recommended))) & ~self.required_mask
+
+        self.names_by_key = {key: field.name for key, field in fields.fields_by_key.items()}
+        self.checks = {key: _compile_check(field) for key, field in fields.fields_by_key.items()}
+
+    def validate(self, region_name: str, data: dict, report: Report):
+        """Checks the raw (undecoded) region data, adding the issues to the report"""
+        present = _mask(key for key in data if type(key) is int and key >= 0)
+
+        missing_required = self.required_mask & ~present
+        missing_recommended = self.recommended_mask & ~present
+
+        # Presence checks are a couple of mask operations, the loops below only run if something is missing
+        if missing_required:
+            for key in _mask_keys(missing_required):
+                report.errors.append(Issue(region_name, self.names_by_key[key], "missing_required", f"Missing required field '{self.names_by_key[key]}'"))
+
+        if missing_recommended:
+            for key in _mask_keys(missing_recommended):
+                report.warnings.append(Issue(region_name, self.names_by_key[key], "missing_recommended", f"Missing recommended field '{self.names_by_key[key]}'"))
+
+        checks = self.checks
+        for key, value in data.items():
+            check = checks.get(key)
+            if check is None:
+                if type(key) is not int or key not in self.vendor_keys:
+                    report.warnings.append(Issue(region_name, key, "unknown_field", f"Unknown CBOR key {key!r}"))
+
+                continue
+
+            issue = check(value)
+            if issue is not None:
+                report.errors.append(Issue(region_name, self.names_by_key[key], issue[0], issue[1]))
+
+
+def _mask_keys(mask: int) -> list[int]:
+    result = []
+    key = 0
+    while mask:
+        if mask & 1:
+            result.append(key)
+
+        mask >>= 1
+        key += 1
+
+    return result
+
+
+def load_requirements(file: str) -> dict[str, dict[str, list[str]]]:
+    """Loads an extra requirements YAML file
+
+    The file maps region names to lists of required field names (the --extra-required-fields format of rec_info),
+    or to {"required": [...], "recommended": [...]}.
+    """
+    with open(file, "r") as f:
+        data = yaml.safe_load(f)
+
+    result = dict()
+    for region_name, requirements in data.items():
+        if isinstance(requirements, list):
+            requirements = {"required": requirements}
+
+        result[region_name] = {"required": list(requirements.get("required", [])), "recommended": list(requirements.get("recommended", []))}
+
+    return result
+
+
+class Validator:
+    """Validates records against the schema of the config and optional extra requirement files"""
+
+    def __init__(self, config_file: str = default_config_file, requirement_files: typing.Iterable[str] = ()):
+        self.config_file = config_file
+
+        with open(config_file, "r") as f:
+            config = yaml.safe_load(f)
+
+        requirements = dict()
+        for file in requirement_files:
+            for region_name, region_requirements in load_requirements(file).items():
+                merged = requirements.setdefault(region_name, {"required": [], "recommended": []})
+                merged["required"] += region_requirements["required"]
+                merged["recommended"] += region_requirements["recommended"]
+
+        config_dir = os.path.dirname(config_file)
+        self.regions: dict[str, RegionValidator] = dict()
+        for region_name in ("meta", "main", "aux"):
+            fields_file = config.get(f"{region_name}_fields")
+            if fields_file is None:
+                continue
+
+            region_requirements = requirements.pop(region_name, {})
+            self.regions[region_name] = RegionValidator(
+                Fields.from_file(os.path.join(config_dir, fields_file)),
+                region_requirements.get("required", ()),
+                region_requirements.get("recommended", ()),
+                vendor_key_ranges.get(region_name, range(0)),
+            )
+
+        assert not requirements, f"Requirements for unknown regions {list(requirements)}"
+
+        # Regions that have some required fields must be present
+        self.required_regions = [name for name, validator in self.regions.items() if validator.required_mask]
+
+    def validate_record(self, record: Record) -> Report:
+        report = Report()
+
+        for region_name, validator in self.regions.items():
+            region: Region = record.regions.get(region_name)
+            if region is None:
+                if region_name in self.required_regions and region_name != "meta":
+                    report.errors.append(Issue(region_name, None, "missing_region", f"Missing region '{region_name}'"))
+                continue
+
+            if region.is_corrupt:
+                report.errors.append(Issue(region_name, None, "corrupt_region", "Region data are corrupt"))
+                continue
+
+            # Raw CBOR values, without the field conversions
+            try:
+                data, _ = cbor2.load_from(region.memory)
+            except cbor2.CBORDecodeError as e:
+                report.errors.append(Issue(region_name, None, "corrupt_region", f"Invalid CBOR: {e}"))
+                continue
+
+            if not isinstance(data, dict):
+                report.errors.append(Issue(region_name, None, "corrupt_region", "Region data are not a CBOR map"))
+                continue
+
+            validator.validate(region_name, data, report)
+
+        return report
+
+    def validate_image(self, image: memoryview) -> Report:
+        try:
+            record = Record(self.config_file, image)
+        except Exception as e:
+            # The record structure (NDEF, meta region) is checked while constructing the Record
+            return Report(errors=[Issue("record", None, "invalid_record", f"{type(e).__name__}: {e}")])
+
+        return self.validate_record(record)
+
+    def validate_batch(self, images: typing.Iterable[memoryview]) -> list[Report]:
+        return [self.validate_image(image if type(image) is memoryview else memoryview(image)) for image in images]
+
+
+def summarize(reports: typing.Sequence[Report]) -> dict:
+    """Aggregates the reports: number of valid records and counts of the issues by code and field"""
+    errors = dict()
+    warnings = dict()
+    for report in reports:
+        for issues, counts in ((report.errors, errors), (report.warnings, warnings)):
+            for issue in issues:
+                key = f"{issue.region}.{issue.field}: {issue.code}" if issue.field is not None else f"{issue.region}: {issue.code}"
+                counts[key] = counts.get(key, 0) + 1
+
+    return {
+        "records": len(reports),
+        "valid": sum(1 for report in reports if report.ok),
+        "with_warnings": sum(1 for report in reports if report.warnings),
+        "errors": dict(sorted(errors.items(), key=lambda x: -x[1])),
+        "warnings": dict(sorted(warnings.items(), key=lambda x: -x[1])),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="validator", description="Validates all tags of a corpus (see corpus.py) and prints a summary of the found issues")
+    parser.add_argument("corpus", help="Corpus stream file or directory")
+    parser.add_argument("-c", "--config-file", type=str, default=default_config_file, help="Record configuration YAML file")
+    parser.add_argument("-f", "--extra-required-fields", action="append", default=[], help="YAML file with extra field requirements, can be repeated")
+    parser.add_argument("--show-records", action=argparse.BooleanOptionalAction, default=False, help="Print the issues of the individual records")
+    parser.add_argument("--strict", action=argparse.BooleanOptionalAction, default=False, help="Exit with an error code if any of the records is not valid")
+
+    args = parser.parse_args()
+
+    validator = Validator(args.config_file, args.extra_required_fields)
+    reports = validator.validate_batch(read_corpus(args.corpus))
+
+    output = summarize(reports)
+    if args.show_records:
+        output["records_issues"] = {i: {"errors": [dataclasses.asdict(x) for x in r.errors], "warnings": [dataclasses.asdict(x) for x in r.warnings]} for i, r in enumerate(reports) if r.errors or r.warnings}
+
+    print(yaml.dump(output, sort_keys=False), end="")
+
+    if args.strict and output["valid"] != output["records"]:
+        sys.exit(1)
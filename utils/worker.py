@@ -0,0 +1,228 @@
+# Resident worker for the command line utilities
+#
+# Station scripts run nfc_initialize | rec_update | rec_info for every tag, paying the interpreter startup, imports and
+# schema loading three times per tag. The worker is a long running process that keeps all of that loaded and executes
+# the utilities' main() functions on behalf of thin clients, connected over a local UNIX socket.
+#
+# The client mode is enabled by setting the NFC_WORKER_SOCKET environment variable to the socket path (the worker
+# listens there by default too). The utilities then forward their arguments, working directory and stdin to the
+# worker before importing anything costly, and print the returned stdout/stderr and exit with the returned code.
+# If the worker is not running, they fall back to running in-process as usual.
+#
+# This module is imported by the clients, so it must only use cheap standard library imports at the top level.
+
+import json
+import os
+import socket
+import struct
+import sys
+
+socket_env = "NFC_WORKER_SOCKET"
+
+# Utilities the worker executes, name -> whether the utility reads stdin
+utilities = {
+    "nfc_initialize": False,
+    "rec_update": True,
+    "rec_info": True,
+}
+
+_frame_header = struct.Struct("!I")
+
+
+def _send_frame(sock: socket.socket, data: bytes):
+    sock.sendall(_frame_header.pack(len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    result = bytearray()
+    while len(result) < size:
+        chunk = sock.recv(min(size - len(result), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by the peer")
+
+        result += chunk
+
+    return bytes(result)
+
+
+def _recv_frame(sock: socket.socket) -> bytes:
+    (size,) = _frame_header.unpack(_recv_exact(sock, _frame_header.size))
+    return _recv_exact(sock, size)
+
+
+def _request(sock: socket.socket, util: str, argv: list[str], cwd: str, input: bytes) -> tuple[int, bytes, bytes]:
+    _send_frame(sock, json.dumps({"util": util, "argv": argv, "cwd": cwd}).encode())
+    _send_frame(sock, input)
+
+    code = json.loads(_recv_frame(sock))["code"]
+    stdout = _recv_frame(sock)
+    stderr = _recv_frame(sock)
+
+    return code, stdout, stderr
+
+
+def call(socket_path: str, util: str, argv: list[str], input: bytes = b"", cwd: str = None) -> tuple[int, bytes, bytes]:
+    """Executes the utility in the worker, returns (exit code, stdout, stderr)
+
+    Raises OSError if the worker is not running.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        return _request(sock, util, argv, cwd or os.getcwd(), input)
+
+
+def forward(util: str):
+    """Client mode of the utilities: if the worker is enabled and running, executes the call in it and exits
+
+    Returns without doing anything if the client mode is not enabled or the worker is not running, the caller then
+    continues with the in-process execution.
+    """
+    socket_path = os.environ.get(socket_env)
+    if not socket_path:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return
+
+    # From now on, stdin is consumed and there is no way back to the in-process execution
+    with sock:
+        code, stdout, stderr = _request(sock, util, sys.argv[1:], os.getcwd(), sys.stdin.buffer.read() if utilities[util] else b"")
+
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+    sys.exit(code)
+
+
+def execute(util: str, argv: list[str], cwd: str, input: bytes) -> tuple[int, bytes, bytes]:
+    """Runs the utility's main() in this process, the same way the interpreter would run the script
+
+    Changes the working directory and redirects sys.stdout/sys.stderr for the duration of the call, so the calls must
+    not run concurrently.
+    """
+    import contextlib
+    import importlib
+    import io
+    import traceback
+
+    assert util in utilities, f"Unknown utility '{util}'"
+    module = importlib.import_module(util)
+
+    # Text printed directly (argparse help and errors, validation warnings, profiling tables)
+    printed = io.StringIO()
+    errors = io.StringIO()
+    stdout = b""
+
+    original_cwd = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(printed), contextlib.redirect_stderr(errors):
+            try:
+                stdout = module.main(argv, input)
+                code = 0
+
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    code = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    code = 1
+
+            except Exception:
+                traceback.print_exc()
+                code = 1
+
+    finally:
+        os.chdir(original_cwd)
+
+    return code, printed.getvalue().encode() + stdout, errors.getvalue().encode()
+
+
+def preload(config_file: str):
+    """Imports the utilities and loads the config and all its schemas into the caches"""
+    import importlib
+    from common import cached_load
+    from fields import Fields
+    from record import load_config
+
+    for util in utilities:
+        importlib.import_module(util)
+
+    config = cached_load(config_file, load_config)
+    for key, fields_file in config.items():
+        if key.endswith("_fields"):
+            Fields.from_file(os.path.join(os.path.dirname(config_file), fields_file))
+
+
+def serve(socket_path: str, config_files: list[str] = ()):
+    import signal
+    import socketserver
+    import threading
+
+    for config_file in config_files:
+        preload(config_file)
+
+    if os.path.exists(socket_path):
+        # Refuse to take over the socket of a running worker, remove a stale one
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+        else:
+            sys.exit(f"A worker is already listening on '{socket_path}'")
+
+    # The calls run one at a time, as each of them runs in the working directory of its client
+    execute_lock = threading.Lock()
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            # Clients of a pipeline connect at the same time and each sends its stdin once the previous one is done,
+            # so the requests are received concurrently
+            request = json.loads(_recv_frame(self.request))
+            input = _recv_frame(self.request)
+
+            with execute_lock:
+                code, stdout, stderr = execute(request["util"], request["argv"], request["cwd"], input)
+
+            _send_frame(self.request, json.dumps({"code": code}).encode())
+            _send_frame(self.request, stdout)
+            _send_frame(self.request, stderr)
+
+    # Create the socket accessible only by the owner from the start, the clients make the worker run any command line
+    # in any directory
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        print(f"Worker listening on '{socket_path}'", file=sys.stderr, flush=True)
+        server.serve_forever()
+
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    from common import default_config_file
+
+    parser = argparse.ArgumentParser(prog="worker", description=f"Resident worker executing the nfc_initialize, rec_update and rec_info calls of clients that have the {socket_env} environment variable set")
+    parser.add_argument("-s", "--socket", type=str, default=os.environ.get(socket_env), help=f"Path of the UNIX socket to listen on ({socket_env} by default)")
+    parser.add_argument("-c", "--config-file", action="append", default=None, help="Preload the config and its schemas, can be repeated (the default config by default)")
+
+    args = parser.parse_args()
+    assert args.socket, f"Specify the socket path by --socket or {socket_env}"
+
+    serve(args.socket, args.config_file if args.config_file is not None else [default_config_file])